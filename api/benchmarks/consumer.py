@@ -0,0 +1,538 @@
+"""
+Load-test `DocumentConsumer` in-process and record how it performs.
+
+Simulates a number of rooms with several clients each. Every client keeps
+its own Y.Doc and types into the shared document, while TITLE_UPDATE and
+SAVE events are interleaved with the edits. Consumers are driven through
+`WebsocketCommunicator` on the in-memory channel layer with an in-memory
+SQLite database, so no Postgres or Redis is needed.
+
+Usage:
+    python -m benchmarks.consumer --rooms 10 --clients 5 --edits 200
+    python -m benchmarks.consumer --output results.json --baseline main.json
+
+Results are written as JSON. Passing `--baseline` compares the run against
+an earlier results file and exits with status 1 if a metric regressed by more
+than `--tolerance`.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import string
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import y_py as Y
+from ypy_websocket.yutils import (
+    YMessageType,
+    YSyncMessageType,
+    create_sync_step1_message,
+    create_update_message,
+    read_message,
+)
+
+RECEIVE_TIMEOUT_SECONDS = 30
+
+# Metrics compared against a baseline, and whether higher values are better
+REGRESSION_METRICS = {
+    ("latency_ms", "update_fanout", "p50"): False,
+    ("latency_ms", "update_fanout", "p99"): False,
+    ("latency_ms", "title_fanout", "p99"): False,
+    ("queries", "connect", "per_operation"): False,
+    ("queries", "edit", "per_operation"): False,
+    ("queries", "disconnect", "per_operation"): False,
+    ("throughput", "messages_per_second"): True,
+}
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Nearest-rank percentile of a list of values
+    """
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Summarize latencies in seconds as milliseconds
+    """
+
+    def to_ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "count": len(values),
+        "mean": to_ms(sum(values) / len(values)) if values else None,
+        "p50": to_ms(percentile(values, 0.5)),
+        "p99": to_ms(percentile(values, 0.99)),
+        "max": to_ms(max(values)) if values else None,
+    }
+
+
+def get_rss_bytes() -> int:
+    """
+    Current resident set size of this process
+    """
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak RSS is the best available approximation elsewhere
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+class QueryCounter:
+    """
+    Count SQL queries on every database connection, whichever thread opened it
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
+        connection_created.connect(self.on_connection_created, weak=False)
+        for connection in connections.all():
+            if self not in connection.execute_wrappers:
+                connection.execute_wrappers.append(self)
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class BenchmarkClient:
+    """
+    Simulated editor connected to a document over a WebsocketCommunicator
+    """
+
+    def __init__(self, communicator, rng: random.Random):
+        self.communicator = communicator
+        self.rng = rng
+        self.ydoc = Y.YDoc()
+        self.xml = self.ydoc.get_xml_element("default")
+        self.messages_sent = 0
+        self.messages_received = 0
+        self._update_waiter: Optional[asyncio.Future] = None
+        self._event_waiters: Dict[str, List[asyncio.Future]] = {}
+        self._reader: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError("Consumer rejected the connection")
+        self._reader = asyncio.ensure_future(self._read())
+        await self.send_bytes(
+            create_sync_step1_message(Y.encode_state_vector(self.ydoc))
+        )
+
+    async def disconnect(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.communicator.disconnect()
+
+    async def send_bytes(self, data: bytes):
+        self.messages_sent += 1
+        await self.communicator.send_to(bytes_data=data)
+
+    async def send_event(self, event: dict):
+        self.messages_sent += 1
+        await self.communicator.send_to(text_data=json.dumps(event))
+
+    def expect_update(self) -> asyncio.Future:
+        self._update_waiter = asyncio.get_running_loop().create_future()
+        return self._update_waiter
+
+    def expect_event(self, event_type: str) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self._event_waiters.setdefault(event_type, []).append(waiter)
+        return waiter
+
+    def make_edit(self) -> bytes:
+        """
+        Type into the local document and return the resulting Yjs update
+        """
+
+        state_vector = Y.encode_state_vector(self.ydoc)
+        paragraphs = []
+        child = self.xml.first_child
+        while child is not None:
+            paragraphs.append(child)
+            child = child.next_sibling
+
+        with self.ydoc.begin_transaction() as txn:
+            if not paragraphs or self.rng.random() < 0.05:
+                paragraph = self.xml.push_xml_element(txn, "paragraph")
+                paragraph.push_xml_text(txn)
+            else:
+                paragraph = self.rng.choice(paragraphs)
+                text = paragraph.first_child
+                if text is None:
+                    text = paragraph.push_xml_text(txn)
+                chars = "".join(
+                    self.rng.choices(
+                        string.ascii_lowercase + " ", k=self.rng.randint(1, 5)
+                    )
+                )
+                text.insert(txn, self.rng.randint(0, len(str(text))), chars)
+
+        return Y.encode_state_as_update(self.ydoc, state_vector)
+
+    async def _read(self):
+        while True:
+            message = await self.communicator.receive_output(RECEIVE_TIMEOUT_SECONDS)
+            if message["type"] == "websocket.close":
+                return
+            received_at = time.perf_counter()
+            self.messages_received += 1
+
+            data = message.get("bytes")
+            if data is not None:
+                if (
+                    len(data) > 2
+                    and data[0] == YMessageType.SYNC
+                    and data[1]
+                    in (YSyncMessageType.SYNC_STEP2, YSyncMessageType.SYNC_UPDATE)
+                ):
+                    Y.apply_update(self.ydoc, read_message(data[2:]))
+                    if data[1] == YSyncMessageType.SYNC_UPDATE:
+                        self._resolve(self._update_waiter, received_at)
+                continue
+
+            event_type = json.loads(message["text"]).get("eventType")
+            waiters = self._event_waiters.get(event_type)
+            if not waiters:
+                continue
+            if event_type == "SAVE":
+                # Saves are coalesced, so one SAVE acknowledges every request
+                # made before the flush
+                for waiter in waiters:
+                    self._resolve(waiter, received_at)
+                waiters.clear()
+            else:
+                self._resolve(waiters.pop(0), received_at)
+
+    @staticmethod
+    def _resolve(waiter: Optional[asyncio.Future], value: float):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(value)
+
+
+class ConsumerBenchmark:
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.queries = QueryCounter()
+        self.rooms: Dict[str, List[BenchmarkClient]] = {}
+        self.update_latencies: List[float] = []
+        self.title_latencies: List[float] = []
+        self.save_latencies: List[float] = []
+        self.save_acks: List[asyncio.Future] = []
+
+    def make_client(self, document_id: str) -> BenchmarkClient:
+        from channels.routing import URLRouter
+        from channels.testing import WebsocketCommunicator
+
+        from minidoc_api.routing import websocket_urlpatterns
+
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/documents/{document_id}"
+        )
+        return BenchmarkClient(communicator, random.Random(self.rng.random()))
+
+    async def fan_out(self, sender: BenchmarkClient, peers, send, expect):
+        """
+        Send a message and record how long each peer takes to receive it
+        """
+
+        waiters = [expect(peer) for peer in peers]
+        started = time.perf_counter()
+        await send(sender)
+        received = await asyncio.wait_for(
+            asyncio.gather(*waiters), RECEIVE_TIMEOUT_SECONDS
+        )
+        return [received_at - started for received_at in received]
+
+    async def edit_room(self, clients: List[BenchmarkClient]):
+        options = self.options
+        for index in range(options.edits):
+            sender = clients[index % len(clients)]
+            peers = [client for client in clients if client is not sender]
+
+            if options.title_every and index % options.title_every == 0:
+                title = f"Benchmark {index}"
+                self.title_latencies.extend(
+                    await self.fan_out(
+                        sender,
+                        peers,
+                        lambda client: client.send_event(
+                            {"eventType": "TITLE_UPDATE", "title": title}
+                        ),
+                        lambda peer: peer.expect_event("TITLE_UPDATE"),
+                    )
+                )
+
+            if options.save_every and index % options.save_every == 0:
+                # SAVE is acknowledged after the next flush, so don't wait here
+                self.save_acks.append(self.track_save(sender))
+
+            update = sender.make_edit()
+            self.update_latencies.extend(
+                await self.fan_out(
+                    sender,
+                    peers,
+                    lambda client: client.send_bytes(create_update_message(update)),
+                    lambda peer: peer.expect_update(),
+                )
+            )
+
+    def track_save(self, sender: BenchmarkClient) -> asyncio.Future:
+        waiter = sender.expect_event("SAVE")
+        started = time.perf_counter()
+
+        async def wait():
+            await sender.send_event({"eventType": "SAVE"})
+            received_at = await asyncio.wait_for(waiter, RECEIVE_TIMEOUT_SECONDS)
+            self.save_latencies.append(received_at - started)
+
+        return asyncio.ensure_future(wait())
+
+    async def run(self) -> dict:
+        options = self.options
+        self.queries.install()
+        phases = {}
+
+        # Connect every client, loading each room from the database
+        rss_before = get_rss_bytes()
+        queries_before = self.queries.count
+        for _ in range(options.rooms):
+            document_id = str(uuid.uuid4())
+            self.rooms[document_id] = [
+                self.make_client(document_id) for _ in range(options.clients)
+            ]
+        for clients in self.rooms.values():
+            for client in clients:
+                await client.connect()
+        rss_loaded = get_rss_bytes()
+        phases["connect"] = (
+            options.rooms * options.clients,
+            self.queries.count - queries_before,
+        )
+
+        # Edit all rooms concurrently
+        queries_before = self.queries.count
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(self.edit_room(clients) for clients in self.rooms.values())
+        )
+        duration = time.perf_counter() - started
+        # SAVE is only acknowledged after the autosave delay, so it is left
+        # out of the throughput figures
+        await asyncio.gather(*self.save_acks)
+        operations = len(self.update_latencies) // max(options.clients - 1, 1)
+        operations += len(self.title_latencies) // max(options.clients - 1, 1)
+        operations += len(self.save_acks)
+        phases["edit"] = (operations, self.queries.count - queries_before)
+
+        rss_edited = get_rss_bytes()
+        state_sizes = [
+            len(Y.encode_state_as_update(room.ydoc)) for room in self._resident_rooms()
+        ]
+
+        messages_sent = sum(
+            client.messages_sent
+            for clients in self.rooms.values()
+            for client in clients
+        )
+        messages_received = sum(
+            client.messages_received
+            for clients in self.rooms.values()
+            for client in clients
+        )
+
+        # Disconnect everyone, which flushes and closes every room
+        queries_before = self.queries.count
+        for clients in self.rooms.values():
+            for client in clients:
+                await client.disconnect()
+        phases["disconnect"] = (
+            options.rooms * options.clients,
+            self.queries.count - queries_before,
+        )
+
+        return {
+            "config": {
+                key: value
+                for key, value in vars(options).items()
+                if key not in ("output", "baseline", "tolerance")
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "batching": self.batching_enabled(),
+            },
+            "latency_ms": {
+                "update_fanout": summarize(self.update_latencies),
+                "title_fanout": summarize(self.title_latencies),
+                "save_ack": summarize(self.save_latencies),
+            },
+            "queries": {
+                name: {
+                    "operations": operations,
+                    "queries": queries,
+                    "per_operation": (
+                        round(queries / operations, 3) if operations else None
+                    ),
+                }
+                for name, (operations, queries) in phases.items()
+            },
+            "memory": {
+                "rss_per_room_loaded_bytes": (rss_loaded - rss_before) // options.rooms,
+                "rss_per_room_edited_bytes": (rss_edited - rss_before) // options.rooms,
+                "state_per_room_bytes": (
+                    sum(state_sizes) // len(state_sizes) if state_sizes else 0
+                ),
+            },
+            "throughput": {
+                "duration_s": round(duration, 3),
+                "messages_sent": messages_sent,
+                "messages_received": messages_received,
+                "messages_per_second": round(
+                    (messages_sent + messages_received) / duration, 1
+                ),
+            },
+        }
+
+    def _resident_rooms(self):
+        from documents.rooms import get_room_name, room_registry
+
+        for document_id in self.rooms:
+            room = room_registry.get(get_room_name(document_id))
+            if room is not None:
+                yield room
+
+    @staticmethod
+    def batching_enabled() -> bool:
+        from django.conf import settings
+
+        return settings.DOCUMENT_UPDATE_BATCHING_ENABLED
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    List the metrics that regressed by more than the tolerance
+    """
+
+    regressions = []
+    for path, higher_is_better in REGRESSION_METRICS.items():
+        current, previous = results, baseline
+        for key in path:
+            current = (current or {}).get(key)
+            previous = (previous or {}).get(key)
+        if current is None or not previous:
+            continue
+
+        change = (current - previous) / previous
+        if (higher_is_better and change < -tolerance) or (
+            not higher_is_better and change > tolerance
+        ):
+            regressions.append(
+                f"{'.'.join(path)}: {previous} -> {current} ({change:+.0%})"
+            )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=10, help="Number of documents")
+    parser.add_argument("--clients", type=int, default=5, help="Clients per room")
+    parser.add_argument("--edits", type=int, default=100, help="Edits per room")
+    parser.add_argument(
+        "--title-every", type=int, default=25, help="Send a TITLE_UPDATE every N edits"
+    )
+    parser.add_argument(
+        "--save-every", type=int, default=50, help="Send a SAVE every N edits"
+    )
+    parser.add_argument(
+        "--batching",
+        choices=["on", "off"],
+        help="Override DOCUMENT_UPDATE_BATCHING_ENABLED",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default="benchmark-results.json", help="Where to write results"
+    )
+    parser.add_argument("--baseline", help="Results file to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed relative regression against the baseline",
+    )
+    options = parser.parse_args(argv)
+    if options.clients < 2:
+        parser.error("--clients must be at least 2 to measure fan-out")
+    return options
+
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    import django
+
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+
+    if options.batching is not None:
+        settings.DOCUMENT_UPDATE_BATCHING_ENABLED = options.batching == "on"
+
+    # Create and migrate a throwaway database
+    database_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        results = asyncio.run(ConsumerBenchmark(options).run())
+    finally:
+        connection.creation.destroy_test_db(database_name, verbosity=0)
+
+    with open(options.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    print(json.dumps(results, indent=2))
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), options.tolerance)
+        if regressions:
+            print("Regressions against baseline:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+"""
+Settings for running benchmarks without Postgres or Redis.
+"""
+
+from minidoc_api.settings import *  # noqa: F401, F403
+from minidoc_api.settings import LOGGING
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    }
+}
+
+# SQLite only allows one writer at a time
+DOCUMENT_DB_MAX_CONCURRENCY = 1
+
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {
+            "capacity": 10000,
+        },
+    }
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "documents": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "documents",
+    },
+}
+
+# Per-message debug logging would dominate the timings
+LOGGING["loggers"]["django.channels"]["level"] = "WARNING"
+LOGGING["loggers"]["django"]["level"] = "WARNING"
@@ -0,0 +1,71 @@
+"""
+Archive format used by the export_documents and import_documents commands.
+
+An archive is `ARCHIVE_MAGIC` and a format version byte, followed by one
+record per document: a 4-byte big-endian length and the document's metadata
+as JSON, then a 4-byte big-endian length and the document's full state as a
+raw Yjs update. Records are written and read one at a time, so archives of
+any size can be streamed through constant memory.
+"""
+
+import json
+import struct
+from datetime import datetime
+from typing import BinaryIO, Dict, Iterator, Tuple
+
+ARCHIVE_MAGIC = b"MINIDOC"
+ARCHIVE_VERSION = 1
+
+LENGTH = struct.Struct(">I")
+
+
+class ArchiveError(ValueError):
+    """
+    Raised when an archive can't be read
+    """
+
+
+class ArchiveWriter:
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.stream.write(ARCHIVE_MAGIC + bytes([ARCHIVE_VERSION]))
+
+    def write(self, metadata: Dict, content: bytes):
+        encoded = json.dumps(metadata, default=_encode_value).encode()
+        self.stream.write(LENGTH.pack(len(encoded)))
+        self.stream.write(encoded)
+        self.stream.write(LENGTH.pack(len(content)))
+        self.stream.write(content)
+
+
+class ArchiveReader:
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        header = self.stream.read(len(ARCHIVE_MAGIC) + 1)
+        if header[: len(ARCHIVE_MAGIC)] != ARCHIVE_MAGIC:
+            raise ArchiveError("Not a document archive")
+        if header[-1] != ARCHIVE_VERSION:
+            raise ArchiveError(f"Unsupported archive version {header[-1]}")
+
+    def _read(self, size: int) -> bytes:
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise ArchiveError("Archive is truncated")
+        return data
+
+    def __iter__(self) -> Iterator[Tuple[Dict, bytes]]:
+        while True:
+            prefix = self.stream.read(LENGTH.size)
+            if not prefix:
+                return
+            if len(prefix) != LENGTH.size:
+                raise ArchiveError("Archive is truncated")
+            metadata = json.loads(self._read(LENGTH.unpack(prefix)[0]))
+            (size,) = LENGTH.unpack(self._read(LENGTH.size))
+            yield metadata, self._read(size)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
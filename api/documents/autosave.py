@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from channels.layers import get_channel_layer
+
+from django.conf import settings
+
+from .control import make_broadcast
+from .crdt import crdt_executor
+from .db import run_db
+from .metrics import group_send, save_bytes, save_seconds
+from .persistence import append_updates, compact_document
+from .rooms import Room
+
+logger = logging.getLogger("django.channels")
+
+
+class WriteBehind:
+    """
+    Write-behind persistence for rooms held by this process.
+
+    Modified rooms are marked dirty and each one is due for saving once it
+    hasn't changed for `DOCUMENT_AUTOSAVE_IDLE_SECONDS` (or at most
+    `DOCUMENT_AUTOSAVE_MAX_DELAY_SECONDS` after its first unsaved change), so
+    a busy room never holds back the others. Rooms asked to save are due after
+    `DOCUMENT_AUTOSAVE_SAVE_DELAY_SECONDS`. Rooms that are due together are
+    flushed together, in one transaction, and retried one by one if it fails.
+    """
+
+    def __init__(self):
+        self._dirty: Dict[str, Room] = {}
+        self._save_requested: Set[str] = set()
+        # When each dirty room first changed and when it is due for saving
+        self._first_dirty_at: Dict[str, float] = {}
+        self._due_at: Dict[str, float] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at: Optional[float] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._compactions: Dict[str, asyncio.Task] = {}
+
+    def mark_dirty(self, room: Room):
+        """
+        Queue a room for saving and push its save back by one idle window,
+        bounded by the maximum delay
+        """
+
+        self._dirty[room.name] = room
+
+        now = asyncio.get_running_loop().time()
+        first_dirty_at = self._first_dirty_at.setdefault(room.name, now)
+        deadline = first_dirty_at + settings.DOCUMENT_AUTOSAVE_MAX_DELAY_SECONDS
+        if room.name in self._save_requested:
+            # Further edits don't delay a requested save
+            due_at = min(
+                now + settings.DOCUMENT_AUTOSAVE_SAVE_DELAY_SECONDS,
+                self._due_at.get(room.name, deadline),
+            )
+        else:
+            due_at = now + settings.DOCUMENT_AUTOSAVE_IDLE_SECONDS
+        self._due_at[room.name] = min(due_at, deadline)
+        self._schedule(self._due_at[room.name])
+
+    def _schedule(self, when: float):
+        """
+        Wake up at the given loop time, unless already due to wake up sooner.
+        Timers are never pushed back; a room whose save was delayed since is
+        just rescheduled when the timer fires.
+        """
+
+        if self._timer is not None and self._timer_at <= when:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_at = when
+        self._timer = asyncio.get_running_loop().call_at(when, self._start_flush)
+
+    def update_title(self, room: Room):
+        """
+        Persist the room's latest title with the next flush. Titles change on
+        every keystroke, so only the last one set within the idle window is
+        written.
+        """
+
+        self.mark_dirty(room)
+
+    def request_save(self, room: Room):
+        """
+        Ask for the room to be saved with the next flush. Clients are notified
+        with a SAVE broadcast once the flush completes.
+        """
+
+        self._save_requested.add(room.name)
+        self.mark_dirty(room)
+
+    def _start_flush(self):
+        self._timer = None
+        self._timer_at = None
+
+        now = asyncio.get_running_loop().time()
+        due = [
+            self._dirty[name]
+            for name, due_at in self._due_at.items()
+            if due_at <= now and name in self._dirty
+        ]
+        if due:
+            asyncio.ensure_future(self.flush(due))
+        # The flush clears the due rooms' deadlines once it starts
+        later = [
+            due_at
+            for name, due_at in self._due_at.items()
+            if due_at > now and name in self._dirty
+        ]
+        if later:
+            self._schedule(min(later))
+
+    async def flush(self, rooms: Optional[Iterable[Room]] = None):
+        """
+        Persist the pending updates of the given rooms, or of every dirty room
+        """
+
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            failed = await self._flush(rooms)
+
+        # Retry the rooms of a failed batch one by one, so one document's bad
+        # data doesn't keep the others from being saved
+        if len(failed) > 1:
+            for room in failed:
+                await self.flush([room])
+
+    async def _flush(self, rooms: Optional[Iterable[Room]]) -> List[Room]:
+        """
+        Persist the pending updates of the given rooms in one transaction.
+        Returns the rooms, marked dirty again, if it failed.
+        """
+
+        if rooms is None:
+            rooms = list(self._dirty.values())
+        rooms = [room for room in rooms if self._dirty.pop(room.name, None)]
+        for room in rooms:
+            self._first_dirty_at.pop(room.name, None)
+            self._due_at.pop(room.name, None)
+        if not rooms:
+            return []
+
+        batch = {}
+        texts = {}
+        titles = {}
+        editors = {}
+        state_vectors = {}
+        for room in rooms:
+            if room.last_editor_id is not None:
+                editors[room.document_id] = room.last_editor_id
+            if room.pending_title is not None:
+                titles[room.document_id] = room.pending_title
+            # Rooms owned by another worker are persisted by that worker
+            if room.state_modified and room.owned:
+                update, state_vector = room.take_unsaved_changes()
+                batch[room.document_id] = [update]
+                state_vectors[room.name] = state_vector
+                text = room.text.get_text()
+                if text != room.saved_text:
+                    texts[room.document_id] = text
+
+        started = time.perf_counter()
+        try:
+            # Fold the changes into the saved states to write them through
+            # to the state cache, off the event loop for large documents
+            tracked = [
+                room
+                for room in rooms
+                if room.name in state_vectors and room.saved_state is not None
+            ]
+            merged = await asyncio.gather(
+                *(
+                    crdt_executor.merge([room.saved_state, *batch[room.document_id]])
+                    for room in tracked
+                )
+            )
+            states = {
+                room.document_id: (
+                    state,
+                    state_vectors[room.name],
+                    room.saved_log_id,
+                )
+                for room, state in zip(tracked, merged)
+            }
+            if batch or titles:
+                save_bytes.observe(sum(len(updates[0]) for updates in batch.values()))
+                with save_seconds.time():
+                    needs_compaction, missing, log_ids = await run_db(
+                        append_updates, batch, texts, titles, editors, states
+                    )
+            else:
+                needs_compaction, missing, log_ids = set(), set(), {}
+        except Exception:
+            logger.exception("Failed to flush dirty documents")
+            for room in rooms:
+                if room.name in state_vectors:
+                    room.mark_unsaved()
+                self.mark_dirty(room)
+            return rooms
+
+        for room in rooms:
+            if room.name in state_vectors:
+                state, _, _ = states.get(room.document_id, (None, None, None))
+                room.mark_saved(
+                    state_vectors[room.name], state, log_ids.get(room.document_id)
+                )
+            if room.document_id in texts:
+                room.saved_text = texts[room.document_id]
+            # A newer title may have been set while the flush was running
+            if room.pending_title == titles.get(room.document_id):
+                room.pending_title = None
+
+        logger.debug(
+            f"Flushed {len(batch)} documents and {len(titles)} titles in "
+            f"{time.perf_counter() - started:.3f}s"
+        )
+
+        channel_layer = get_channel_layer()
+        for room in rooms:
+            if room.document_id in missing:
+                logger.error(f"Document {room.document_id} not found")
+                await group_send(
+                    channel_layer,
+                    room.name,
+                    make_broadcast("broadcast_error", {"error": "Document not found"}),
+                )
+            elif room.name in self._save_requested:
+                await group_send(
+                    channel_layer,
+                    room.name,
+                    make_broadcast("broadcast_save", {"eventType": "SAVE"}),
+                )
+            self._save_requested.discard(room.name)
+
+            if room.document_id in needs_compaction:
+                self.schedule_compaction(room.document_id)
+        return []
+
+    def schedule_compaction(self, document_id: str):
+        """
+        Merge the document's update log into its snapshot in the background
+        """
+
+        task = self._compactions.get(document_id)
+        if task is not None and not task.done():
+            return
+
+        async def compact():
+            try:
+                await run_db(compact_document, document_id)
+            except Exception:
+                logger.exception(f"Failed to compact document {document_id}")
+            finally:
+                self._compactions.pop(document_id, None)
+
+        self._compactions[document_id] = asyncio.ensure_future(compact())
+
+
+write_behind = WriteBehind()
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from typing import Optional
+
+import y_py as Y
+from channels.layers import get_channel_layer
+from ypy_websocket.yutils import (
+    YMessageType,
+    YSyncMessageType,
+    create_update_message,
+    read_message,
+)
+
+from django.conf import settings
+
+from .metrics import group_send
+
+logger = logging.getLogger("django.channels")
+
+# Update emitted by Y.YDoc for transactions that did not change anything
+EMPTY_UPDATE = b"\x00\x00"
+
+
+def is_sync_update(message: Optional[bytes]) -> bool:
+    return (
+        message is not None
+        and len(message) > 2
+        and message[0] == YMessageType.SYNC
+        and message[1] == YSyncMessageType.SYNC_UPDATE
+    )
+
+
+def get_message_type(message: bytes) -> str:
+    """
+    Name the kind of a binary Yjs message, e.g. for metrics
+    """
+
+    if len(message) > 1 and message[0] == YMessageType.SYNC:
+        return {
+            YSyncMessageType.SYNC_STEP1: "sync_step1",
+            YSyncMessageType.SYNC_STEP2: "sync_step2",
+            YSyncMessageType.SYNC_UPDATE: "sync_update",
+        }.get(message[1], "sync_unknown")
+    if len(message) > 0 and message[0] == YMessageType.AWARENESS:
+        return "awareness"
+    return "unknown"
+
+
+class UpdateBatcher:
+    """
+    Merge the Yjs updates a room receives within a short window into a single
+    update before fanning it out to the room's group.
+
+    Updates are applied to the room's YDoc as they arrive, so the combined
+    update is simply the document's diff against its state vector from before
+    the first update of the batch. A batch is sent once it is
+    `DOCUMENT_UPDATE_BATCH_MAX_LATENCY_MS` old or holds
+    `DOCUMENT_UPDATE_BATCH_MAX_SIZE` updates, whichever comes first.
+    """
+
+    def __init__(self, room_name: str, ydoc: Y.YDoc):
+        self.room_name = room_name
+        self.ydoc = ydoc
+        self._state_vector: Optional[bytes] = None
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def pending(self) -> int:
+        return self._size
+
+    async def add(self, message: bytes):
+        """
+        Apply a SYNC_UPDATE message to the document and queue it for broadcast
+        """
+
+        update = read_message(message[2:])
+        if update == EMPTY_UPDATE:
+            return
+
+        if self._state_vector is None:
+            self._state_vector = Y.encode_state_vector(self.ydoc)
+            self._timer = asyncio.get_running_loop().call_later(
+                settings.DOCUMENT_UPDATE_BATCH_MAX_LATENCY_MS / 1000,
+                lambda: asyncio.ensure_future(self.flush()),
+            )
+
+        Y.apply_update(self.ydoc, update)
+        self._size += 1
+
+        if self._size >= settings.DOCUMENT_UPDATE_BATCH_MAX_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        """
+        Broadcast everything queued so far as one combined update
+        """
+
+        if self._state_vector is None:
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        state_vector, self._state_vector = self._state_vector, None
+        size, self._size = self._size, 0
+
+        update = Y.encode_state_as_update(self.ydoc, state_vector)
+        if update == EMPTY_UPDATE:
+            return
+
+        logger.debug(f"Broadcasting {size} merged updates to {self.room_name}")
+        await group_send(
+            get_channel_layer(),
+            self.room_name,
+            {"type": "send_message", "message": create_update_message(update)},
+        )
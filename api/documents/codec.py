@@ -0,0 +1,66 @@
+"""
+Versioned storage codec for CRDT snapshots.
+
+Encoded values start with `MAGIC` followed by a codec version byte. Values
+without the header are raw Yjs updates, which is how rows written before the
+codec existed are stored, and how values too small to benefit from
+compression are still written. Raw updates that happen to start with `MAGIC`
+are always written with the `CODEC_RAW` header, so they can't be mistaken for
+encoded values.
+"""
+
+import logging
+import zlib
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"\xffMD"
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+
+
+def is_encoded(value: bytes) -> bool:
+    return value[: len(MAGIC)] == MAGIC and len(value) > len(MAGIC)
+
+
+def encode_content(value: bytes) -> bytes:
+    """
+    Compress a raw snapshot for storage if it is large enough to be worth it
+    """
+
+    if len(value) >= settings.DOCUMENT_CONTENT_COMPRESSION_MIN_BYTES:
+        compressed = zlib.compress(value, settings.DOCUMENT_CONTENT_COMPRESSION_LEVEL)
+        if len(compressed) + len(MAGIC) + 1 < len(value):
+            return MAGIC + bytes([CODEC_ZLIB]) + compressed
+
+    if value[: len(MAGIC)] == MAGIC:
+        return MAGIC + bytes([CODEC_RAW]) + value
+    return value
+
+
+def decode_content(value: bytes) -> bytes:
+    """
+    Return the raw Yjs update for a stored value, whichever codec wrote it
+    """
+
+    if not is_encoded(value):
+        return value
+
+    version = value[len(MAGIC)]
+    payload = value[len(MAGIC) + 1 :]  # noqa: E203
+    if version == CODEC_ZLIB:
+        try:
+            return zlib.decompress(payload)
+        except zlib.error:
+            # A legacy raw update that happens to start with the header
+            logger.warning("Failed to decompress stored content; reading it as raw")
+            return value
+    if version == CODEC_RAW:
+        return payload
+
+    # Unknown versions are most likely raw updates that happen to start with
+    # the header rather than values written by a newer codec
+    return value
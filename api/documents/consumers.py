@@ -1,25 +1,71 @@
 import json
 import logging
-import re
+from typing import Optional
 
 import y_py as Y
-from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 from ypy_websocket.django_channels_consumer import YjsConsumer
+from ypy_websocket.yutils import (
+    YMessageType,
+    YSyncMessageType,
+    create_update_message,
+    read_message,
+)
 
 from django.apps import apps
+from django.conf import settings
+
+from .autosave import write_behind
+from .broadcast import EMPTY_UPDATE, get_message_type, is_sync_update
+from .control import (
+    JSON,
+    InvalidControlFrame,
+    broadcast_frame,
+    decode_control_frame,
+    encode_event,
+    get_control_format,
+    is_control_frame,
+    make_broadcast,
+)
+from .crdt import crdt_executor
+from .db import run_db
+from .lifecycle import room_lifecycle
+from .metrics import (
+    group_send,
+    messages_received,
+    phase,
+    room_load_seconds,
+    trace_message,
+    websocket_bytes_received,
+    websocket_bytes_sent,
+)
+from .outbound import OutboundQueue
+from .ownership import room_ownership
+from .persistence import load_room_state
+from .presence import QUERY_AWARENESS, InvalidAwarenessUpdate
+from .rooms import Room, get_room_name, room_registry
+from .state_cache import state_cache
+from .viewers import ViewerHub, viewer_hubs
 
 logger = logging.getLogger("django.channels")
 
+# Close code telling a client that fell too far behind to reconnect and resync
+RESYNC_CLOSE_CODE = 4000
+
 
 class DocumentConsumer(YjsConsumer):
     Document = None
 
-    initial_state: bytes
-    state_modified: bool
+    room: Optional[Room]
+    outbound: Optional[OutboundQueue]
+    client_state_vector: Optional[bytes]
+    control_format: str
 
     def __init__(self, *args, **kwargs):
-        self.initial_state = b""
-        self.state_modified = False
+        self.room = None
+        self.outbound = None
+        self.client_state_vector = None
+        self.control_format = JSON
         super().__init__(*args, **kwargs)
 
     @classmethod
@@ -39,140 +85,445 @@ class DocumentConsumer(YjsConsumer):
 
         return self.scope["url_route"]["kwargs"]["document_id"]
 
+    def get_user_id(self) -> Optional[int]:
+        """
+        ID of the connected user, if authenticated
+        """
+
+        user = self.scope.get("user")
+        return user.pk if user is not None and user.is_authenticated else None
+
     def make_room_name(self):
         """
         Sanitize the room name to avoid TypeError
         """
 
-        room_name = self.get_document_id()
-        return re.sub(r"[^a-zA-Z0-9]", "_", room_name)
+        return get_room_name(self.get_document_id())
 
     async def make_ydoc(self):
+        """
+        Join the room for this document, loading it from the database if it
+        isn't resident in this process
+        """
+
+        room_lifecycle.start()
+        source = "memory" if self.room_name in room_registry else "database"
+        with room_load_seconds.time(source=source):
+            self.room = await room_registry.acquire(
+                self.room_name, self.load_room, refresh=self.refresh_room
+            )
+        await room_lifecycle.enforce_budget()
+        return self.room.ydoc
+
+    async def load_room(self) -> Room:
         """
         Create a Y.Doc instance and load the document content from the database
         """
 
         doc = Y.YDoc()
 
-        # Fetch the document or create a new one
-        Document = self.get_document_model()
-        db_document, created = await sync_to_async(Document.objects.get_or_create)(
-            id=self.get_document_id(),
-            defaults={
-                "title": "Untitled Document",
-                "content": b"",  # Use default binary content
-            },
+        # Fetch the document or create a new one, along with its update log
+        db_document, updates, log_id = await run_db(
+            load_room_state, self.get_document_id()
         )
 
         # TODO: When collaboration permissions are implemented, set owner of new documents
         # if created:
         #     db_document.owner = self.scope["user"]
 
-        # Initialize the document with the content from the database.
-        # This comparison avoids unnecessarily initializing the document with an empty state.
-        content = db_document.content
-        if content != b"":
-            Y.apply_update(doc, content)
-            self.initial_state = content
+        # Replay the snapshot followed by the update log, merged off the event
+        # loop for large documents
+        state = await crdt_executor.merge(updates)
+        Y.apply_update(doc, state)
 
-        doc.observe_after_transaction(self.on_update_event)
-        return doc
+        room = Room(
+            self.room_name,
+            self.get_document_id(),
+            doc,
+            on_change=write_behind.mark_dirty,
+            saved_state=state if state_cache.enabled else None,
+            saved_log_id=log_id,
+        )
+        room.saved_text = db_document.readable_content
+        room.title = db_document.title
+        if room_ownership.enabled:
+            await room_ownership.register(room)
+        return room
 
-    def on_update_event(self, event):
-        # Set the state_modified flag to True when the document is modified
-        self.state_modified = True
+    async def refresh_room(self, room: Room):
+        """
+        Catch an idle room up with changes saved by other workers
+        """
+
+        db_document, updates, log_id = await run_db(
+            load_room_state, self.get_document_id()
+        )
+        room.catch_up(await crdt_executor.merge(updates), log_id)
+        room.saved_text = db_document.readable_content
+        room.title = db_document.title
+        if room_ownership.enabled and not room.owned:
+            await room_ownership.register(room)
+
+    async def connect(self):
+        self.control_format = get_control_format(self.scope)
+        self.outbound = OutboundQueue(self.send)
+        self.outbound.start()
+        await super().connect()
+        self.enqueue_presence()
 
     async def receive(self, text_data=None, bytes_data=None):
-        # Handle custom events
+        websocket_bytes_received.inc(len(text_data or bytes_data or b""))
+
         if text_data:
-            try:
-                data = json.loads(text_data)
-                event_type = data.get("eventType")
-
-                if event_type == "TITLE_UPDATE":
-                    # Clean up the title
-                    title = data.get("title", "Untitled Document").strip()
-                    await self.update_document_title(title)
-                    await self.channel_layer.group_send(
-                        self.room_name,
-                        {
-                            "type": "broadcast_title_update",
-                            "eventType": "TITLE_UPDATE",
-                            "title": title,
-                        },
-                    )
-                elif event_type == "SAVE":
-                    await self.save_changes_to_document()
-                    await self.channel_layer.group_send(
-                        self.room_name,
-                        {
-                            "type": "broadcast_save",
-                            "eventType": "SAVE",
-                        },
-                    )
-                else:
-                    await self.send(json.dumps({"error": "Invalid event type"}))
-            except json.JSONDecodeError:
-                await self.send(json.dumps({"error": "Invalid JSON data"}))
+            with trace_message("event", room=self.room_name):
+                await self.receive_event(text_data)
+            return
+
+        if is_control_frame(bytes_data):
+            with trace_message("event", room=self.room_name):
+                await self.receive_control_frame(bytes_data)
+            return
+
+        if bytes_data is not None:
+            message_type = get_message_type(bytes_data)
+            messages_received.inc(type=message_type)
+            with trace_message(message_type, room=self.room_name):
+                await self.receive_yjs_message(bytes_data)
+
+    async def receive_event(self, text_data):
+        """
+        Handle custom events sent as JSON
+        """
+
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            messages_received.inc(type="invalid")
+            await self.send_event({"error": "Invalid JSON data"})
+            return
+        await self.handle_event(data)
+
+    async def receive_control_frame(self, bytes_data):
+        """
+        Handle custom events sent as binary control frames
+        """
+
+        try:
+            data = decode_control_frame(bytes_data)
+        except InvalidControlFrame:
+            messages_received.inc(type="invalid")
+            await self.send_event({"error": "Invalid control frame"})
+            return
+        await self.handle_event(data)
+
+    async def handle_event(self, data):
+        event_type = data.get("eventType") if isinstance(data, dict) else None
+
+        if event_type == "TITLE_UPDATE":
+            messages_received.inc(type=event_type)
+            # Clean up the title, cut to what the database column holds
+            max_length = self.get_document_model()._meta.get_field("title").max_length
+            title = str(data.get("title", "Untitled Document")).strip()[:max_length]
+            if not self.room.set_title(title):
                 return
+            self.room.last_editor_id = self.get_user_id()
+            # Broadcast right away, but leave persisting the title to
+            # the write-behind stage so typing doesn't hit the database
+            write_behind.update_title(self.room)
+            await group_send(
+                self.channel_layer,
+                self.room_name,
+                make_broadcast(
+                    "broadcast_title_update",
+                    {"eventType": "TITLE_UPDATE", "title": title},
+                ),
+            )
+        elif event_type == "SAVE":
+            messages_received.inc(type=event_type)
+            # Saves are coalesced by the write-behind stage, which
+            # broadcasts the SAVE event once the document is flushed
+            write_behind.request_save(self.room)
+        else:
+            messages_received.inc(type="invalid")
+            await self.send_event({"error": "Invalid event type"})
+
+    async def send_event(self, event):
+        """
+        Send a control event straight to the client, in the format it uses
+        """
+
+        await self.send(**encode_event(event, self.control_format))
+
+    async def receive_yjs_message(self, bytes_data):
+        if bytes_data[:1] == bytes([YMessageType.AWARENESS]):
+            await self.receive_awareness(bytes_data)
+            return
+        if bytes_data[:1] == bytes([QUERY_AWARENESS]):
+            self.enqueue_presence()
             return
 
-        # Let YjsConsumer handle bytes_data
-        return await super().receive(text_data, bytes_data)
+        # Remember what the client reported having, for catching it up later
+        if (
+            len(bytes_data) > 2
+            and bytes_data[0] == YMessageType.SYNC
+            and bytes_data[1] == YSyncMessageType.SYNC_STEP1
+        ):
+            self.client_state_vector = read_message(bytes_data[2:])
 
-    async def disconnect(self, code):
-        # Only save to database if the document has been modified
-        if self.state_modified and self.initial_state != Y.encode_state_as_update(
-            self.ydoc
+        if is_sync_update(bytes_data):
+            self.room.last_editor_id = self.get_user_id()
+
+        # Document updates are merged per room before being broadcast
+        if settings.DOCUMENT_UPDATE_BATCHING_ENABLED and is_sync_update(bytes_data):
+            with phase("batch"):
+                await self.room.batcher.add(bytes_data)
+        else:
+            # Let YjsConsumer handle bytes_data
+            with phase("sync"):
+                await super().receive(bytes_data=bytes_data)
+
+        # Another worker persists this room, so hand it the client's changes
+        if (
+            room_ownership.enabled
+            and not self.room.owned
+            and len(bytes_data) > 2
+            and bytes_data[0] == YMessageType.SYNC
+            and bytes_data[1]
+            in (YSyncMessageType.SYNC_STEP2, YSyncMessageType.SYNC_UPDATE)
         ):
-            await self.save_changes_to_document()
+            update = read_message(bytes_data[2:])
+            if update != EMPTY_UPDATE:
+                with phase("forward"):
+                    await room_ownership.forward(self.room, update)
+
+    async def receive_awareness(self, bytes_data):
+        """
+        Record the client's presence. Peers get it with the room's next merged
+        presence broadcast rather than straight away.
+        """
+
+        try:
+            with phase("presence"):
+                self.room.presence.receive(self.channel_name, bytes_data)
+        except InvalidAwarenessUpdate:
+            await self.send_event({"error": "Invalid awareness update"})
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        websocket_bytes_sent.inc(len(text_data or bytes_data or b""))
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def group_send_message(self, message: bytes):
+        await group_send(
+            self.channel_layer,
+            self.room_name,
+            {"type": "send_message", "message": message},
+        )
+
+    async def disconnect(self, code):
+        if self.room is not None:
+            self.room.presence.disconnect(self.channel_name)
+            # Flush unsaved changes when the last local consumer leaves
+            await room_registry.release(self.room_name, on_empty=self.close_room)
+            self.room = None
+            await room_lifecycle.enforce_budget()
+        if self.outbound is not None:
+            self.outbound.stop()
         await super().disconnect(code)
 
-    async def broadcast_title_update(self, event):
-        await self.send(
-            json.dumps(
-                {
-                    "eventType": event["eventType"],
-                    "title": event["title"],
-                }
+    async def close_room(self, room: Room):
+        """
+        Send and persist everything still pending before the room goes idle
+        """
+
+        await room.batcher.flush()
+        await self.save_changes_to_document()
+        if room_ownership.enabled:
+            # Let a worker that still has clients in the room take it over
+            await room_ownership.release(room)
+
+    def enqueue(self, text_data=None, bytes_data=None):
+        """
+        Queue a frame for the client, unless it was told to resync and is
+        about to be disconnected
+        """
+
+        if self.outbound is not None:
+            self.outbound.put(text_data=text_data, bytes_data=bytes_data)
+
+    async def send_message(self, message_wrapper):
+        self.enqueue(bytes_data=message_wrapper["message"])
+        if self.outbound is not None and self.outbound.is_over_limit():
+            await self.catch_up_slow_client()
+
+    async def catch_up_slow_client(self):
+        """
+        Replace the Yjs frames a slow client has not received yet with a single
+        diff against its last known state vector. If even that diff is too
+        large, disconnect the client so it resyncs from scratch.
+        """
+
+        pending = len(self.outbound)
+        # The dropped updates may not have reached this room's YDoc yet (e.g.
+        # when they came from another worker), so merge them in first
+        for update in self.outbound.drop_sync_messages():
+            if update != EMPTY_UPDATE:
+                Y.apply_update(self.ydoc, update)
+
+        state_vector = Y.encode_state_vector(self.ydoc)
+        if self.client_state_vector is None:
+            diff = Y.encode_state_as_update(self.ydoc)
+        else:
+            diff = Y.encode_state_as_update(self.ydoc, self.client_state_vector)
+
+        if len(diff) > settings.DOCUMENT_OUTBOUND_MAX_BYTES:
+            logger.warning(
+                f"Disconnecting slow client {self.channel_name} from "
+                f"{self.room_name}: {len(diff)} byte diff exceeds the outbound limit"
             )
+            self.outbound.stop()
+            self.outbound = None
+            await self.send_event({"error": "Too far behind; please resync"})
+            await self.close(code=RESYNC_CLOSE_CODE)
+            return
+
+        logger.info(
+            f"Collapsed {pending} pending frames for slow client "
+            f"{self.channel_name} in {self.room_name} into a {len(diff)} byte diff"
         )
 
-    async def broadcast_save(self, event):
-        await self.send(
-            json.dumps(
-                {
-                    "eventType": event["eventType"],
-                }
-            )
+        def on_sent():
+            self.client_state_vector = state_vector
+
+        self.outbound.put(bytes_data=create_update_message(diff), on_sent=on_sent)
+        # Pending presence changes were dropped as well
+        self.enqueue_presence()
+
+    async def apply_remote_update(self, event):
+        """
+        Apply an update that was made and persisted outside this room (e.g.
+        through the REST sync endpoint) and forward it to the client
+        """
+
+        self.enqueue(bytes_data=create_update_message(event["update"]))
+        await self.room.apply_persisted_update(event["update_id"], event["update"])
+
+    def enqueue_presence(self):
+        """
+        Queue the presence of everyone in the room
+        """
+
+        snapshot = self.room.presence.snapshot_message()
+        if snapshot is not None:
+            self.enqueue(bytes_data=snapshot)
+
+    def enqueue_broadcast(self, message):
+        """
+        Queue a broadcast control event, already encoded by its sender
+        """
+
+        self.enqueue(**broadcast_frame(message, self.control_format))
+
+    async def broadcast_title_update(self, message):
+        self.enqueue_broadcast(message)
+
+    async def broadcast_save(self, message):
+        self.enqueue_broadcast(message)
+
+    async def broadcast_error(self, message):
+        self.enqueue_broadcast(message)
+
+    async def broadcast_presence(self, message):
+        """
+        Forward a room's merged presence changes, taking note of those made
+        on other workers
+        """
+
+        self.room.presence.apply_remote(
+            message["origin"], message["sequence"], message["message"]
         )
+        self.enqueue(bytes_data=message["message"])
 
     async def save_changes_to_document(self):
         """
-        Save in-memory document state to the database.
+        Immediately flush the room's unsaved updates to the document's update log
         """
 
-        Document = self.get_document_model()
+        await write_behind.flush([self.room])
+
+
+class ViewerConsumer(AsyncWebsocketConsumer):
+    """
+    Read-only connection to a document, opened with `?mode=view`.
+
+    Viewers hold no document state of their own: they are served the cached
+    snapshot of the room's viewer hub when they sync and are then relayed
+    the frames the hub receives. Anything a viewer sends besides its sync
+    request is ignored.
+    """
+
+    hub: Optional[ViewerHub]
+    outbound: Optional[OutboundQueue]
+    control_format: str
+
+    def __init__(self, *args, **kwargs):
+        self.hub = None
+        self.outbound = None
+        self.control_format = JSON
+        super().__init__(*args, **kwargs)
+
+    async def connect(self):
+        self.control_format = get_control_format(self.scope)
+        document_id = self.scope["url_route"]["kwargs"]["document_id"]
+        self.room_name = get_room_name(document_id)
         try:
-            document = await sync_to_async(Document.objects.get)(
-                id=self.get_document_id()
+            self.hub = await viewer_hubs.join(self.room_name, document_id, self)
+        except DocumentConsumer.get_document_model().DoesNotExist:
+            await self.close()
+            return
+
+        self.outbound = OutboundQueue(self.send)
+        await self.accept()
+        self.outbound.start()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.outbound is None:
+            return
+        if text_data or is_control_frame(bytes_data):
+            self.outbound.put(
+                **encode_event({"error": "Document is read-only"}, self.control_format)
             )
-            document.content = Y.encode_state_as_update(self.ydoc)
-            # TODO: Extract readable text from YDoc
-            # readable_content = self.ydoc.get_text('content').__str__()
-            # document.readable_content = readable_content
-            await sync_to_async(document.save)()
-        except Document.DoesNotExist:
-            error_message = "Document not found"
-            logger.error(error_message)
-            await self.send(json.dumps({"error": error_message}))
+        elif (
+            bytes_data is not None
+            and len(bytes_data) > 1
+            and bytes_data[0] == YMessageType.SYNC
+            and bytes_data[1] == YSyncMessageType.SYNC_STEP1
+        ):
+            self.outbound.put(bytes_data=self.hub.snapshot_frame())
 
-    async def update_document_title(self, title: str):
+    def deliver(self, text_data=None, bytes_data=None):
         """
-        Update the title of the document in the database
+        Queue a frame relayed by the hub
         """
 
-        Document = self.get_document_model()
-        document = await sync_to_async(Document.objects.get)(id=self.get_document_id())
-        document.title = title
-        await sync_to_async(document.save)()
+        if self.outbound is None:
+            return
+        self.outbound.put(text_data=text_data, bytes_data=bytes_data)
+        if self.outbound.is_over_limit():
+            # The snapshot already contains every update the viewer is missing
+            self.outbound.drop_sync_messages()
+            self.outbound.put(bytes_data=self.hub.snapshot_frame())
+
+    def deliver_broadcast(self, message):
+        """
+        Queue a broadcast control event relayed by the hub
+        """
+
+        self.deliver(**broadcast_frame(message, self.control_format))
+
+    async def disconnect(self, code):
+        if self.hub is not None:
+            await viewer_hubs.leave(self.room_name, self)
+            self.hub = None
+        if self.outbound is not None:
+            self.outbound.stop()
+            self.outbound = None
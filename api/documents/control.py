@@ -0,0 +1,90 @@
+"""
+Encoding of control events (titles, saves, errors) sent over the document
+WebSocket.
+
+Clients connecting with `?control=msgpack` exchange control events as binary
+frames: a `CONTROL_MESSAGE_TYPE` header byte followed by the msgpack-encoded
+event, alongside the Yjs frames on the same socket. Other clients keep using
+JSON text frames. Broadcasts carry the event encoded both ways, so each is
+encoded once by its sender rather than once per recipient.
+"""
+
+import json
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+import msgpack
+
+# Leading byte of binary control frames, outside the range of Yjs message types
+CONTROL_MESSAGE_TYPE = 0x7F
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+
+class InvalidControlFrame(ValueError):
+    """
+    Raised when a binary control frame can't be decoded
+    """
+
+
+def get_control_format(scope) -> str:
+    """
+    The control event format a client asked for when connecting
+    """
+
+    query = parse_qs(scope.get("query_string", b"").decode())
+    return MSGPACK if query.get("control") == [MSGPACK] else JSON
+
+
+def is_control_frame(message: Optional[bytes]) -> bool:
+    return (
+        message is not None and len(message) > 0 and message[0] == CONTROL_MESSAGE_TYPE
+    )
+
+
+def encode_control_frame(event: Dict) -> bytes:
+    return bytes([CONTROL_MESSAGE_TYPE]) + msgpack.packb(event)
+
+
+def decode_control_frame(message: bytes) -> Dict:
+    try:
+        event = msgpack.unpackb(message[1:])
+    except Exception as exc:
+        raise InvalidControlFrame(str(exc)) from exc
+    if not isinstance(event, dict):
+        raise InvalidControlFrame("Control event must be a map")
+    return event
+
+
+def encode_event(event: Dict, control_format: str) -> Dict:
+    """
+    Encode an event as the `send` arguments for a client using the given format
+    """
+
+    if control_format == MSGPACK:
+        return {"bytes_data": encode_control_frame(event)}
+    return {"text_data": json.dumps(event)}
+
+
+def make_broadcast(handler: str, event: Dict) -> Dict:
+    """
+    Build a group message delivering an event to every client of a room, with
+    the event already encoded in both formats
+    """
+
+    return {
+        "type": handler,
+        JSON: json.dumps(event),
+        MSGPACK: encode_control_frame(event),
+    }
+
+
+def broadcast_frame(message: Dict, control_format: str) -> Dict:
+    """
+    Pick the pre-encoded frame of a broadcast for a client, as `send` arguments
+    """
+
+    if control_format == MSGPACK:
+        return {"bytes_data": message[MSGPACK]}
+    return {"text_data": message[JSON]}
@@ -0,0 +1,165 @@
+"""
+CRDT work on encoded updates, run off the event loop when it is large.
+
+A room's Y.YDoc is bound to the thread that created it, so it can only be
+touched from the event loop. Work on encoded updates (merging a document's
+snapshot and log, folding a save into its full state) can run anywhere, and
+for large documents it is handed to an executor so it doesn't stall every
+other socket on the worker. Updates smaller than
+`DOCUMENT_CRDT_OFFLOAD_MIN_BYTES` stay inline, where the hand-off would cost
+more than it saves.
+
+y-py holds the GIL while it works, so only the process pool actually frees
+the loop; the thread pool merely lets it run between calls.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import (
+    BrokenExecutor,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+import y_py as Y
+from ypy_websocket.yutils import Decoder, write_var_uint
+
+from django.conf import settings
+
+from .metrics import crdt_offloaded_seconds, crdt_seconds
+
+logger = logging.getLogger("django.channels")
+
+T = TypeVar("T")
+
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+
+
+def merge_updates(updates: List[bytes]) -> bytes:
+    """
+    Merge a sequence of Yjs updates into a single update
+    """
+
+    doc = Y.YDoc()
+    for update in updates:
+        Y.apply_update(doc, update)
+    return Y.encode_state_as_update(doc)
+
+
+def decode_state_vector(state_vector: bytes) -> Dict[int, int]:
+    """
+    Decode a Yjs state vector into the clock of each client
+    """
+
+    decoder = Decoder(state_vector)
+    clocks = {}
+    for _ in range(decoder.read_var_uint()):
+        client_id = decoder.read_var_uint()
+        clocks[client_id] = decoder.read_var_uint()
+    return clocks
+
+
+def encode_state_vector(clocks: Dict[int, int]) -> bytes:
+    parts = [write_var_uint(len(clocks))]
+    for client_id, clock in clocks.items():
+        parts += [write_var_uint(client_id), write_var_uint(clock)]
+    return b"".join(parts)
+
+
+def advance_state_vector(state_vector: bytes, before: bytes, after: bytes) -> bytes:
+    """
+    Advance a state vector by the clocks that moved from `before` to `after`,
+    leaving every other client as it was
+    """
+
+    clocks = decode_state_vector(state_vector)
+    previous = decode_state_vector(before)
+    for client_id, clock in decode_state_vector(after).items():
+        if clock != previous.get(client_id):
+            clocks[client_id] = max(clocks.get(client_id, 0), clock)
+    return encode_state_vector(clocks)
+
+
+def _timed(func: Callable[..., T], *args) -> Tuple[T, float]:
+    # Timed where the work runs, so queueing and pickling aren't counted
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+class CrdtExecutor:
+    def __init__(self):
+        self._executor: Optional[Executor] = None
+
+    @property
+    def mode(self) -> str:
+        return settings.DOCUMENT_CRDT_EXECUTOR
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.mode == PROCESS:
+                # Forking would copy the worker's threads and locks
+                self._executor = ProcessPoolExecutor(
+                    settings.DOCUMENT_CRDT_MAX_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    settings.DOCUMENT_CRDT_MAX_WORKERS, thread_name_prefix="crdt"
+                )
+        return self._executor
+
+    def should_offload(self, size: int) -> bool:
+        return self.mode != INLINE and size >= settings.DOCUMENT_CRDT_OFFLOAD_MIN_BYTES
+
+    async def run(self, func: Callable[..., T], *args, size: int) -> T:
+        """
+        Run a function of encoded updates, totalling `size` bytes, off the
+        event loop if they are large enough. The function must not touch any
+        Y.YDoc it is not creating itself, and must be picklable for the
+        process pool.
+        """
+
+        if not self.should_offload(size):
+            with crdt_seconds.time(mode="inline"):
+                return func(*args)
+
+        loop = asyncio.get_running_loop()
+        try:
+            result, seconds = await loop.run_in_executor(
+                self.executor, _timed, func, *args
+            )
+        except BrokenExecutor:
+            # A worker died; start a new pool for the next call
+            logger.exception(f"CRDT executor failed running {func.__name__}")
+            self._executor = None
+            with crdt_seconds.time(mode="inline"):
+                return func(*args)
+        crdt_seconds.observe(seconds, mode="offloaded")
+        crdt_offloaded_seconds.inc(seconds)
+        logger.debug(
+            f"Ran {func.__name__} on {size} bytes off the event loop "
+            f"in {seconds * 1000:.1f}ms"
+        )
+        return result
+
+    async def merge(self, updates: List[bytes]) -> bytes:
+        """
+        Merge encoded updates into one, off the event loop if they are large
+        """
+
+        if len(updates) == 1:
+            return updates[0]
+        return await self.run(
+            merge_updates, updates, size=sum(len(update) for update in updates)
+        )
+
+
+crdt_executor = CrdtExecutor()
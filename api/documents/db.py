@@ -0,0 +1,87 @@
+"""
+Database access for code running on the event loop.
+
+`sync_to_async` runs every call on a single shared thread, so one slow query
+holds up every other consumer. `run_db` runs calls on the thread pool
+instead, at most `DOCUMENT_DB_MAX_CONCURRENCY` at a time, and hands the
+connection back once the call completes. With the connection pool enabled
+in `DATABASES`, that means no call pays for opening a Postgres connection.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from channels.db import database_sync_to_async
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger("django.channels")
+
+T = TypeVar("T")
+
+
+class DatabaseExecutor:
+    def __init__(self):
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.calls = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(settings.DOCUMENT_DB_MAX_CONCURRENCY)
+        return self._semaphore
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Run a synchronous database function on the thread pool
+        """
+
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        waited = time.perf_counter() - started
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.calls += 1
+        self.in_flight += 1
+        try:
+            # Closes the connection afterwards, returning it to the pool
+            return await database_sync_to_async(func, thread_sensitive=False)(
+                *args, **kwargs
+            )
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "max_concurrency": settings.DOCUMENT_DB_MAX_CONCURRENCY,
+            "calls": self.calls,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+            "pool": None,
+        }
+        pool = getattr(connection, "pool", None)
+        if pool is not None:
+            stats["pool"] = pool.get_stats()
+        return stats
+
+
+db_executor = DatabaseExecutor()
+
+
+async def run_db(func: Callable[..., T], *args, **kwargs) -> T:
+    return await db_executor.run(func, *args, **kwargs)
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from .autosave import write_behind
+from .rooms import Room, RoomRegistry, room_registry
+
+logger = logging.getLogger("django.channels")
+
+
+class RoomLifecycle:
+    """
+    Keep the rooms resident in this process within a memory budget.
+
+    Rooms stay loaded after their last consumer leaves so that reconnecting
+    clients don't have to wait for the document to be rebuilt. Idle rooms are
+    flushed and evicted once they have been unused for
+    `DOCUMENT_ROOM_IDLE_SECONDS`, or least recently used first whenever the
+    resident rooms exceed `DOCUMENT_ROOM_MEMORY_BUDGET_BYTES`. Rooms with
+    connected clients are never evicted.
+    """
+
+    def __init__(self, registry: RoomRegistry):
+        self.registry = registry
+        self._task: Optional[asyncio.Task] = None
+        self._over_budget = False
+
+    def start(self):
+        """
+        Start sweeping idle rooms in the background, if not already running
+        """
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.DOCUMENT_ROOM_SWEEP_INTERVAL_SECONDS)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Failed to sweep idle rooms")
+
+    async def sweep(self):
+        """
+        Evict rooms that have been idle for too long, then enforce the budget
+        """
+
+        cutoff = time.monotonic() - settings.DOCUMENT_ROOM_IDLE_SECONDS
+        for room in self.registry.rooms():
+            if room.connections == 0 and room.last_active < cutoff:
+                await self.evict(room)
+        await self.enforce_budget()
+
+    async def enforce_budget(self):
+        """
+        Evict idle rooms, least recently used first, until the resident rooms
+        fit in the memory budget
+        """
+
+        budget = settings.DOCUMENT_ROOM_MEMORY_BUDGET_BYTES
+        if self.registry.size_bytes <= budget:
+            self._over_budget = False
+            return
+
+        idle = sorted(
+            (room for room in self.registry.rooms() if room.connections == 0),
+            key=lambda room: room.last_active,
+        )
+        for room in idle:
+            await self.evict(room)
+            if self.registry.size_bytes <= budget:
+                self._over_budget = False
+                return
+
+        # Only rooms in use are left, which can't be evicted
+        if not self._over_budget:
+            logger.warning(
+                f"Rooms in use take up {self.registry.size_bytes} bytes, "
+                f"exceeding the budget of {budget} bytes"
+            )
+        self._over_budget = True
+
+    async def evict(self, room: Room) -> bool:
+        await write_behind.flush([room])
+        return await self.registry.evict(room.name)
+
+    def resident_set(self) -> List[Dict]:
+        """
+        Describe the rooms currently held in memory, most recently used first
+        """
+
+        now = time.monotonic()
+        return [
+            {
+                "document_id": room.document_id,
+                "connections": room.connections,
+                "size_bytes": room.size_bytes,
+                "update_bytes": room.update_bytes,
+                "updates_per_second": round(room.update_rate(now), 2),
+                "idle_seconds": round(now - room.last_active, 1),
+            }
+            for room in sorted(
+                self.registry.rooms(), key=lambda room: room.last_active, reverse=True
+            )
+        ]
+
+
+room_lifecycle = RoomLifecycle(room_registry)
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Length
+
+from documents.models import DocumentUpdate
+from documents.persistence import compact_document
+
+
+class Command(BaseCommand):
+    help = "Merge document update logs that exceed the size or count threshold"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Compact every document with a non-empty update log",
+        )
+
+    def handle(self, *args, **options):
+        logs = DocumentUpdate.objects.values("document_id").annotate(
+            count=Count("id"), size=Sum(Length("content"))
+        )
+        if not options["all"]:
+            logs = logs.filter(
+                Q(count__gte=settings.DOCUMENT_UPDATE_LOG_MAX_COUNT)
+                | Q(size__gte=settings.DOCUMENT_UPDATE_LOG_MAX_BYTES)
+            )
+
+        total = 0
+        for log in logs.order_by():
+            total += compact_document(log["document_id"])
+            self.stdout.write(f"Compacted document {log['document_id']}")
+
+        self.stdout.write(self.style.SUCCESS(f"Compacted {total} updates"))
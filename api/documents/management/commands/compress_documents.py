@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import BinaryField, F, Func
+from django.db.models.functions import Length
+
+from documents.codec import MAGIC, encode_content
+from documents.models import Document, DocumentVersion
+
+
+class Command(BaseCommand):
+    help = "Rewrite stored document snapshots and versions with the storage codec"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        for model in (Document, DocumentVersion):
+            total = self.compress(model, options["batch_size"])
+            self.stdout.write(
+                self.style.SUCCESS(f"Rewrote {total} {model._meta.verbose_name_plural}")
+            )
+
+    def pending(self, model):
+        """
+        Rows whose content doesn't start with the codec header yet and is
+        large enough to be compressed
+        """
+
+        return (
+            model.objects.exclude(content__isnull=True)
+            .annotate(
+                header=Func(
+                    F("content"),
+                    1,
+                    len(MAGIC),
+                    function="SUBSTR",
+                    output_field=BinaryField(),
+                ),
+                size=Length("content"),
+            )
+            .exclude(header=MAGIC)
+            .filter(size__gte=settings.DOCUMENT_CONTENT_COMPRESSION_MIN_BYTES)
+        )
+
+    def compress(self, model, batch_size: int) -> int:
+        last_id = None
+        processed = 0
+        total = 0
+        while True:
+            batch = self.pending(model).order_by("pk")
+            if last_id is not None:
+                batch = batch.filter(pk__gt=last_id)
+            ids = list(batch.values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                break
+
+            with transaction.atomic():
+                # Lock and re-read the rows, so content merged by a concurrent
+                # compaction isn't overwritten with what was read before it
+                rows = list(
+                    self.pending(model)
+                    .select_for_update()
+                    .filter(pk__in=ids)
+                    .only("pk", "content")
+                )
+                # Incompressible content would be written back unchanged
+                rows = [
+                    row for row in rows if encode_content(row.content) != row.content
+                ]
+                model.objects.bulk_update(rows, ["content"])
+
+            last_id = ids[-1]
+            processed += len(ids)
+            total += len(rows)
+            self.stdout.write(
+                f"Processed {processed} {model._meta.verbose_name_plural}"
+            )
+
+        return total
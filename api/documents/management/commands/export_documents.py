@@ -0,0 +1,86 @@
+import sys
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from documents.archive import ArchiveWriter
+from documents.crdt import merge_updates
+from documents.models import Document, DocumentUpdate
+
+FIELDS = ("id", "title", "readable_content", "created_at", "updated_at")
+
+
+class Command(BaseCommand):
+    help = "Stream every document and its full state to an archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Archive file, or - for standard output")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        to_stdout = options["output"] == "-"
+        # Keep progress out of an archive written to standard output
+        self.progress = self.stderr if to_stdout else self.stdout
+
+        output = (
+            nullcontext(sys.stdout.buffer)
+            if to_stdout
+            else open(options["output"], "wb")
+        )
+        with output as stream, transaction.atomic():
+            if connection.vendor == "postgresql":
+                # Read every batch from the same snapshot, so documents being
+                # compacted meanwhile are neither missed nor exported twice
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"
+                    )
+            total = self.export(ArchiveWriter(stream), options["batch_size"])
+
+        self.progress.write(self.style.SUCCESS(f"Exported {total} documents"))
+
+    def export(self, writer: ArchiveWriter, batch_size: int) -> int:
+        documents = (
+            Document.objects.order_by("id")
+            .values(*FIELDS, "content")
+            .iterator(chunk_size=batch_size)
+        )
+
+        batch = []
+        total = 0
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                total += self.write_batch(writer, batch)
+                batch = []
+                self.progress.write(f"Processed {total} documents")
+        total += self.write_batch(writer, batch)
+        return total
+
+    def write_batch(self, writer: ArchiveWriter, batch) -> int:
+        """
+        Write a batch of documents, merging each one's update log into its
+        snapshot
+        """
+
+        if not batch:
+            return 0
+
+        logs = {}
+        entries = (
+            DocumentUpdate.objects.filter(document_id__in=[doc["id"] for doc in batch])
+            .order_by("document_id", "id")
+            .values_list("document_id", "content")
+        )
+        for document_id, content in entries:
+            logs.setdefault(document_id, []).append(bytes(content))
+
+        for document in batch:
+            content = bytes(document.pop("content") or b"")
+            log = logs.get(document["id"])
+            if log:
+                # Archive the full state rather than the snapshot and its log
+                content = merge_updates([content, *log] if content else log)
+            writer.write(document, content)
+        return len(batch)
@@ -0,0 +1,192 @@
+import multiprocessing
+import sys
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connections, transaction
+from django.utils.dateparse import parse_datetime
+
+from documents.archive import ArchiveError, ArchiveReader
+from documents.models import Document, DocumentSummary, DocumentUpdate
+from documents.search import update_search_vectors
+from documents.summaries import summarize_text
+
+# What to do with documents that already exist
+ON_CONFLICT = ("error", "skip", "replace")
+
+
+@contextmanager
+def archived_timestamps():
+    """
+    Keep the archived creation and modification times instead of stamping
+    the imported documents with the current time
+    """
+
+    fields = [Document._meta.get_field(name) for name in ("created_at", "updated_at")]
+    flags = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, flags):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def import_batch(records: List[Tuple[Dict, bytes]], on_conflict: str) -> int:
+    """
+    Write a batch of archived documents in one transaction, along with their
+    summaries and search vectors. Returns the number of documents written.
+    """
+
+    documents = [
+        Document(
+            id=uuid.UUID(metadata["id"]),
+            title=metadata["title"],
+            content=content,
+            readable_content=metadata["readable_content"],
+            created_at=parse_datetime(metadata["created_at"]),
+            updated_at=parse_datetime(metadata["updated_at"]),
+        )
+        for metadata, content in records
+    ]
+
+    with transaction.atomic(), archived_timestamps():
+        if on_conflict == "skip":
+            existing = set(
+                Document.objects.filter(
+                    id__in=[document.id for document in documents]
+                ).values_list("id", flat=True)
+            )
+            documents = [
+                document for document in documents if document.id not in existing
+            ]
+        elif on_conflict == "replace":
+            # The archived state replaces the stored snapshot and its log
+            DocumentUpdate.objects.filter(
+                document_id__in=[document.id for document in documents]
+            ).delete()
+
+        Document.objects.bulk_create(
+            documents,
+            update_conflicts=on_conflict == "replace",
+            unique_fields=["id"] if on_conflict == "replace" else None,
+            update_fields=(
+                ["title", "content", "readable_content", "created_at", "updated_at"]
+                if on_conflict == "replace"
+                else None
+            ),
+        )
+        DocumentSummary.objects.bulk_create(
+            [
+                DocumentSummary(
+                    document_id=document.id,
+                    last_activity_at=document.updated_at,
+                    **summarize_text(document.readable_content),
+                )
+                for document in documents
+            ],
+            update_conflicts=True,
+            unique_fields=["document"],
+            update_fields=[
+                "snippet",
+                "word_count",
+                "character_count",
+                "last_activity_at",
+            ],
+        )
+        update_search_vectors(document.id for document in documents)
+    return len(documents)
+
+
+def close_connections():
+    # Forked workers must open connections of their own
+    for connection in connections.all():
+        connection.close()
+        if connection.vendor == "postgresql":
+            connection.close_pool()
+
+
+class Command(BaseCommand):
+    help = "Import documents from an archive written by export_documents"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="Archive file, or - for standard input")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes writing batches in parallel",
+        )
+        parser.add_argument(
+            "--on-conflict",
+            choices=ON_CONFLICT,
+            default="error",
+            help="What to do with documents that already exist",
+        )
+
+    def handle(self, *args, **options):
+        from_stdin = options["input"] == "-"
+        archive = (
+            nullcontext(sys.stdin.buffer)
+            if from_stdin
+            else open(options["input"], "rb")
+        )
+        try:
+            with archive as stream:
+                total = self.import_archive(ArchiveReader(stream), options)
+        except ArchiveError as exc:
+            raise CommandError(str(exc)) from exc
+        except IntegrityError as exc:
+            raise CommandError(
+                f"{exc}\nPass --on-conflict skip or replace to import documents "
+                "that already exist"
+            ) from exc
+
+        self.stdout.write(self.style.SUCCESS(f"Imported {total} documents"))
+
+    def batches(self, reader: ArchiveReader, batch_size: int):
+        batch = []
+        for record in reader:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def import_archive(self, reader: ArchiveReader, options) -> int:
+        batches = self.batches(reader, options["batch_size"])
+        total = 0
+
+        if options["workers"] <= 1:
+            for batch in batches:
+                total += import_batch(batch, options["on_conflict"])
+                self.stdout.write(f"Processed {total} documents")
+            return total
+
+        close_connections()
+        pool = ProcessPoolExecutor(
+            options["workers"], mp_context=multiprocessing.get_context("fork")
+        )
+        with pool:
+            pending = set()
+            for batch in batches:
+                # Only read ahead a couple of batches per worker
+                if len(pending) >= options["workers"] * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    total += self.collect(done, total)
+                pending.add(pool.submit(import_batch, batch, options["on_conflict"]))
+            total += self.collect(pending, total)
+        return total
+
+    def collect(self, futures, total: int) -> int:
+        count = 0
+        for future in futures:
+            count += future.result()
+            self.stdout.write(f"Processed {total + count} documents")
+        return count
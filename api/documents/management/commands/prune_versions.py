@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from documents.persistence import prune_versions
+
+
+class Command(BaseCommand):
+    help = "Delete the diffs of versions older than the retention period"
+
+    def handle(self, *args, **options):
+        total = prune_versions()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {total} versions"))
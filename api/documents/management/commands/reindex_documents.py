@@ -0,0 +1,39 @@
+import y_py as Y
+
+from django.core.management.base import BaseCommand
+
+from documents.models import Document
+from documents.persistence import load_document_state
+from documents.search import update_search_vectors
+from documents.text import extract_text
+
+
+class Command(BaseCommand):
+    help = "Rebuild the readable content and search vector of stored documents"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        document_ids = Document.objects.values_list("id", flat=True).order_by("id")
+
+        batch = []
+        total = 0
+        for document_id in document_ids.iterator(chunk_size=options["batch_size"]):
+            _, updates = load_document_state(str(document_id))
+            doc = Y.YDoc()
+            for update in updates:
+                Y.apply_update(doc, update)
+            batch.append(Document(id=document_id, readable_content=extract_text(doc)))
+
+            if len(batch) >= options["batch_size"]:
+                total += self.save_batch(batch)
+                batch = []
+        total += self.save_batch(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Reindexed {total} documents"))
+
+    def save_batch(self, batch):
+        Document.objects.bulk_update(batch, ["readable_content"])
+        update_search_vectors(document.id for document in batch)
+        return len(batch)
@@ -0,0 +1,187 @@
+"""
+Metrics and sampled tracing for the collaboration server.
+
+Metrics are never labeled by document, which would expose document IDs and
+grow with every document opened; staff can see per-room figures at
+/documents/rooms/ instead. Set `METRICS_TRACE_SAMPLE_RATE` to log a timing
+breakdown of that fraction of the messages consumers receive.
+"""
+
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from minidoc_api.metrics import registry
+
+logger = logging.getLogger("django.channels")
+
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _rooms():
+    # Imported here since rooms record their updates in these metrics
+    from .rooms import room_registry
+
+    return room_registry.rooms()
+
+
+def _viewer_hubs():
+    from .viewers import viewer_hubs
+
+    return viewer_hubs.hubs()
+
+
+rooms_resident = registry.gauge(
+    "minidoc_rooms_resident",
+    "Rooms loaded in this process",
+    callback=lambda: len(_rooms()),
+)
+rooms_active = registry.gauge(
+    "minidoc_rooms_active",
+    "Rooms with at least one connected client",
+    callback=lambda: sum(1 for room in _rooms() if room.connections),
+)
+connections = registry.gauge(
+    "minidoc_websocket_connections",
+    "Connected WebSocket clients",
+    callback=lambda: sum(room.connections for room in _rooms()),
+)
+viewers = registry.gauge(
+    "minidoc_viewers",
+    "Connected read-only viewers",
+    callback=lambda: sum(len(hub.viewers) for hub in _viewer_hubs()),
+)
+websocket_bytes_received = registry.counter(
+    "minidoc_websocket_bytes_received_total",
+    "Bytes received from WebSocket clients",
+)
+websocket_bytes_sent = registry.counter(
+    "minidoc_websocket_bytes_sent_total",
+    "Bytes sent to WebSocket clients",
+)
+messages_received = registry.counter(
+    "minidoc_websocket_messages_received_total",
+    "WebSocket messages received, by message type",
+    labels=("type",),
+)
+yjs_updates = registry.counter(
+    "minidoc_yjs_updates_total",
+    "Yjs updates applied to resident rooms",
+)
+room_load_seconds = registry.histogram(
+    "minidoc_room_load_seconds",
+    "Time taken to join a room, by whether it had to be loaded from the database",
+    labels=("source",),
+)
+save_seconds = registry.histogram(
+    "minidoc_save_seconds",
+    "Time taken to write a batch of dirty documents to the database",
+)
+save_bytes = registry.histogram(
+    "minidoc_save_bytes",
+    "Size of the updates written per batch of dirty documents",
+    buckets=BYTE_BUCKETS,
+)
+publish_seconds = registry.histogram(
+    "minidoc_channel_layer_publish_seconds",
+    "Time taken to publish an event to a room's group, by event type",
+    labels=("type",),
+)
+message_seconds = registry.histogram(
+    "minidoc_websocket_message_seconds",
+    "Time taken to handle a received WebSocket message, by message type",
+    labels=("type",),
+)
+crdt_seconds = registry.histogram(
+    "minidoc_crdt_seconds",
+    "Time taken to merge or encode CRDT updates, by whether it ran on the event "
+    "loop or was offloaded",
+    labels=("mode",),
+)
+crdt_offloaded_seconds = registry.counter(
+    "minidoc_crdt_offloaded_seconds_total",
+    "Event loop time saved by running CRDT work in the executor",
+)
+
+
+class Span:
+    """
+    Timing breakdown of a single sampled message
+    """
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def finish(self):
+        total = time.perf_counter() - self.started
+        details = " ".join(
+            [f"{key}={value}" for key, value in self.attributes.items()]
+            + [f"{name}={seconds * 1000:.2f}ms" for name, seconds in self.phases]
+        )
+        logger.info(f"Trace {self.name} {details} total={total * 1000:.2f}ms")
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def trace_message(message_type: str, **attributes):
+    """
+    Time the handling of a received message, logging a span for a sample of
+    messages. Yields the span, or None if the message wasn't sampled.
+    """
+
+    span = None
+    if random.random() < settings.METRICS_TRACE_SAMPLE_RATE:
+        span = Span(message_type, **attributes)
+    token = current_span.set(span)
+    started = time.perf_counter()
+    try:
+        yield span
+    finally:
+        message_seconds.observe(time.perf_counter() - started, type=message_type)
+        current_span.reset(token)
+        if span is not None:
+            span.finish()
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Record a phase of the current span, if the message is being traced
+    """
+
+    span = current_span.get()
+    if span is None:
+        yield
+        return
+    with span.phase(name):
+        yield
+
+
+async def group_send(channel_layer, group: str, message: Dict):
+    """
+    Publish an event to a group, recording how long the channel layer took
+    """
+
+    with (
+        phase(f"publish:{message['type']}"),
+        publish_seconds.time(type=message["type"]),
+    ):
+        await channel_layer.group_send(group, message)
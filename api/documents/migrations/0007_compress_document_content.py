@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:14
+
+import documents.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("documents", "0006_document_search_vector"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="document",
+            name="content",
+            field=documents.models.CompressedBinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="documentupdate",
+            name="content",
+            field=documents.models.CompressedBinaryField(),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_summaries(apps, schema_editor):
+    """
+    Summarize existing documents from their stored readable content
+    """
+
+    from documents.summaries import summarize_text
+
+    Document = apps.get_model("documents", "Document")
+    DocumentSummary = apps.get_model("documents", "DocumentSummary")
+    documents = Document.objects.only("id", "readable_content", "updated_at")
+    batch = []
+    for document in documents.iterator(chunk_size=500):
+        batch.append(
+            DocumentSummary(
+                document_id=document.id,
+                last_activity_at=document.updated_at,
+                **summarize_text(document.readable_content),
+            )
+        )
+        if len(batch) >= 500:
+            DocumentSummary.objects.bulk_create(batch)
+            batch = []
+    DocumentSummary.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("documents", "0008_documentversion"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DocumentSummary",
+            fields=[
+                (
+                    "document",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="summary",
+                        serialize=False,
+                        to="documents.document",
+                    ),
+                ),
+                ("snippet", models.CharField(blank=True, default="", max_length=280)),
+                ("word_count", models.PositiveIntegerField(default=0)),
+                ("character_count", models.PositiveIntegerField(default=0)),
+                ("last_activity_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "last_editor",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(create_summaries, migrations.RunPython.noop),
+    ]
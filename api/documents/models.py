@@ -1,16 +1,106 @@
 import uuid
 
 # from django.contrib.auth.models import User
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
+from .codec import decode_content, encode_content
+
+
+class CompressedBinaryField(models.BinaryField):
+    """
+    BinaryField that transparently compresses values with the document
+    storage codec. Rows written before compression was enabled stay readable.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decode_content(bytes(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is not None and not prepared:
+            value = encode_content(bytes(value))
+        return super().get_db_prep_value(value, connection, prepared)
+
 
 class Document(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     title = models.CharField(max_length=255)
-    content = models.BinaryField(null=True, blank=True)
+    content = CompressedBinaryField(null=True, blank=True)
     readable_content = models.TextField(default="")
+    # Maintained by documents.search.update_search_vectors
+    search_vector = SearchVectorField(null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     # TODO
     # author = models.ForeignKey(User, on_delete=models.CASCADE)
     # collaborators = models.ManyToManyField(User, related_name='collaborators')
+
+    class Meta:
+        indexes = [
+            # Supports keyset pagination of the documents list
+            models.Index(
+                fields=["-updated_at", "-id"], name="document_updated_at_id_idx"
+            ),
+            GinIndex(fields=["search_vector"], name="document_search_vector_idx"),
+        ]
+
+
+class DocumentUpdate(models.Model):
+    """
+    Incremental Yjs update appended to a document's log. The log is replayed on
+    top of `Document.content` when loading and periodically compacted into it.
+    """
+
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name="updates"
+    )
+    content = CompressedBinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class DocumentVersion(models.Model):
+    """
+    Entry in a document's version history. Every few versions store the full
+    document state; the rest store the diff against the previous version.
+    """
+
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name="versions"
+    )
+    number = models.PositiveIntegerField()
+    is_snapshot = models.BooleanField(default=False)
+    content = CompressedBinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["document", "number"], name="document_version_number_unique"
+            )
+        ]
+
+
+class DocumentSummary(models.Model):
+    """
+    Dashboard metadata of a document, kept up to date whenever its changes are
+    persisted so that listing documents never has to decode their content
+    """
+
+    document = models.OneToOneField(
+        Document, on_delete=models.CASCADE, primary_key=True, related_name="summary"
+    )
+    snippet = models.CharField(max_length=280, blank=True, default="")
+    word_count = models.PositiveIntegerField(default=0)
+    character_count = models.PositiveIntegerField(default=0)
+    last_editor = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    last_activity_at = models.DateTimeField(null=True, blank=True)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, NamedTuple, Optional
+
+from ypy_websocket.yutils import YMessageType, YSyncMessageType, read_message
+
+from django.conf import settings
+
+from .control import is_control_frame
+
+logger = logging.getLogger("django.channels")
+
+
+class OutboundMessage(NamedTuple):
+    text_data: Optional[str]
+    bytes_data: Optional[bytes]
+    on_sent: Optional[Callable[[], None]]
+
+    @property
+    def size(self) -> int:
+        return len(self.bytes_data if self.bytes_data is not None else self.text_data)
+
+
+class OutboundQueue:
+    """
+    Per-connection queue of frames waiting to be written to the client.
+
+    Channel layer handlers enqueue frames and return immediately, while a
+    writer task sends them at whatever pace the client reads. The queue keeps
+    track of how much is pending so a consumer can tell when its client falls
+    too far behind.
+    """
+
+    def __init__(self, send: Callable[..., Awaitable[None]]):
+        self._send = send
+        self._messages: Deque[OutboundMessage] = deque()
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.pending_bytes = 0
+        self.peak_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def put(
+        self,
+        text_data: Optional[str] = None,
+        bytes_data: Optional[bytes] = None,
+        on_sent: Optional[Callable[[], None]] = None,
+    ):
+        message = OutboundMessage(text_data, bytes_data, on_sent)
+        self._messages.append(message)
+        self.pending_bytes += message.size
+        self.peak_bytes = max(self.peak_bytes, self.pending_bytes)
+        self._ready.set()
+
+    def is_over_limit(self) -> bool:
+        return (
+            self.pending_bytes > settings.DOCUMENT_OUTBOUND_MAX_BYTES
+            or len(self._messages) > settings.DOCUMENT_OUTBOUND_MAX_MESSAGES
+        )
+
+    def drop_sync_messages(self) -> List[bytes]:
+        """
+        Remove every pending binary Yjs frame, keeping text and control frames
+        in order.
+
+        Returns the updates carried by the removed SYNC_STEP2 and SYNC_UPDATE
+        messages. Other binary frames (sync requests, awareness) are dropped.
+        """
+
+        updates = []
+        kept: Deque[OutboundMessage] = deque()
+        for message in self._messages:
+            data = message.bytes_data
+            if data is None or is_control_frame(data):
+                kept.append(message)
+                continue
+            if len(data) > 2 and data[0] == YMessageType.SYNC:
+                if data[1] in (
+                    YSyncMessageType.SYNC_STEP2,
+                    YSyncMessageType.SYNC_UPDATE,
+                ):
+                    updates.append(read_message(data[2:]))
+
+        self._messages = kept
+        self.pending_bytes = sum(message.size for message in kept)
+        return updates
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._messages:
+                message = self._messages.popleft()
+                self.pending_bytes -= message.size
+                await self._send(
+                    text_data=message.text_data, bytes_data=message.bytes_data
+                )
+                if message.on_sent is not None:
+                    message.on_sent()
+            self._ready.clear()
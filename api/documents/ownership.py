@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+import y_py as Y
+from channels.layers import get_channel_layer
+from redis import asyncio as aioredis
+
+from django.conf import settings
+
+from .autosave import write_behind
+from .crdt import crdt_executor
+from .db import run_db
+from .persistence import append_updates, load_stored_state
+from .rooms import Room, RoomRegistry, room_registry
+
+logger = logging.getLogger("django.channels")
+
+LEASE_KEY_PREFIX = "minidoc:room-owner:"
+
+# Only extend or drop a lease while still holding it
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class RoomOwnership:
+    """
+    Assign each room to a single worker through a lease in Redis.
+
+    Every worker keeps its own copy of a room for the clients connected to
+    it, but only the owner persists it. Other workers forward their clients'
+    updates to the owner over the channel layer instead of writing them
+    themselves. Leases are renewed while the owner has the room resident and
+    dropped once its last local client leaves, letting a worker that still
+    has clients take over. When a worker takes over a room, it writes only
+    the part of its state that isn't in the database yet.
+
+    An owner that dies keeps its lease until it expires, so updates forwarded
+    in the meantime may never be saved. A room that forwarded updates stays
+    resident, even once idle, until its owner is seen renewing the lease long
+    enough after the last of them to have been alive, or the room is taken
+    over. If a new owner took over in between, it is sent the room's state.
+
+    Disabled unless `DOCUMENT_ROOM_OWNERSHIP_ENABLED` is set, in which case
+    rooms are always owned by the worker holding them.
+    """
+
+    def __init__(self, registry: RoomRegistry):
+        self.registry = registry
+        self.channel_name: Optional[str] = None
+        self._redis: Optional[aioredis.Redis] = None
+        self._renew = None
+        self._release = None
+        self._tasks = []
+        # Owner each room's unconfirmed forwarded updates were last sent to
+        self._forwarded_to: Dict[str, str] = {}
+        self._started: Optional[asyncio.Event] = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.DOCUMENT_ROOM_OWNERSHIP_ENABLED
+
+    async def start(self):
+        """
+        Open this worker's channel for forwarded updates and start renewing
+        leases, if not already running
+        """
+
+        if self._started is not None:
+            await self._started.wait()
+            return
+        self._started = asyncio.Event()
+
+        self._redis = aioredis.Redis.from_url(
+            settings.DOCUMENT_ROOM_OWNERSHIP_REDIS_URL
+        )
+        self._renew = self._redis.register_script(RENEW_SCRIPT)
+        self._release = self._redis.register_script(RELEASE_SCRIPT)
+        self.channel_name = await get_channel_layer().new_channel("room-owner")
+        self._tasks = [
+            asyncio.ensure_future(self._receive_forwarded()),
+            asyncio.ensure_future(self._maintain_leases()),
+        ]
+        self._started.set()
+
+    def _lease_key(self, room: Room) -> str:
+        return f"{LEASE_KEY_PREFIX}{room.name}"
+
+    @property
+    def _lease_ms(self) -> int:
+        return int(settings.DOCUMENT_ROOM_LEASE_SECONDS * 1000)
+
+    async def register(self, room: Room):
+        """
+        Claim a room that was just loaded or became active again, or find out
+        which worker owns it
+        """
+
+        await self.start()
+        if await self._claim(room):
+            room.owned = True
+            room.owner_channel = self.channel_name
+            if room.state_modified:
+                write_behind.mark_dirty(room)
+        else:
+            room.owned = False
+
+    async def _claim(self, room: Room) -> bool:
+        claimed = await self._redis.set(
+            self._lease_key(room), self.channel_name, nx=True, px=self._lease_ms
+        )
+        if not claimed:
+            owner = await self._redis.get(self._lease_key(room))
+            room.owner_channel = owner.decode() if owner else None
+        return bool(claimed)
+
+    async def release(self, room: Room):
+        """
+        Give up ownership of a room after persisting its pending changes
+        """
+
+        if not room.owned:
+            return
+        await write_behind.flush([room])
+        room.owned = False
+        room.owner_channel = None
+        await self._release(keys=[self._lease_key(room)], args=[self.channel_name])
+        logger.debug(f"Released ownership of {room.name}")
+
+    async def take_over(self, room: Room):
+        """
+        Become the owner of a room another worker owned before. Anything the
+        room has that the database doesn't is written with the next flush.
+        """
+
+        updates, state_vector, log_id = await run_db(
+            load_stored_state, room.document_id
+        )
+        state = await crdt_executor.merge(updates)
+        room.catch_up(state, log_id)
+        room.saved_state_vector = state_vector
+        if room.saved_state is not None:
+            room.saved_state = state
+            room.saved_log_id = log_id
+        room.owned = True
+        room.owner_channel = self.channel_name
+        room.forwarded_at = None
+        self._forwarded_to.pop(room.name, None)
+        room.mark_unsaved()
+        write_behind.mark_dirty(room)
+        logger.info(f"Took over ownership of {room.name}")
+
+    async def forward(self, room: Room, update: bytes):
+        """
+        Send an update made by one of this worker's clients to the room's owner
+        """
+
+        if room.owner_channel is None:
+            # The update is already in the room, so taking over persists it
+            if await self._claim(room):
+                await self.take_over(room)
+                return
+            if room.owner_channel is None:
+                # Changes of rooms this worker doesn't own aren't tracked as
+                # unsaved, so write the update rather than dropping it
+                logger.warning(f"No owner to forward update for {room.name} to")
+                await self._persist(room.document_id, update, room.last_editor_id)
+                return
+
+        await self._send(room, update)
+
+    async def _send(self, room: Room, update: bytes):
+        room.forwarded_at = time.monotonic()
+        self._forwarded_to[room.name] = room.owner_channel
+        await get_channel_layer().send(
+            room.owner_channel,
+            {
+                "type": "room.update",
+                "room": room.name,
+                "document_id": room.document_id,
+                "update": update,
+                "editor_id": room.last_editor_id,
+            },
+        )
+
+    async def _receive_forwarded(self):
+        channel_layer = get_channel_layer()
+        while True:
+            message = await channel_layer.receive(self.channel_name)
+            try:
+                await self._apply_forwarded(message)
+            except Exception:
+                logger.exception(
+                    f"Failed to apply update forwarded to {message['room']}"
+                )
+
+    async def _apply_forwarded(self, message):
+        room = self.registry.get(message["room"])
+        if room is not None and room.owned:
+            if message.get("editor_id") is not None:
+                room.last_editor_id = message["editor_id"]
+            # Marks the room dirty, so the update is saved with the next flush
+            Y.apply_update(room.ydoc, message["update"])
+            return
+
+        # Ownership moved while the update was in flight; persisting it
+        # directly keeps it from being lost
+        await self._persist(
+            message["document_id"], message["update"], message.get("editor_id")
+        )
+
+    async def _persist(
+        self, document_id: str, update: bytes, editor_id: Optional[int] = None
+    ):
+        await run_db(
+            append_updates, {document_id: [update]}, editors={document_id: editor_id}
+        )
+
+    async def _maintain_leases(self):
+        while True:
+            await asyncio.sleep(settings.DOCUMENT_ROOM_LEASE_SECONDS / 3)
+            for room in self.registry.rooms():
+                try:
+                    await self._maintain_lease(room)
+                except Exception:
+                    logger.exception(f"Failed to maintain lease of {room.name}")
+
+    async def _maintain_lease(self, room: Room):
+        if room.owned:
+            renewed = await self._renew(
+                keys=[self._lease_key(room)], args=[self.channel_name, self._lease_ms]
+            )
+            if not renewed:
+                logger.warning(f"Lost ownership of {room.name}")
+                await write_behind.flush([room])
+                room.owned = False
+                room.owner_channel = None
+        elif room.connections > 0 or room.forwarded_at is not None:
+            if await self._claim(room):
+                await self.take_over(room)
+                if room.connections == 0:
+                    # Saves the forwarded changes and lets the room be evicted
+                    await self.release(room)
+            elif room.forwarded_at is not None:
+                await self._confirm_forwarded(room)
+
+    async def _confirm_forwarded(self, room: Room):
+        if room.owner_channel is None:
+            return
+        if room.owner_channel != self._forwarded_to.get(room.name):
+            # The owner the updates went to may have died before saving them
+            logger.info(f"Sending {room.name} to its new owner")
+            await self._send(room, Y.encode_state_as_update(room.ydoc))
+        elif (
+            time.monotonic() - room.forwarded_at > settings.DOCUMENT_ROOM_LEASE_SECONDS
+        ):
+            # A dead owner's lease would have expired by now
+            room.forwarded_at = None
+            del self._forwarded_to[room.name]
+
+
+room_ownership = RoomOwnership(room_registry)
@@ -0,0 +1,98 @@
+import base64
+import binascii
+import uuid
+from datetime import datetime
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from django.db.models import Q
+
+
+class DocumentKeysetPagination(BasePagination):
+    """
+    Keyset pagination over `(updated_at, id)`, newest first.
+
+    Unlike offset pagination, fetching a page costs the same regardless of how
+    deep into the list it is. Pagination is opt-in: it only applies when the
+    request passes `limit` or `cursor`, so existing clients still receive a
+    plain list.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = "Invalid cursor"
+
+    def is_requested(self, request) -> bool:
+        return (
+            self.cursor_query_param in request.query_params
+            or self.page_size_query_param in request.query_params
+        )
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def encode_cursor(self, document) -> str:
+        position = f"{document.updated_at.isoformat()}|{document.id}"
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor: str):
+        try:
+            position = base64.urlsafe_b64decode(cursor.encode()).decode()
+            updated_at, document_id = position.split("|")
+            return datetime.fromisoformat(updated_at), uuid.UUID(document_id)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_requested(request):
+            return None
+
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            updated_at, document_id = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(updated_at__lt=updated_at)
+                | Q(updated_at=updated_at, id__lt=document_id)
+            )
+
+        page = list(queryset.order_by("-updated_at", "-id")[: page_size + 1])
+        self.has_next = len(page) > page_size
+        page = page[:page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if self.has_next else None
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+
+class DocumentSearchPagination(LimitOffsetPagination):
+    """
+    Search results are ordered by rank, which has no stable keyset, so they
+    are paged by offset
+    """
+
+    default_limit = 20
+    max_limit = 100
+
+
+class DocumentVersionPagination(LimitOffsetPagination):
+    default_limit = 50
+    max_limit = 200
@@ -0,0 +1,561 @@
+"""
+Synchronous storage helpers for document state.
+
+A document's state is its `content` snapshot plus the tail of incremental
+updates in `DocumentUpdate`. These helpers only deal in bytes; Y.YDoc instances
+are bound to the thread that created them, so callers on the event loop must
+apply the returned updates themselves.
+"""
+
+import logging
+import uuid
+from datetime import timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+import y_py as Y
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from .broadcast import EMPTY_UPDATE
+from .crdt import merge_updates
+from .models import Document, DocumentUpdate, DocumentVersion
+from .search import update_search_vectors
+from .state_cache import state_cache
+from .summaries import update_summaries
+from .text import extract_text
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidUpdate(ValueError):
+    """
+    Raised when a client submits data that isn't a valid Yjs update
+    """
+
+
+class InvalidStateVector(ValueError):
+    """
+    Raised when a client submits data that isn't a valid Yjs state vector
+    """
+
+
+def load_cached_state(
+    document_id: str,
+) -> Optional[Tuple[Document, List[bytes], Optional[bytes], int]]:
+    """
+    Rebuild a document's state from the state cache and the update log entries
+    written since, without reading the stored snapshot.
+
+    Returns the document (without its content), the updates, the state vector
+    of the cached state if it is still the latest, and the ID of the newest log
+    entry the updates include. Returns None if the document isn't cached or
+    the cached state can't be trusted anymore.
+    """
+
+    cached = state_cache.get(document_id)
+    if cached is None:
+        return None
+
+    log = list(
+        DocumentUpdate.objects.filter(document_id=document_id, id__gte=cached.log_id)
+        .order_by("id")
+        .values_list("id", "content")
+    )
+    # The entry the cached state ends with was compacted away, so later
+    # entries may have been too
+    if not log or log[0][0] != cached.log_id:
+        state_cache.delete(document_id)
+        return None
+
+    try:
+        document = Document.objects.defer("content", "search_vector").get(
+            id=document_id
+        )
+    except Document.DoesNotExist:
+        return None
+
+    tail = [bytes(content) for _, content in log[1:]]
+    state_vector = None if tail else cached.state_vector
+    return document, [cached.state, *tail], state_vector, log[-1][0]
+
+
+def load_room_state(document_id: str) -> Tuple[Document, List[bytes], int]:
+    """
+    Fetch (or create) a document along with the updates needed to rebuild its
+    state, as `load_document_state` does, and the ID of the newest update log
+    entry they include (0 if the log was empty). Every entry up to that ID is
+    included.
+    """
+
+    cached = load_cached_state(document_id)
+    if cached is not None:
+        document, updates, _, log_id = cached
+        return document, updates, log_id
+
+    # Read the log before the snapshot. If a compaction runs in between, the
+    # snapshot already contains the log entries and re-applying them is a no-op.
+    log = list(
+        DocumentUpdate.objects.filter(document_id=document_id)
+        .order_by("id")
+        .values_list("id", "content")
+    )
+    document, _ = Document.objects.get_or_create(
+        id=document_id,
+        defaults={
+            "title": "Untitled Document",
+            "content": b"",  # Use default binary content
+        },
+    )
+
+    updates = [bytes(update) for _, update in log]
+    content = bytes(document.content or b"")
+    if content != b"":
+        updates.insert(0, content)
+    return document, updates, log[-1][0] if log else 0
+
+
+def load_document_state(document_id: str) -> Tuple[Document, List[bytes]]:
+    """
+    Fetch (or create) a document and return it along with the updates needed
+    to rebuild its state: the snapshot followed by the update log.
+    """
+
+    document, updates, _ = load_room_state(document_id)
+    return document, updates
+
+
+def load_existing_state(document_id: str) -> List[bytes]:
+    """
+    Return the updates needed to rebuild an existing document, without
+    creating it if it is missing.
+
+    Raises Document.DoesNotExist if there is no such document.
+    """
+
+    cached = load_cached_state(document_id)
+    if cached is not None:
+        return cached[1]
+
+    # Log before snapshot, as in load_document_state
+    log = list(
+        DocumentUpdate.objects.filter(document_id=document_id)
+        .order_by("id")
+        .values_list("content", flat=True)
+    )
+    content = Document.objects.values_list("content", flat=True).get(id=document_id)
+
+    updates = [bytes(update) for update in log]
+    if content:
+        updates.insert(0, bytes(content))
+    return updates
+
+
+def load_stored_state(document_id: str) -> Tuple[List[bytes], bytes, int]:
+    """
+    Return the updates needed to rebuild a document along with the state
+    vector of the stored state and the ID of the newest log entry it includes
+    """
+
+    cached = load_cached_state(document_id)
+    if cached is not None and cached[2] is not None:
+        _, updates, state_vector, log_id = cached
+        return updates, state_vector, log_id
+
+    _, updates, log_id = load_room_state(document_id)
+    doc = Y.YDoc()
+    for update in updates:
+        Y.apply_update(doc, update)
+    return updates, Y.encode_state_vector(doc), log_id
+
+
+def append_updates(
+    batch: Dict[str, List[bytes]],
+    texts: Optional[Dict[str, str]] = None,
+    titles: Optional[Dict[str, str]] = None,
+    editors: Optional[Dict[str, int]] = None,
+    states: Optional[Dict[str, Tuple[bytes, bytes, int]]] = None,
+) -> Tuple[Set[str], Set[str], Dict[str, int]]:
+    """
+    Append incremental updates for several documents to their logs in a single
+    transaction, along with the new readable content of any document in
+    `texts` and the new title of any document in `titles`. Their summaries
+    are updated as well, crediting the user ID in `editors` if there is one.
+
+    `states` holds the full state and state vector of documents in `batch`
+    as of their new updates, along with the ID of the newest log entry the
+    state included before them (see `load_room_state`). They are written
+    through to the state cache, unless other entries were written since that
+    one. Cached states of other documents in `batch` are invalidated.
+
+    Only the changed columns are written; the `content` snapshot is never
+    touched. Returns the IDs of documents whose log has grown past the
+    compaction thresholds, the IDs of documents that no longer exist, and the
+    ID of the newest log entry of each document whose state was cached.
+    """
+
+    texts = texts or {}
+    titles = titles or {}
+    editors = editors or {}
+    states = states or {}
+    ids = {
+        document_id: uuid.UUID(document_id) for document_id in {*batch, *texts, *titles}
+    }
+    with transaction.atomic():
+        existing = set(
+            Document.objects.filter(id__in=ids.values()).values_list("id", flat=True)
+        )
+        # Touch the documents so the dashboard ordering reflects the edits
+        now = timezone.now()
+        Document.objects.filter(id__in=existing).update(updated_at=now)
+        for document_id, title in titles.items():
+            Document.objects.filter(id=ids[document_id]).update(title=title)
+        log = DocumentUpdate.objects.bulk_create(
+            [
+                DocumentUpdate(document_id=ids[document_id], content=update)
+                for document_id, updates in batch.items()
+                if ids[document_id] in existing
+                for update in updates
+            ]
+        )
+        # Checked within the transaction: writers of a document are serialized
+        # by the row lock taken when touching it above
+        cached = select_cached_states(states, log)
+        transaction.on_commit(lambda: cache_states(cached, log))
+        record_versions(
+            {
+                ids[document_id]: updates
+                for document_id, updates in batch.items()
+                if ids[document_id] in existing and updates
+            }
+        )
+        if texts:
+            Document.objects.bulk_update(
+                [
+                    Document(id=ids[document_id], readable_content=text)
+                    for document_id, text in texts.items()
+                    if ids[document_id] in existing
+                ],
+                ["readable_content"],
+            )
+        if texts or titles:
+            update_search_vectors(
+                ids[document_id]
+                for document_id in {*texts, *titles}
+                if ids[document_id] in existing
+            )
+        update_summaries(
+            existing,
+            {ids[document_id]: text for document_id, text in texts.items()},
+            {ids[document_id]: user_id for document_id, user_id in editors.items()},
+            now,
+        )
+        logs = (
+            DocumentUpdate.objects.filter(document_id__in=existing)
+            .values("document_id")
+            .annotate(count=Count("id"), size=Sum(Length("content")))
+            .order_by()
+        )
+        oversized = {
+            log["document_id"]
+            for log in logs
+            if log["count"] >= settings.DOCUMENT_UPDATE_LOG_MAX_COUNT
+            or (log["size"] or 0) >= settings.DOCUMENT_UPDATE_LOG_MAX_BYTES
+        }
+
+    needs_compaction = {key for key, value in ids.items() if value in oversized}
+    missing = {key for key, value in ids.items() if value not in existing}
+    log_ids = {key: cached[value][2] for key, value in ids.items() if value in cached}
+    return needs_compaction, missing, log_ids
+
+
+def select_cached_states(
+    states: Dict[str, Tuple[bytes, bytes, int]],
+    log: List[DocumentUpdate],
+) -> Dict[uuid.UUID, Tuple[bytes, bytes, int]]:
+    """
+    Pick the states that can be written through to the state cache along with
+    the new log entries, as their state, state vector and the ID of the newest
+    new entry.
+
+    A state can only be cached if the new entries directly follow the entry it
+    was based on. Entries written in between come from other workers and are
+    missing from the state, and readers of the cache would skip them.
+    """
+
+    first_ids = {}
+    last_ids = {}
+    for entry in log:
+        first_ids[entry.document_id] = min(
+            entry.id, first_ids.get(entry.document_id, entry.id)
+        )
+        last_ids[entry.document_id] = max(entry.id, last_ids.get(entry.document_id, 0))
+
+    candidates = {
+        uuid.UUID(document_id): state
+        for document_id, state in states.items()
+        if uuid.UUID(document_id) in first_ids
+    }
+    if not candidates:
+        return {}
+
+    gaps = Q()
+    for document_id, (_, _, log_id) in candidates.items():
+        gaps |= Q(document_id=document_id, id__gt=log_id, id__lt=first_ids[document_id])
+    behind = set(
+        DocumentUpdate.objects.filter(gaps)
+        .values_list("document_id", flat=True)
+        .distinct()
+    )
+    return {
+        document_id: (state, state_vector, last_ids[document_id])
+        for document_id, (state, state_vector, _) in candidates.items()
+        if document_id not in behind
+    }
+
+
+def cache_states(
+    states: Dict[uuid.UUID, Tuple[bytes, bytes, int]],
+    log: List[DocumentUpdate],
+):
+    """
+    Write the new states of the documents whose logs grew through to the state
+    cache, or invalidate them if their new state isn't known
+    """
+
+    for document_id in {entry.document_id for entry in log}:
+        if document_id in states:
+            state_cache.set(document_id, *states[document_id])
+        else:
+            state_cache.delete(document_id)
+
+
+def sync_document_state(
+    document_id: str,
+    state_vector: Optional[bytes],
+    updates: List[bytes],
+    editor_id: Optional[int] = None,
+) -> Tuple[bytes, bytes, bytes]:
+    """
+    Apply a client's pending updates to a stored document and compute what the
+    client is missing.
+
+    Returns the diff against the client's state vector, the document's new
+    state vector, and the part of the client's updates that was new to the
+    server (empty if there was none).
+
+    Raises Document.DoesNotExist if there is no such document, and
+    InvalidUpdate or InvalidStateVector before writing anything if the client
+    sent invalid data.
+    """
+
+    if state_vector:
+        try:
+            Y.encode_state_as_update(Y.YDoc(), state_vector)
+        except Exception as e:
+            raise InvalidStateVector(str(e)) from e
+
+    stored = load_existing_state(document_id)
+    doc = Y.YDoc()
+    for update in stored:
+        Y.apply_update(doc, update)
+
+    server_state_vector = Y.encode_state_vector(doc)
+    for update in updates:
+        try:
+            Y.apply_update(doc, update)
+        except Exception as e:
+            # y_py doesn't expose its exception types
+            raise InvalidUpdate(str(e)) from e
+
+    new_update = Y.encode_state_as_update(doc, server_state_vector)
+    if new_update == EMPTY_UPDATE:
+        new_update = b""
+    else:
+        append_updates(
+            {document_id: [new_update]},
+            {document_id: extract_text(doc)},
+            editors={document_id: editor_id},
+        )
+
+    if state_vector:
+        diff = Y.encode_state_as_update(doc, state_vector)
+    else:
+        diff = Y.encode_state_as_update(doc)
+    return diff, Y.encode_state_vector(doc), new_update
+
+
+def is_snapshot_version(number: int) -> bool:
+    return (number - 1) % settings.DOCUMENT_VERSION_SNAPSHOT_INTERVAL == 0
+
+
+def record_versions(batch: Dict[uuid.UUID, List[bytes]]):
+    """
+    Add a version to the history of each document in the batch, holding the
+    updates that were just appended to its log. Updates saved within
+    `DOCUMENT_VERSION_MIN_INTERVAL_SECONDS` of a document's latest version
+    are folded into that version instead.
+
+    Must be called after the updates were appended, since snapshots of a
+    document without any history are taken from its stored state.
+    """
+
+    if not batch:
+        return
+
+    latest = dict(
+        DocumentVersion.objects.filter(document_id__in=batch.keys())
+        .values("document_id")
+        .annotate(number=Max("number"))
+        .order_by()
+        .values_list("document_id", "number")
+    )
+
+    # Latest versions that are still open to more changes; a version stays
+    # open for the minimum interval after it was started
+    cutoff = timezone.now() - timedelta(
+        seconds=settings.DOCUMENT_VERSION_MIN_INTERVAL_SECONDS
+    )
+    recent = {
+        version.document_id: version
+        for version in DocumentVersion.objects.select_for_update()
+        .filter(document_id__in=batch.keys(), created_at__gte=cutoff)
+        .order_by("number")
+    }
+
+    versions = []
+    folded = []
+    for document_id, updates in batch.items():
+        version = recent.get(document_id)
+        if version is not None and version.number == latest.get(document_id):
+            # A diff stays the diff against the previous version, and a
+            # snapshot stays the full state
+            version.content = merge_updates([version.content, *updates])
+            folded.append(version)
+            continue
+
+        number = latest.get(document_id, 0) + 1
+        if number == 1:
+            # Documents edited before version history existed start from
+            # their full current state
+            _, stored = load_document_state(str(document_id))
+            content = merge_updates(stored)
+        elif is_snapshot_version(number):
+            content = merge_updates(
+                [get_version_state(document_id, number - 1), *updates]
+            )
+        elif len(updates) == 1:
+            content = updates[0]
+        else:
+            content = merge_updates(updates)
+
+        versions.append(
+            DocumentVersion(
+                document_id=document_id,
+                number=number,
+                is_snapshot=number == 1 or is_snapshot_version(number),
+                content=content,
+            )
+        )
+
+    DocumentVersion.objects.bulk_create(versions)
+    DocumentVersion.objects.bulk_update(folded, ["content"])
+
+
+def prune_versions(document_ids: Optional[List[str]] = None) -> int:
+    """
+    Thin out the version history of the given documents, or of every
+    document. Once older than `DOCUMENT_VERSION_RETENTION_DAYS`, only the
+    snapshots of versions are kept; the diffs needed to rebuild versions
+    after the newest of those snapshots stay.
+
+    Returns the number of versions deleted.
+    """
+
+    cutoff = timezone.now() - timedelta(days=settings.DOCUMENT_VERSION_RETENTION_DAYS)
+    anchors = DocumentVersion.objects.filter(is_snapshot=True, created_at__lt=cutoff)
+    if document_ids is not None:
+        anchors = anchors.filter(document_id__in=document_ids)
+    anchors = (
+        anchors.values("document_id")
+        .annotate(number=Max("number"))
+        .order_by()
+        .values_list("document_id", "number")
+    )
+
+    total = 0
+    for document_id, number in anchors:
+        deleted, _ = DocumentVersion.objects.filter(
+            document_id=document_id, number__lt=number, is_snapshot=False
+        ).delete()
+        total += deleted
+    return total
+
+
+def get_version_state(document_id, number: int) -> bytes:
+    """
+    Rebuild the full document state at the given version by replaying the
+    diffs recorded since the closest snapshot.
+
+    Raises DocumentVersion.DoesNotExist if there is no such version.
+    """
+
+    snapshot = (
+        DocumentVersion.objects.filter(
+            document_id=document_id, number__lte=number, is_snapshot=True
+        )
+        .order_by("-number")
+        .values_list("number", flat=True)
+        .first()
+    )
+    if snapshot is None:
+        raise DocumentVersion.DoesNotExist
+
+    versions = list(
+        DocumentVersion.objects.filter(
+            document_id=document_id, number__gte=snapshot, number__lte=number
+        )
+        .order_by("number")
+        .values_list("number", "content")
+    )
+    if versions[-1][0] != number:
+        raise DocumentVersion.DoesNotExist
+
+    contents = [bytes(content) for _, content in versions]
+    return contents[0] if len(contents) == 1 else merge_updates(contents)
+
+
+def compact_document(document_id: str) -> int:
+    """
+    Merge the document's update log into its snapshot and truncate the log.
+
+    Returns the number of log entries that were compacted.
+    """
+
+    with transaction.atomic():
+        document = Document.objects.select_for_update().get(id=document_id)
+        log = list(
+            DocumentUpdate.objects.filter(document_id=document_id)
+            .order_by("id")
+            .values_list("id", "content")
+        )
+        if not log:
+            return 0
+
+        updates = [bytes(content) for _, content in log]
+        if document.content:
+            updates.insert(0, bytes(document.content))
+        document.content = merge_updates(updates)
+        document.save(update_fields=["content"])
+
+        last_id = log[-1][0]
+        DocumentUpdate.objects.filter(document_id=document_id, id__lte=last_id).delete()
+        # Cached states end with a log entry that no longer exists
+        transaction.on_commit(lambda: state_cache.delete(document_id))
+        prune_versions([document_id])
+
+    logger.debug(f"Compacted {len(log)} updates into document {document_id}")
+    return len(log)
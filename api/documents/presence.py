@@ -0,0 +1,250 @@
+"""
+Awareness (presence) state of the rooms held by this process.
+
+Clients announce their cursors and selections with Yjs awareness messages,
+often dozens of times a second. Rather than relaying each message to every
+peer, a room keeps the latest awareness state of each client in memory and
+broadcasts everything that changed as one merged update per
+`DOCUMENT_PRESENCE_BROADCAST_INTERVAL_MS`. A client's changes go out at most
+`DOCUMENT_PRESENCE_MAX_UPDATES_PER_SECOND` times a second; in between, only
+its latest state is kept.
+
+Presence is never persisted. The merged updates also reach the room on other
+workers through its group, so each worker can greet joining clients with
+everyone's state. States are removed when their connection closes, and
+states nobody renewed within `DOCUMENT_PRESENCE_TIMEOUT_SECONDS` (e.g. of
+clients on a worker that died) are dropped.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+
+from channels.layers import get_channel_layer
+from ypy_websocket.yutils import Decoder, YMessageType, read_message, write_var_uint
+
+from django.conf import settings
+
+from .metrics import group_send
+
+logger = logging.getLogger("django.channels")
+
+# Identifies the merged updates this process broadcasts
+PROCESS_ID = uuid.uuid4().hex
+
+# Message type clients send to ask for every peer's awareness state
+QUERY_AWARENESS = 3
+
+# Awareness state of a client that left
+NULL_STATE = "null"
+
+# Client ID, clock and JSON state of an entry in an awareness update
+AwarenessEntry = Tuple[int, int, str]
+
+
+class InvalidAwarenessUpdate(ValueError):
+    """
+    Raised when an awareness update can't be decoded
+    """
+
+
+def decode_awareness_update(update: bytes) -> List[AwarenessEntry]:
+    decoder = Decoder(update)
+    entries = []
+    try:
+        for _ in range(decoder.read_var_uint()):
+            client_id = decoder.read_var_uint()
+            clock = decoder.read_var_uint()
+            entries.append((client_id, clock, decoder.read_var_string()))
+    except (IndexError, RuntimeError, UnicodeDecodeError) as exc:
+        raise InvalidAwarenessUpdate(str(exc)) from exc
+    return entries
+
+
+def encode_awareness_update(entries: List[AwarenessEntry]) -> bytes:
+    parts = [write_var_uint(len(entries))]
+    for client_id, clock, state in entries:
+        data = state.encode()
+        parts += [
+            write_var_uint(client_id),
+            write_var_uint(clock),
+            write_var_uint(len(data)),
+            data,
+        ]
+    return b"".join(parts)
+
+
+def read_awareness_message(message: bytes) -> List[AwarenessEntry]:
+    """
+    Decode the entries of an AWARENESS message
+    """
+
+    if len(message) < 2 or message[0] != YMessageType.AWARENESS:
+        raise InvalidAwarenessUpdate("Not an awareness message")
+    return decode_awareness_update(read_message(message[1:]))
+
+
+def create_awareness_message(entries: List[AwarenessEntry]) -> bytes:
+    update = encode_awareness_update(entries)
+    return bytes([YMessageType.AWARENESS]) + write_var_uint(len(update)) + update
+
+
+class Presence:
+    """
+    Awareness states of a room's clients, merged into periodic broadcasts
+    """
+
+    def __init__(self, room_name: str):
+        self.room_name = room_name
+        # Latest clock of every client seen, including those that left
+        self.clocks: Dict[int, int] = {}
+        # States of present clients and when they were last renewed
+        self.states: Dict[int, str] = {}
+        self.renewed_at: Dict[int, float] = {}
+        # Clients announced by each local connection, by channel name
+        self._connections: Dict[str, Set[int]] = {}
+        # Local clients with changes to broadcast, by their connection
+        self._pending: Dict[int, Optional[str]] = {}
+        self._next_send_at: Dict[str, float] = {}
+        self._sequence = 0
+        self._remote_sequences: Dict[str, int] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _apply(self, client_id: int, clock: int, state: str) -> bool:
+        current = self.clocks.get(client_id)
+        # As in y-protocols: newer clocks win, and a client that is known to
+        # have left stays gone until it announces itself with a newer clock
+        if current is not None and (
+            clock < current
+            or (
+                clock == current
+                and not (state == NULL_STATE and client_id in self.states)
+            )
+        ):
+            return False
+
+        self.clocks[client_id] = clock
+        if state == NULL_STATE:
+            self.states.pop(client_id, None)
+            self.renewed_at.pop(client_id, None)
+        else:
+            self.states[client_id] = state
+            self.renewed_at[client_id] = time.monotonic()
+        return True
+
+    def receive(self, channel_name: str, message: bytes):
+        """
+        Record an AWARENESS message sent by a local connection and queue its
+        changes for the next broadcast
+        """
+
+        entries = read_awareness_message(message)
+        clients = self._connections.setdefault(channel_name, set())
+        for client_id, clock, state in entries:
+            if self._apply(client_id, clock, state):
+                clients.add(client_id)
+                self._pending[client_id] = channel_name
+        self._schedule()
+
+    def disconnect(self, channel_name: str):
+        """
+        Remove the states of the clients a closed connection announced
+        """
+
+        for client_id in self._connections.pop(channel_name, set()):
+            if client_id in self.states:
+                self._apply(client_id, self.clocks[client_id] + 1, NULL_STATE)
+                # Removals aren't throttled
+                self._pending[client_id] = None
+        self._next_send_at.pop(channel_name, None)
+        self._schedule()
+
+    def apply_remote(self, origin: str, sequence: int, message: bytes):
+        """
+        Apply a merged update broadcast by another worker. Every local
+        consumer passes it on, but it is only applied once.
+        """
+
+        if origin == PROCESS_ID or sequence <= self._remote_sequences.get(origin, 0):
+            return
+        self._remote_sequences[origin] = sequence
+        for client_id, clock, state in read_awareness_message(message):
+            self._apply(client_id, clock, state)
+
+    def expire(self):
+        """
+        Drop the states that haven't been renewed in time
+        """
+
+        deadline = time.monotonic() - settings.DOCUMENT_PRESENCE_TIMEOUT_SECONDS
+        for client_id, renewed_at in list(self.renewed_at.items()):
+            if renewed_at < deadline:
+                del self.states[client_id]
+                del self.renewed_at[client_id]
+
+    def snapshot_message(self) -> Optional[bytes]:
+        """
+        Awareness message holding the state of every present client, for a
+        client that just joined
+        """
+
+        self.expire()
+        if not self.states:
+            return None
+        return create_awareness_message(
+            [
+                (client_id, self.clocks[client_id], state)
+                for client_id, state in self.states.items()
+            ]
+        )
+
+    def _schedule(self):
+        if self._timer is None and self._pending:
+            self._timer = asyncio.get_running_loop().call_later(
+                settings.DOCUMENT_PRESENCE_BROADCAST_INTERVAL_MS / 1000,
+                lambda: asyncio.ensure_future(self.flush()),
+            )
+
+    async def flush(self):
+        """
+        Broadcast the changes of every local client that isn't being
+        throttled as one merged update
+        """
+
+        self._timer = None
+        now = time.monotonic()
+        ready = [
+            client_id
+            for client_id, channel_name in self._pending.items()
+            if channel_name is None or self._next_send_at.get(channel_name, 0) <= now
+        ]
+        if ready:
+            entries = []
+            for client_id in ready:
+                channel_name = self._pending.pop(client_id)
+                if channel_name is not None:
+                    self._next_send_at[channel_name] = (
+                        now + 1 / settings.DOCUMENT_PRESENCE_MAX_UPDATES_PER_SECOND
+                    )
+                entries.append(
+                    (
+                        client_id,
+                        self.clocks[client_id],
+                        self.states.get(client_id, NULL_STATE),
+                    )
+                )
+
+            self._sequence += 1
+            await group_send(
+                get_channel_layer(),
+                self.room_name,
+                {
+                    "type": "broadcast_presence",
+                    "message": create_awareness_message(entries),
+                    "origin": PROCESS_ID,
+                    "sequence": self._sequence,
+                },
+            )
+        self._schedule()
@@ -0,0 +1,243 @@
+"""
+Readable renderings (HTML, Markdown, plain text) of a document's content.
+
+Renderers walk the document tree and yield their output block by block, and
+`render_chunks` groups it into chunks of about `CHUNK_SIZE` bytes, so a
+rendering is never held in memory as a whole. Nodes are named after the
+TipTap extensions the editor uses; unknown elements are rendered through
+their children.
+"""
+
+import asyncio
+import hashlib
+import html
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, List
+
+import y_py as Y
+
+from django.db.models import Max
+from django.utils.http import quote_etag
+
+from .models import Document, DocumentUpdate
+from .text import TEXT_ROOTS, XML_ROOTS, XmlNode, iter_children, render_node
+
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    "html": "text/html; charset=utf-8",
+    "md": "text/markdown; charset=utf-8",
+    "txt": "text/plain; charset=utf-8",
+}
+
+HTML_TAGS = {
+    "paragraph": "p",
+    "bulletList": "ul",
+    "orderedList": "ol",
+    "listItem": "li",
+    "blockquote": "blockquote",
+}
+
+
+def inline_text(element: Y.YXmlElement, hard_break: str = "\n") -> str:
+    """
+    Text of an element holding inline content, such as a paragraph
+    """
+
+    parts = []
+    for child in iter_children(element):
+        if isinstance(child, Y.YXmlText):
+            parts.append(str(child))
+        elif child.name == "hardBreak":
+            parts.append(hard_break)
+        else:
+            parts.append(inline_text(child, hard_break))
+    return "".join(parts)
+
+
+def heading_level(element: Y.YXmlElement) -> int:
+    try:
+        level = int(element.get_attribute("level"))
+    except (TypeError, ValueError):
+        return 1
+    return min(max(level, 1), 6)
+
+
+def render_html(node: XmlNode) -> Iterator[str]:
+    if isinstance(node, Y.YXmlText):
+        yield html.escape(str(node))
+        return
+
+    name = node.name
+    if name == "heading":
+        level = heading_level(node)
+        yield f"<h{level}>{html.escape(inline_text(node))}</h{level}>\n"
+    elif name == "codeBlock":
+        language = node.get_attribute("language")
+        attributes = f' class="language-{html.escape(language)}"' if language else ""
+        yield f"<pre><code{attributes}>{html.escape(inline_text(node))}</code></pre>\n"
+    elif name == "horizontalRule":
+        yield "<hr>\n"
+    elif name == "hardBreak":
+        yield "<br>"
+    elif name in HTML_TAGS:
+        tag = HTML_TAGS[name]
+        yield f"<{tag}>"
+        for child in iter_children(node):
+            yield from render_html(child)
+        yield f"</{tag}>\n"
+    else:
+        for child in iter_children(node):
+            yield from render_html(child)
+
+
+def render_markdown(node: XmlNode, prefix: str = "") -> Iterator[str]:
+    """
+    Render a block as Markdown, starting each of its lines with `prefix`
+    """
+
+    if isinstance(node, Y.YXmlText):
+        yield prefixed(str(node), prefix) + "\n\n"
+        return
+
+    name = node.name
+    if name == "heading":
+        yield f"{prefix}{'#' * heading_level(node)} {inline_text(node, ' ')}\n\n"
+    elif name == "paragraph":
+        yield prefixed(inline_text(node, "  \n"), prefix) + "\n\n"
+    elif name == "codeBlock":
+        fence = f"{prefix}```"
+        language = node.get_attribute("language") or ""
+        yield f"{fence}{language}\n{prefixed(inline_text(node), prefix)}\n{fence}\n\n"
+    elif name == "horizontalRule":
+        yield f"{prefix}---\n\n"
+    elif name == "blockquote":
+        for child in iter_children(node):
+            yield from render_markdown(child, prefix + "> ")
+    elif name in ("bulletList", "orderedList"):
+        number = 1
+        if name == "orderedList":
+            try:
+                number = int(node.get_attribute("start") or 1)
+            except ValueError:
+                pass
+        for item in iter_children(node):
+            marker = f"{number}. " if name == "orderedList" else "- "
+            number += 1
+            indent = prefix + " " * len(marker)
+            first = True
+            for child in iter_children(item):
+                for block in render_markdown(child, indent):
+                    if first:
+                        # The item's first line carries the list marker
+                        block = prefix + marker + block[len(indent) :]  # noqa: E203
+                        first = False
+                    yield block
+    else:
+        for child in iter_children(node):
+            yield from render_markdown(child, prefix)
+
+
+def prefixed(text: str, prefix: str) -> str:
+    return "\n".join(prefix + line for line in text.split("\n"))
+
+
+def render_text_root(text: str, format: str) -> Iterator[str]:
+    for line in text.split("\n"):
+        if not line:
+            continue
+        if format == "html":
+            yield f"<p>{html.escape(line)}</p>\n"
+        elif format == "md":
+            yield f"{line}\n\n"
+        else:
+            yield f"{line}\n"
+
+
+def render_document(ydoc: Y.YDoc, format: str, title: str) -> Iterator[str]:
+    """
+    Render a document in the given format, one block at a time
+    """
+
+    if format == "html":
+        yield (
+            '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            f"<title>{html.escape(title)}</title>\n</head>\n<body>\n"
+        )
+
+    for name in XML_ROOTS:
+        for block in iter_children(ydoc.get_xml_element(name)):
+            if format == "html":
+                yield from render_html(block)
+            elif format == "md":
+                yield from render_markdown(block)
+            else:
+                text = render_node(block)
+                if text:
+                    yield text + "\n"
+
+    for name in TEXT_ROOTS:
+        yield from render_text_root(str(ydoc.get_text(name)), format)
+
+    if format == "html":
+        yield "</body>\n</html>\n"
+
+
+def render_chunks(updates: List[bytes], format: str, title: str) -> Iterator[bytes]:
+    """
+    Decode a document from its updates and render it in chunks of encoded
+    output. The document is bound to the thread this runs on.
+    """
+
+    ydoc = Y.YDoc()
+    for update in updates:
+        Y.apply_update(ydoc, update)
+
+    parts = []
+    size = 0
+    for part in render_document(ydoc, format, title):
+        data = part.encode()
+        parts.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b"".join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield b"".join(parts)
+
+
+async def iterate_in_thread(
+    make_iterator: Callable[..., Iterator[bytes]], *args
+) -> AsyncIterator[bytes]:
+    """
+    Pull the items of a synchronous iterator from a thread of its own, so
+    the event loop isn't blocked and a YDoc it creates stays on one thread
+    """
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+    loop = asyncio.get_running_loop()
+    try:
+        iterator = await loop.run_in_executor(executor, make_iterator, *args)
+        while True:
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        executor.shutdown(wait=False)
+
+
+def get_export_etag(document: Document, format: str) -> str:
+    """
+    ETag of a rendering, derived without loading the document's state. Every
+    save touches the document's `updated_at` and appends to its update log.
+    """
+
+    latest_update = DocumentUpdate.objects.filter(document=document).aggregate(
+        id=Max("id")
+    )["id"]
+    key = (
+        f"{document.id}|{document.updated_at}|{latest_update}|{format}|{document.title}"
+    )
+    return quote_etag(hashlib.md5(key.encode()).hexdigest())
@@ -0,0 +1,362 @@
+import asyncio
+import logging
+import math
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import y_py as Y
+
+from .broadcast import EMPTY_UPDATE, UpdateBatcher
+from .crdt import advance_state_vector, crdt_executor
+from .metrics import yjs_updates
+from .presence import Presence
+from .text import TextExtractor
+
+logger = logging.getLogger("django.channels")
+
+# Time constant of the rooms' update rates, which average over roughly the
+# last this many seconds
+UPDATE_RATE_SECONDS = 60
+
+
+def get_room_name(document_id: str) -> str:
+    """
+    Sanitize the document ID into a valid channel group name
+    """
+
+    return re.sub(r"[^a-zA-Z0-9]", "_", document_id)
+
+
+class Room:
+    """
+    In-memory state of a document shared by every consumer connected to it
+    within the current process
+    """
+
+    def __init__(
+        self,
+        name: str,
+        document_id: str,
+        ydoc: Y.YDoc,
+        on_change: Optional[Callable[["Room"], None]] = None,
+        saved_state: Optional[bytes] = None,
+        saved_log_id: int = 0,
+    ):
+        self.name = name
+        self.document_id = document_id
+        self.ydoc = ydoc
+        self.state_modified = False
+        self.saved_state_vector = Y.encode_state_vector(ydoc)
+        # Encoded state as of the last save, if tracked, so that saves can
+        # encode the full state off the event loop, see documents.crdt
+        self.saved_state = saved_state
+        # ID of the newest update log entry the saved state includes, along
+        # with every entry before it, see documents.persistence.append_updates
+        self.saved_log_id = saved_log_id
+        self.text = TextExtractor(ydoc)
+        self.batcher = UpdateBatcher(name, ydoc)
+        self.presence = Presence(name)
+        self.saved_text: Optional[str] = None
+        self.title: Optional[str] = None
+        self.pending_title: Optional[str] = None
+        # User who last changed the document or its title, credited on save
+        self.last_editor_id: Optional[int] = None
+        self.connections = 0
+        self.on_change = on_change
+        # Whether this worker persists the room, see documents.ownership
+        self.owned = True
+        self.owner_channel: Optional[str] = None
+        # When this worker last forwarded an update to the owner that it hasn't
+        # since seen the owner alive to receive, see documents.ownership
+        self.forwarded_at: Optional[float] = None
+        # Approximate memory footprint, tracked as the encoded size of the
+        # state as of the last save or load plus the changes made since
+        if saved_state is None:
+            saved_state = Y.encode_state_as_update(ydoc)
+        self._saved_size = len(saved_state)
+        self._unsaved_size = 0
+        self._saving_sizes = (0, 0)
+        self.last_active = time.monotonic()
+        # Updates made to the document since it was loaded, for monitoring
+        self.update_bytes = 0
+        self._update_rate = 0.0
+        self._update_rate_at = self.last_active
+        self._catching_up = False
+        self._persisted_update_id: Optional[str] = None
+
+        ydoc.observe_after_transaction(self.on_update_event)
+
+    def on_update_event(self, event):
+        # Read-only transactions (e.g. encoding the state) also fire this event
+        update = event.get_update()
+        if update == EMPTY_UPDATE or self._catching_up:
+            return
+
+        self._unsaved_size += len(update)
+        self.update_bytes += len(update)
+        yjs_updates.inc()
+        self.touch()
+        self._update_rate = self.update_rate(self.last_active) + 1 / UPDATE_RATE_SECONDS
+        self._update_rate_at = self.last_active
+        if not self.owned:
+            # The owner persists the change; this worker's clients' changes
+            # are forwarded to it, see documents.ownership
+            return
+        self.state_modified = True
+        if self.on_change is not None:
+            self.on_change(self)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._saved_size + self._unsaved_size
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def update_rate(self, now: float) -> float:
+        """
+        Exponentially weighted average of the updates made per second
+        """
+
+        elapsed = now - self._update_rate_at
+        return self._update_rate * math.exp(-elapsed / UPDATE_RATE_SECONDS)
+
+    def _apply_persisted(self, update: bytes):
+        self._catching_up = True
+        try:
+            Y.apply_update(self.ydoc, update)
+        finally:
+            self._catching_up = False
+
+    def catch_up(self, state: bytes, log_id: int = 0):
+        """
+        Apply the stored state, including the update log up to `log_id`, with
+        changes persisted elsewhere while the room sat idle, without treating
+        them as unsaved changes
+        """
+
+        self._apply_persisted(state)
+
+        self._saved_size = len(state)
+        if not self.state_modified:
+            # Everything the room had was saved, so it now holds the stored state
+            self.saved_state_vector = Y.encode_state_vector(self.ydoc)
+            if self.saved_state is not None:
+                self.saved_state = state
+                self.saved_log_id = log_id
+            self._unsaved_size = 0
+
+    async def apply_persisted_update(self, update_id: str, update: bytes) -> bool:
+        """
+        Apply an update that was already persisted outside the room (e.g.
+        through the REST sync endpoint) without treating it as an unsaved
+        change. Every local consumer passes it on, but it is only applied
+        once.
+
+        Returns False if the update was already applied.
+        """
+
+        if update_id == self._persisted_update_id:
+            return False
+        self._persisted_update_id = update_id
+
+        saved_state = self.saved_state
+        if saved_state is not None:
+            merged = await crdt_executor.merge([saved_state, update])
+
+        before = Y.encode_state_vector(self.ydoc)
+        self._apply_persisted(update)
+        if self.saved_state is saved_state:
+            # Count the update as saved, so the next flush doesn't write it again
+            self.saved_state_vector = advance_state_vector(
+                self.saved_state_vector, before, Y.encode_state_vector(self.ydoc)
+            )
+            if saved_state is not None:
+                # The update's log entry may not directly follow the saved
+                # log ID, which is left as is
+                self.saved_state = merged
+                self._saved_size = len(merged)
+            else:
+                self._saved_size += len(update)
+        # Otherwise a flush replaced the saved state while the update was being
+        # merged; the update is then beyond the saved state vector and merely
+        # written again with the room's next changes
+        return True
+
+    def take_unsaved_changes(self) -> Tuple[bytes, bytes]:
+        """
+        Encode everything that changed since the last save as a single update.
+
+        Returns the update and the state vector to pass to `mark_saved` once
+        it has been persisted.
+        """
+
+        self.state_modified = False
+        update = Y.encode_state_as_update(self.ydoc, self.saved_state_vector)
+        self._saving_sizes = (len(update), self._unsaved_size)
+        return update, Y.encode_state_vector(self.ydoc)
+
+    def mark_saved(
+        self,
+        state_vector: bytes,
+        state: Optional[bytes] = None,
+        log_id: Optional[int] = None,
+    ):
+        """
+        Record that the changes taken with `take_unsaved_changes` were saved,
+        along with the resulting state if it is tracked and, if the state was
+        cached, the ID of the log entry it now ends with
+        """
+
+        self.saved_state_vector = state_vector
+        update_size, unsaved_size = self._saving_sizes
+        if state is not None:
+            self.saved_state = state
+            self._saved_size = len(state)
+            if log_id is not None:
+                self.saved_log_id = log_id
+        else:
+            # The saved changes as a single update, rather than every edit
+            self._saved_size += update_size
+        # Changes made while the save was running are still unsaved
+        self._unsaved_size = max(self._unsaved_size - unsaved_size, 0)
+
+    def mark_unsaved(self):
+        """
+        Flag the room as modified again after a failed save
+        """
+
+        self.state_modified = True
+
+    def set_title(self, title: str) -> bool:
+        """
+        Record a new title to be persisted with the next save.
+
+        Returns False if the title is unchanged.
+        """
+
+        if title == self.title:
+            return False
+        self.title = self.pending_title = title
+        return True
+
+
+class RoomRegistry:
+    """
+    Process-wide registry of rooms keyed by room name.
+
+    Each room is loaded once and shared by all local consumers. When the last
+    of them leaves the room stays resident, idle, until it is evicted.
+    """
+
+    def __init__(self):
+        self._rooms: Dict[str, Room] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiters: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def _room_lock(self, name: str):
+        """
+        Serialize loading and releasing of a single room. The lock is dropped
+        once nobody holds or waits for it and the room is gone.
+        """
+
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        self._waiters[name] = self._waiters.get(name, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[name] -= 1
+            if self._waiters[name] == 0 and name not in self._rooms:
+                del self._waiters[name]
+                del self._locks[name]
+
+    def get(self, name: str) -> Optional[Room]:
+        return self._rooms.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._rooms
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    def rooms(self) -> List[Room]:
+        return list(self._rooms.values())
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(room.size_bytes for room in self._rooms.values())
+
+    async def acquire(
+        self,
+        name: str,
+        load: Callable[[], Awaitable[Room]],
+        refresh: Optional[Callable[[Room], Awaitable[None]]] = None,
+    ) -> Room:
+        """
+        Return the room for the given name, loading it with `load` if it isn't
+        resident. An idle room is passed to `refresh` first, since it may have
+        missed changes made while nobody here had it open.
+        """
+
+        async with self._room_lock(name):
+            room = self._rooms.get(name)
+            if room is None:
+                room = await load()
+                self._rooms[name] = room
+                logger.debug(f"Loaded room {name}")
+            elif room.connections == 0 and refresh is not None:
+                await refresh(room)
+            room.connections += 1
+            room.touch()
+            return room
+
+    async def release(
+        self,
+        name: str,
+        on_empty: Optional[Callable[[Room], Awaitable[None]]] = None,
+    ):
+        """
+        Drop a consumer's reference to the room. When the last local consumer
+        leaves, `on_empty` is awaited and the room becomes idle.
+        """
+
+        async with self._room_lock(name):
+            room = self._rooms.get(name)
+            if room is None:
+                return
+            room.connections -= 1
+            room.touch()
+            if room.connections > 0:
+                return
+            if on_empty is not None:
+                await on_empty(room)
+            logger.debug(f"Room {name} is idle")
+
+    async def evict(self, name: str) -> bool:
+        """
+        Discard an idle room. Returns False if the room is gone, in use or
+        still has unsaved changes, including ones forwarded to an owner that
+        may not have received them.
+        """
+
+        async with self._room_lock(name):
+            room = self._rooms.get(name)
+            if (
+                room is None
+                or room.connections > 0
+                or room.state_modified
+                or room.forwarded_at is not None
+            ):
+                return False
+            del self._rooms[name]
+            logger.debug(f"Evicted room {name}")
+            return True
+
+
+room_registry = RoomRegistry()
@@ -0,0 +1,63 @@
+from typing import Iterable
+
+from django.contrib.postgres.search import (
+    SearchHeadline,
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+)
+from django.db import connection
+from django.db.models import F
+
+from .models import Document
+
+SEARCH_CONFIG = "english"
+
+
+def document_search_vector() -> SearchVector:
+    """
+    Weighted search vector over a document's title and readable content
+    """
+
+    return SearchVector("title", weight="A", config=SEARCH_CONFIG) + SearchVector(
+        "readable_content", weight="B", config=SEARCH_CONFIG
+    )
+
+
+def update_search_vectors(document_ids: Iterable):
+    """
+    Recompute the stored search vector of the given documents
+    """
+
+    # Full-text search relies on Postgres; other backends (e.g. SQLite for
+    # local benchmarks) simply skip indexing
+    if connection.vendor != "postgresql":
+        return
+
+    Document.objects.filter(id__in=list(document_ids)).update(
+        search_vector=document_search_vector()
+    )
+
+
+def search_documents(queryset, terms: str):
+    """
+    Filter documents matching the search terms, best matches first, annotated
+    with their rank and a highlighted snippet
+    """
+
+    query = SearchQuery(terms, config=SEARCH_CONFIG, search_type="websearch")
+    return (
+        queryset.filter(search_vector=query)
+        .annotate(
+            rank=SearchRank(F("search_vector"), query),
+            snippet=SearchHeadline(
+                "readable_content",
+                query,
+                config=SEARCH_CONFIG,
+                max_words=35,
+                min_words=15,
+                max_fragments=2,
+            ),
+        )
+        .order_by("-rank", "-updated_at", "-id")
+    )
@@ -1,9 +1,112 @@
+import base64
+import binascii
+
 from rest_framework import serializers
 
-from .models import Document
+from .models import Document, DocumentVersion
 
 
 class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
-        exclude = ["content"]  # Avoid returning binary data to the client
+        # Avoid returning binary data to the client
+        exclude = ["content", "search_vector"]
+
+
+class DocumentListSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Document
+        # Listings carry metadata only, not every document's full text
+        exclude = ["content", "readable_content", "search_vector"]
+
+
+class DocumentSearchResultSerializer(serializers.ModelSerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = Document
+        fields = ["id", "title", "created_at", "updated_at", "rank", "snippet"]
+
+
+class DocumentSummarySerializer(serializers.ModelSerializer):
+    """
+    Document metadata for the dashboard. Summary fields are null until the
+    document is first saved.
+    """
+
+    snippet = serializers.CharField(source="summary.snippet", read_only=True)
+    word_count = serializers.IntegerField(source="summary.word_count", read_only=True)
+    character_count = serializers.IntegerField(
+        source="summary.character_count", read_only=True
+    )
+    last_editor = serializers.CharField(
+        source="summary.last_editor.username", read_only=True
+    )
+    last_activity_at = serializers.DateTimeField(
+        source="summary.last_activity_at", read_only=True
+    )
+
+    class Meta:
+        model = Document
+        fields = [
+            "id",
+            "title",
+            "created_at",
+            "updated_at",
+            "snippet",
+            "word_count",
+            "character_count",
+            "last_editor",
+            "last_activity_at",
+        ]
+
+
+class Base64BinaryField(serializers.Field):
+    default_error_messages = {"invalid": "Expected base64-encoded binary data."}
+
+    def to_internal_value(self, data):
+        if not isinstance(data, str):
+            self.fail("invalid")
+        try:
+            return base64.b64decode(data, validate=True)
+        except binascii.Error:
+            self.fail("invalid")
+
+    def to_representation(self, value):
+        return base64.b64encode(value).decode()
+
+
+class DocumentSyncSerializer(serializers.Serializer):
+    """
+    Payload exchanged by clients catching up over HTTP. Clients send their
+    state vector and pending updates and receive the diff they are missing.
+    """
+
+    state_vector = Base64BinaryField(required=False)
+    updates = serializers.ListField(
+        child=Base64BinaryField(),
+        required=False,
+        default=list,
+        max_length=1000,
+        write_only=True,
+    )
+    update = Base64BinaryField(read_only=True)
+
+
+class DocumentVersionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DocumentVersion
+        fields = ["number", "is_snapshot", "created_at"]
+
+
+class DocumentVersionStateSerializer(DocumentVersionSerializer):
+    """
+    A version along with the full document state at that point
+    """
+
+    state = Base64BinaryField(read_only=True)
+    readable_content = serializers.CharField(read_only=True)
+
+    class Meta(DocumentVersionSerializer.Meta):
+        fields = DocumentVersionSerializer.Meta.fields + ["state", "readable_content"]
@@ -0,0 +1,89 @@
+"""
+Cache of encoded document states, kept in Redis next to the channel layer.
+
+An entry holds a document's full state, its state vector and the ID of the
+newest `DocumentUpdate` it includes. Readers replay the log entries from that
+ID onwards on top of it, so entries written by other workers since are not
+missed, and they only need the document's update log rather than its stored
+snapshot. Once compaction removes that log entry, the entry can no longer be
+trusted and readers fall back to the database.
+
+A saved state is only written through if the saving room's state includes
+every log entry before its own; with several workers saving the same
+document, the others' entries may be missing from it. Such saves invalidate
+the entry instead, see `documents.persistence.append_updates`.
+
+Entries are written through on save and expire after
+`DOCUMENT_STATE_CACHE_SECONDS`; Redis may also evict them under memory
+pressure. Cache errors are logged and treated as misses.
+"""
+
+import logging
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .codec import decode_content, encode_content
+
+logger = logging.getLogger(__name__)
+
+# Alias of the cache in CACHES
+CACHE_ALIAS = "documents"
+KEY_PREFIX = "document-state:"
+
+
+class CachedState(NamedTuple):
+    state: bytes
+    state_vector: bytes
+    # ID of the newest update log entry included in the state
+    log_id: int
+
+
+class DocumentStateCache:
+    @property
+    def enabled(self) -> bool:
+        return settings.DOCUMENT_STATE_CACHE_ENABLED
+
+    @property
+    def cache(self):
+        return caches[CACHE_ALIAS]
+
+    def _key(self, document_id) -> str:
+        return f"{KEY_PREFIX}{document_id}"
+
+    def get(self, document_id) -> Optional[CachedState]:
+        if not self.enabled:
+            return None
+        try:
+            entry = self.cache.get(self._key(document_id))
+        except Exception:
+            logger.warning("Failed to read document state cache", exc_info=True)
+            return None
+        if entry is None:
+            return None
+        state, state_vector, log_id = entry
+        return CachedState(decode_content(state), state_vector, log_id)
+
+    def set(self, document_id, state: bytes, state_vector: bytes, log_id: int):
+        if not self.enabled:
+            return
+        try:
+            self.cache.set(
+                self._key(document_id),
+                (encode_content(state), state_vector, log_id),
+                settings.DOCUMENT_STATE_CACHE_SECONDS,
+            )
+        except Exception:
+            logger.warning("Failed to write document state cache", exc_info=True)
+
+    def delete(self, document_id):
+        if not self.enabled:
+            return
+        try:
+            self.cache.delete(self._key(document_id))
+        except Exception:
+            logger.warning("Failed to invalidate document state cache", exc_info=True)
+
+
+state_cache = DocumentStateCache()
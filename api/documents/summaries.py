@@ -0,0 +1,70 @@
+import hashlib
+import re
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from django.db.models import Count, Max
+from django.utils.http import quote_etag
+
+from .models import Document, DocumentSummary
+
+SNIPPET_MAX_CHARS = 280
+
+
+def summarize_text(text: str) -> Dict:
+    """
+    Snippet and counts of a document's readable content
+    """
+
+    collapsed = " ".join(text.split())
+    snippet = collapsed
+    if len(snippet) > SNIPPET_MAX_CHARS:
+        snippet = snippet[: SNIPPET_MAX_CHARS - 1].rsplit(" ", 1)[0] + "…"
+    return {
+        "snippet": snippet,
+        "word_count": len(re.findall(r"\w+", text)),
+        "character_count": len(text),
+    }
+
+
+def update_summaries(document_ids: Iterable, texts: Dict, editors: Dict, now: datetime):
+    """
+    Record activity on the given documents, along with the new content summary
+    of those in `texts` and the last editor of those in `editors`
+    """
+
+    # Upsert in groups sharing the fields to overwrite, so that a summary
+    # keeps its snippet when the text didn't change and its last editor when
+    # the editor isn't known
+    groups: Dict[Tuple[str, ...], List[DocumentSummary]] = {}
+    for document_id in document_ids:
+        summary = DocumentSummary(document_id=document_id, last_activity_at=now)
+        fields = ["last_activity_at"]
+        if document_id in texts:
+            for field, value in summarize_text(texts[document_id]).items():
+                setattr(summary, field, value)
+                fields.append(field)
+        if editors.get(document_id) is not None:
+            summary.last_editor_id = editors[document_id]
+            fields.append("last_editor")
+        groups.setdefault(tuple(fields), []).append(summary)
+
+    for fields, summaries in groups.items():
+        DocumentSummary.objects.bulk_create(
+            summaries,
+            update_conflicts=True,
+            unique_fields=["document"],
+            update_fields=list(fields),
+        )
+
+
+def get_summaries_etag(full_path: str) -> str:
+    """
+    ETag of the document summaries listing at the given path. Every change to
+    a summary also touches its document, so the newest `updated_at` and the
+    number of documents change whenever the listing does.
+    """
+
+    state = Document.objects.aggregate(latest=Max("updated_at"), count=Count("id"))
+    key = f"{state['latest']}|{state['count']}|{full_path}"
+    return quote_etag(hashlib.md5(key.encode()).hexdigest())
@@ -1,3 +1,1510 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import BrokenExecutor, Executor
+from datetime import timedelta
+from typing import List
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+import y_py as Y
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from fakeredis import FakeAsyncRedis, FakeServer
+from rest_framework.test import APIClient
+from ypy_websocket.yutils import (
+    YMessageType,
+    YSyncMessageType,
+    create_sync_step1_message,
+    create_update_message,
+    read_message,
+)
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from minidoc_api.routing import websocket_urlpatterns
+
+from .autosave import WriteBehind, write_behind
+from .broadcast import UpdateBatcher
+from .codec import CODEC_RAW, CODEC_ZLIB, MAGIC, decode_content, encode_content
+from .consumers import RESYNC_CLOSE_CODE, DocumentConsumer
+from .control import (
+    CONTROL_MESSAGE_TYPE,
+    JSON,
+    MSGPACK,
+    InvalidControlFrame,
+    broadcast_frame,
+    decode_control_frame,
+    encode_control_frame,
+    encode_event,
+    get_control_format,
+    is_control_frame,
+    make_broadcast,
+)
+from .crdt import CrdtExecutor, merge_updates
+from .lifecycle import RoomLifecycle
+from .models import Document, DocumentUpdate, DocumentVersion
+from .outbound import OutboundQueue
+from .ownership import LEASE_KEY_PREFIX, RoomOwnership
+from .persistence import (
+    append_updates,
+    compact_document,
+    get_version_state,
+    load_cached_state,
+    load_existing_state,
+    load_room_state,
+    prune_versions,
+    sync_document_state,
+)
+from .presence import (
+    PROCESS_ID,
+    Presence,
+    create_awareness_message,
+    read_awareness_message,
+)
+from .rooms import UPDATE_RATE_SECONDS, Room, RoomRegistry, get_room_name
+from .state_cache import state_cache
+
+# Keep tests off Redis and other workers, and merge CRDT updates in-process
+test_settings = override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "documents": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "documents",
+        },
+    },
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    DOCUMENT_ROOM_OWNERSHIP_ENABLED=False,
+    DOCUMENT_CRDT_EXECUTOR="inline",
+)
+
+
+def insert_text(ydoc: Y.YDoc, text: str) -> bytes:
+    """
+    Append text to the document's content and return the resulting update
+    """
+
+    state_vector = Y.encode_state_vector(ydoc)
+    content = ydoc.get_text("content")
+    with ydoc.begin_transaction() as txn:
+        content.extend(txn, text)
+    return Y.encode_state_as_update(ydoc, state_vector)
+
+
+def read_text(updates: List[bytes]) -> str:
+    ydoc = Y.YDoc()
+    for update in updates:
+        Y.apply_update(ydoc, update)
+    return str(ydoc.get_text("content"))
+
+
+def create_document(*edits: str, title: str = "Untitled") -> Document:
+    """
+    Create a document and save each edit to its update log, one save each
+    """
+
+    document = Document.objects.create(title=title)
+    ydoc = Y.YDoc()
+    for text in edits:
+        append_updates({str(document.id): [insert_text(ydoc, text)]})
+    return document
+
+
+@test_settings
+class CodecTests(SimpleTestCase):
+    def test_round_trip(self):
+        values = [
+            b"",
+            b"\x01\x02small",
+            b"compressible " * 500,
+            os.urandom(4096),
+        ]
+        for value in values:
+            with self.subTest(size=len(value)):
+                self.assertEqual(decode_content(encode_content(value)), value)
+
+    def test_compresses_large_values(self):
+        value = b"compressible " * 500
+        encoded = encode_content(value)
+        self.assertEqual(encoded[: len(MAGIC) + 1], MAGIC + bytes([CODEC_ZLIB]))
+        self.assertLess(len(encoded), len(value))
+
+    def test_leaves_small_and_incompressible_values_raw(self):
+        small = b"\x01\x02small"
+        random = os.urandom(4096)
+        self.assertEqual(encode_content(small), small)
+        self.assertEqual(encode_content(random), random)
+
+    def test_wraps_raw_values_that_start_with_the_header(self):
+        value = MAGIC + bytes([CODEC_ZLIB]) + b"not compressed"
+        encoded = encode_content(value)
+        self.assertEqual(encoded[: len(MAGIC) + 1], MAGIC + bytes([CODEC_RAW]))
+        self.assertEqual(decode_content(encoded), value)
+
+    def test_reads_legacy_raw_values(self):
+        update = insert_text(Y.YDoc(), "legacy")
+        self.assertEqual(decode_content(update), update)
+        # Written before the codec existed and merely colliding with the header
+        legacy = MAGIC + bytes([CODEC_ZLIB]) + b"not zlib data"
+        with self.assertLogs("documents.codec", "WARNING"):
+            self.assertEqual(decode_content(legacy), legacy)
+        self.assertEqual(
+            decode_content(MAGIC + bytes([CODEC_ZLIB]) + zlib.compress(update)),
+            update,
+        )
+
+
+def thread_name(*args) -> str:
+    return threading.current_thread().name
+
+
+# Applied after test_settings, which keeps CRDT work inline
+@override_settings(DOCUMENT_CRDT_EXECUTOR="thread", DOCUMENT_CRDT_OFFLOAD_MIN_BYTES=100)
+@test_settings
+class CrdtExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = CrdtExecutor()
+        self.addCleanup(
+            lambda: self.executor._executor and self.executor._executor.shutdown()
+        )
+
+    def test_offloads_large_work(self):
+        async def run():
+            return [
+                await self.executor.run(thread_name, size=99),
+                await self.executor.run(thread_name, size=100),
+            ]
+
+        small, large = asyncio.run(run())
+        self.assertEqual(small, threading.current_thread().name)
+        self.assertTrue(large.startswith("crdt"))
+
+    @override_settings(DOCUMENT_CRDT_EXECUTOR="inline")
+    def test_inline_mode_never_offloads(self):
+        name = asyncio.run(self.executor.run(thread_name, size=10**9))
+        self.assertEqual(name, threading.current_thread().name)
+
+    def test_falls_back_to_inline_when_the_executor_breaks(self):
+        broken = mock.Mock(spec=Executor)
+        broken.submit.side_effect = BrokenExecutor
+        self.executor._executor = broken
+        ydoc = Y.YDoc()
+        updates = [insert_text(ydoc, "x" * 100), insert_text(ydoc, "y")]
+
+        with self.assertLogs("django.channels", "ERROR"):
+            merged = asyncio.run(self.executor.merge(updates))
+
+        self.assertEqual(read_text([merged]), "x" * 100 + "y")
+        # The next call starts a new pool
+        self.assertIsNone(self.executor._executor)
+        name = asyncio.run(self.executor.run(thread_name, size=100))
+        self.assertTrue(name.startswith("crdt"))
+
+
+@test_settings
+class CompactionTests(TestCase):
+    def test_merges_log_into_snapshot(self):
+        document = create_document("one ", "two ", "three")
+        self.assertEqual(DocumentUpdate.objects.filter(document=document).count(), 3)
+
+        self.assertEqual(compact_document(str(document.id)), 3)
+
+        self.assertFalse(DocumentUpdate.objects.filter(document=document).exists())
+        document.refresh_from_db()
+        self.assertEqual(read_text([bytes(document.content)]), "one two three")
+        self.assertEqual(
+            read_text(load_existing_state(str(document.id))), "one two three"
+        )
+
+    def test_keeps_edits_saved_after_compaction(self):
+        document = create_document("one ")
+        compact_document(str(document.id))
+        ydoc = Y.YDoc()
+        for update in load_existing_state(str(document.id)):
+            Y.apply_update(ydoc, update)
+        append_updates({str(document.id): [insert_text(ydoc, "two")]})
+
+        self.assertEqual(read_text(load_existing_state(str(document.id))), "one two")
+        self.assertEqual(compact_document(str(document.id)), 1)
+        self.assertEqual(compact_document(str(document.id)), 0)
+        self.assertEqual(read_text(load_existing_state(str(document.id))), "one two")
+
+    @override_settings(DOCUMENT_UPDATE_LOG_MAX_COUNT=2)
+    def test_reports_documents_due_for_compaction(self):
+        document = create_document("one ")
+        ydoc = Y.YDoc()
+        Y.apply_update(ydoc, load_existing_state(str(document.id))[0])
+
+        needs_compaction, missing, _ = append_updates(
+            {str(document.id): [insert_text(ydoc, "two")]}
+        )
+        self.assertEqual(needs_compaction, {str(document.id)})
+        self.assertEqual(missing, set())
+
+    def test_reports_missing_documents(self):
+        document_id = str(uuid.uuid4())
+        _, missing, _ = append_updates({document_id: [insert_text(Y.YDoc(), "lost")]})
+        self.assertEqual(missing, {document_id})
+        self.assertFalse(DocumentUpdate.objects.exists())
+
+
+@test_settings
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("reader"))
+        now = timezone.now()
+        self.documents = [Document.objects.create(title=f"Doc {i}") for i in range(5)]
+        # Two documents share a timestamp, so the cursor has to break the tie
+        for i, document in enumerate(self.documents):
+            Document.objects.filter(id=document.id).update(
+                updated_at=now - timedelta(minutes=min(i, 3))
+            )
+
+    def expected_order(self) -> List[str]:
+        return [
+            str(document_id)
+            for document_id in Document.objects.order_by(
+                "-updated_at", "-id"
+            ).values_list("id", flat=True)
+        ]
+
+    def test_pages_cover_every_document_once(self):
+        seen = []
+        url = "/documents/?limit=2"
+        pages = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(document["id"] for document in response.data["results"])
+            url = response.data["next"]
+            pages += 1
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, self.expected_order())
+
+    def test_list_is_unpaginated_without_parameters(self):
+        response = self.client.get("/documents/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([d["id"] for d in response.data], self.expected_order())
+        self.assertNotIn("readable_content", response.data[0])
+        self.assertNotIn("content", response.data[0])
+
+    def test_rejects_invalid_cursor(self):
+        response = self.client.get("/documents/?cursor=not-a-cursor")
+        self.assertEqual(response.status_code, 404)
+
+
+@test_settings
+@override_settings(
+    DOCUMENT_VERSION_SNAPSHOT_INTERVAL=3, DOCUMENT_VERSION_MIN_INTERVAL_SECONDS=0
+)
+class VersionTests(TestCase):
+    edits = ["a", "b", "c", "d", "e", "f", "g"]
+
+    def test_reconstructs_every_version(self):
+        document = create_document(*self.edits)
+
+        versions = DocumentVersion.objects.filter(document=document).order_by("number")
+        self.assertEqual(
+            [version.number for version in versions],
+            list(range(1, len(self.edits) + 1)),
+        )
+        self.assertEqual(
+            [version.number for version in versions if version.is_snapshot], [1, 4, 7]
+        )
+        for number in range(1, len(self.edits) + 1):
+            with self.subTest(number=number):
+                state = get_version_state(document.id, number)
+                self.assertEqual(read_text([state]), "".join(self.edits[:number]))
+
+    def test_unknown_version(self):
+        document = create_document("a")
+        with self.assertRaises(DocumentVersion.DoesNotExist):
+            get_version_state(document.id, 2)
+
+    @override_settings(DOCUMENT_VERSION_MIN_INTERVAL_SECONDS=300)
+    def test_folds_saves_close_together_into_one_version(self):
+        document = create_document("a", "b", "c")
+
+        versions = DocumentVersion.objects.filter(document=document)
+        self.assertEqual(versions.count(), 1)
+        self.assertEqual(read_text([get_version_state(document.id, 1)]), "abc")
+
+    def test_prunes_old_diffs_but_keeps_versions_rebuildable(self):
+        document = create_document(*self.edits)
+        DocumentVersion.objects.filter(document=document, number__lte=5).update(
+            created_at=timezone.now() - timedelta(days=60)
+        )
+
+        # Diffs before the newest expired snapshot (4) are dropped
+        self.assertEqual(prune_versions([str(document.id)]), 2)
+
+        numbers = list(
+            DocumentVersion.objects.filter(document=document)
+            .order_by("number")
+            .values_list("number", flat=True)
+        )
+        self.assertEqual(numbers, [1, 4, 5, 6, 7])
+        for number in numbers:
+            state = get_version_state(document.id, number)
+            self.assertEqual(read_text([state]), "".join(self.edits[:number]))
+
+
+@test_settings
+class UpdateBatcherTests(SimpleTestCase):
+    async def batch(self, edits: List[str]):
+        """
+        Add edits to a room's batcher and collect what its group receives
+        """
+
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add("room", channel)
+        ydoc = Y.YDoc()
+        batcher = UpdateBatcher("room", ydoc)
+
+        source = Y.YDoc()
+        for text in edits:
+            await batcher.add(create_update_message(insert_text(source, text)))
+        pending = batcher.pending
+
+        received = []
+        while True:
+            try:
+                message = await asyncio.wait_for(channel_layer.receive(channel), 0.5)
+            except asyncio.TimeoutError:
+                return pending, received, str(ydoc.get_text("content"))
+            received.append(read_message(message["message"][2:]))
+
+    @override_settings(
+        DOCUMENT_UPDATE_BATCH_MAX_SIZE=3, DOCUMENT_UPDATE_BATCH_MAX_LATENCY_MS=60000
+    )
+    def test_flushes_full_batches(self):
+        pending, received, text = asyncio.run(self.batch(["a", "b", "c", "d"]))
+        # The fourth edit waits for the next batch
+        self.assertEqual(pending, 1)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(read_text(received), "abc")
+        self.assertEqual(text, "abcd")
+
+    @override_settings(
+        DOCUMENT_UPDATE_BATCH_MAX_SIZE=64, DOCUMENT_UPDATE_BATCH_MAX_LATENCY_MS=20
+    )
+    def test_flushes_batches_after_the_latency(self):
+        pending, received, _ = asyncio.run(self.batch(["a", "b"]))
+        self.assertEqual(pending, 2)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(read_text(received), "ab")
+
+
+@test_settings
+class RoomTests(SimpleTestCase):
+    def make_room(self, **kwargs) -> Room:
+        document_id = str(uuid.uuid4())
+        return Room(get_room_name(document_id), document_id, Y.YDoc(), **kwargs)
+
+    def test_tracks_unsaved_changes(self):
+        changed = []
+        room = self.make_room(on_change=changed.append)
+        insert_text(room.ydoc, "hello")
+        self.assertTrue(room.state_modified)
+        self.assertEqual(changed, [room])
+
+        first, state_vector = room.take_unsaved_changes()
+        self.assertEqual(read_text([first]), "hello")
+        room.mark_saved(state_vector)
+        self.assertFalse(room.state_modified)
+
+        insert_text(room.ydoc, " world")
+        update, _ = room.take_unsaved_changes()
+        # Only the changes since the last save
+        self.assertEqual(update, Y.encode_state_as_update(room.ydoc, state_vector))
+        self.assertEqual(read_text([first, update]), "hello world")
+
+    def test_size_is_reset_by_saves(self):
+        room = self.make_room(saved_state=Y.encode_state_as_update(Y.YDoc()))
+        for _ in range(50):
+            insert_text(room.ydoc, "x")
+        grown = room.size_bytes
+
+        update, state_vector = room.take_unsaved_changes()
+        state = Y.encode_state_as_update(room.ydoc)
+        room.mark_saved(state_vector, state)
+        self.assertEqual(room.size_bytes, len(state))
+        self.assertLess(room.size_bytes, grown)
+
+    def test_catch_up_is_not_an_unsaved_change(self):
+        room = self.make_room()
+        room.catch_up(insert_text(Y.YDoc(), "saved elsewhere"))
+        self.assertFalse(room.state_modified)
+        self.assertEqual(str(room.ydoc.get_text("content")), "saved elsewhere")
+        update, _ = room.take_unsaved_changes()
+        self.assertEqual(read_text([update]), "")
+
+    def test_applies_persisted_updates_once(self):
+        room = self.make_room(saved_state=Y.encode_state_as_update(Y.YDoc()))
+        update = insert_text(Y.YDoc(), "synced")
+
+        async def apply_twice():
+            first = await room.apply_persisted_update("sync-1", update)
+            second = await room.apply_persisted_update("sync-1", update)
+            return first, second
+
+        self.assertEqual(asyncio.run(apply_twice()), (True, False))
+        self.assertEqual(str(room.ydoc.get_text("content")), "synced")
+        self.assertFalse(room.state_modified)
+        # The update already counts as saved, so it isn't written again
+        self.assertEqual(room.saved_state_vector, Y.encode_state_vector(room.ydoc))
+        self.assertEqual(read_text([room.saved_state]), "synced")
+
+    def test_changes_of_rooms_owned_elsewhere_are_not_unsaved(self):
+        changed = []
+        room = self.make_room(on_change=changed.append)
+        room.owned = False
+        insert_text(room.ydoc, "forwarded to the owner")
+        self.assertFalse(room.state_modified)
+        self.assertEqual(changed, [])
+
+    def test_eviction(self):
+        registry = RoomRegistry()
+        room = self.make_room()
+
+        async def load():
+            return room
+
+        async def scenario():
+            results = []
+            await registry.acquire(room.name, load)
+            results.append(await registry.evict(room.name))
+            await registry.release(room.name)
+
+            insert_text(room.ydoc, "unsaved")
+            results.append(await registry.evict(room.name))
+
+            _, state_vector = room.take_unsaved_changes()
+            room.mark_saved(state_vector)
+            results.append(await registry.evict(room.name))
+            results.append(await registry.evict(room.name))
+            return results
+
+        # In use, unsaved, saved and idle, then already gone
+        self.assertEqual(asyncio.run(scenario()), [False, False, True, False])
+        self.assertNotIn(room.name, registry)
+
+    def test_enforces_the_memory_budget(self):
+        registry = RoomRegistry()
+        lifecycle = RoomLifecycle(registry)
+        rooms = [
+            self.make_room(saved_state=insert_text(Y.YDoc(), "x" * 100))
+            for _ in range(4)
+        ]
+        in_use, oldest, older, newest = rooms
+
+        async def load():
+            return in_use
+
+        async def scenario():
+            await registry.acquire(in_use.name, load)
+            for last_active, room in enumerate(rooms):
+                registry._rooms[room.name] = room
+                room.last_active = last_active
+
+            size = in_use.size_bytes
+            with override_settings(DOCUMENT_ROOM_MEMORY_BUDGET_BYTES=size * 3):
+                await lifecycle.enforce_budget()
+            resident = [room in registry.rooms() for room in rooms]
+
+            # Rooms in use are kept even when that exceeds the budget
+            with override_settings(DOCUMENT_ROOM_MEMORY_BUDGET_BYTES=size - 1):
+                with self.assertLogs("django.channels", "WARNING"):
+                    await lifecycle.enforce_budget()
+            return resident
+
+        # The least recently used idle room goes first
+        self.assertEqual(asyncio.run(scenario()), [True, False, True, True])
+        self.assertEqual(registry.rooms(), [in_use])
+
+    def test_resident_set_reports_update_traffic(self):
+        registry = RoomRegistry()
+        room = self.make_room()
+        registry._rooms[room.name] = room
+        updates = [insert_text(room.ydoc, text) for text in ["one", "two", "three"]]
+        # Saves don't count
+        _, state_vector = room.take_unsaved_changes()
+        room.mark_saved(state_vector)
+
+        [resident] = RoomLifecycle(registry).resident_set()
+        self.assertEqual(resident["update_bytes"], sum(len(u) for u in updates))
+        self.assertEqual(resident["updates_per_second"], 0.05)
+        # The rate decays while the room is quiet
+        later = room.last_active + UPDATE_RATE_SECONDS
+        self.assertAlmostEqual(room.update_rate(later), 0.05 / math.e, places=3)
+
+    def test_evicts_idle_rooms_owned_elsewhere(self):
+        registry = RoomRegistry()
+        room = self.make_room()
+        room.owned = False
+        registry._rooms[room.name] = room
+        insert_text(room.ydoc, "persisted by the owner")
+
+        self.assertTrue(asyncio.run(registry.evict(room.name)))
+
+
+@test_settings
+@override_settings(
+    DOCUMENT_AUTOSAVE_IDLE_SECONDS=0.1,
+    DOCUMENT_AUTOSAVE_MAX_DELAY_SECONDS=5,
+    DOCUMENT_AUTOSAVE_SAVE_DELAY_SECONDS=0.01,
+)
+class AutosaveTests(TransactionTestCase):
+    # Saves run on database threads of their own, outside a test transaction
+
+    def setUp(self):
+        self.write_behind = WriteBehind()
+
+    def make_room(self, document: Document) -> Room:
+        ydoc = Y.YDoc()
+        return Room(
+            get_room_name(str(document.id)),
+            str(document.id),
+            ydoc,
+            on_change=self.write_behind.mark_dirty,
+            saved_state=Y.encode_state_as_update(ydoc),
+        )
+
+    async def test_merges_edits_into_one_save(self):
+        document = await Document.objects.acreate(title="Untitled")
+        room = self.make_room(document)
+        for text in ["one ", "two ", "three"]:
+            insert_text(room.ydoc, text)
+
+        await self.write_behind.flush()
+
+        log = [
+            bytes(content)
+            async for content in DocumentUpdate.objects.filter(
+                document=document
+            ).values_list("content", flat=True)
+        ]
+        self.assertEqual(len(log), 1)
+        self.assertEqual(read_text(log), "one two three")
+        self.assertFalse(room.state_modified)
+        document = await Document.objects.aget(id=document.id)
+        self.assertEqual(document.readable_content, "one two three")
+
+        # Nothing left to save
+        await self.write_behind.flush()
+        self.assertEqual(await DocumentUpdate.objects.acount(), 1)
+
+    async def test_saves_idle_rooms_while_others_stay_busy(self):
+        quiet = self.make_room(await Document.objects.acreate(title="Quiet"))
+        busy = self.make_room(await Document.objects.acreate(title="Busy"))
+
+        insert_text(quiet.ydoc, "once")
+        for _ in range(20):
+            insert_text(busy.ydoc, ".")
+            await asyncio.sleep(0.02)
+        await asyncio.sleep(0)
+
+        self.assertFalse(quiet.state_modified)
+        self.assertTrue(busy.state_modified)
+        self.assertEqual(
+            await DocumentUpdate.objects.filter(document_id=quiet.document_id).acount(),
+            1,
+        )
+        self.assertEqual(
+            await DocumentUpdate.objects.filter(document_id=busy.document_id).acount(),
+            0,
+        )
+
+        await asyncio.sleep(0.3)
+        self.assertFalse(busy.state_modified)
+
+    @override_settings(DOCUMENT_AUTOSAVE_IDLE_SECONDS=60)
+    async def test_requested_saves_are_flushed_promptly(self):
+        room = self.make_room(await Document.objects.acreate(title="Untitled"))
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(room.name, channel)
+
+        insert_text(room.ydoc, "keep this")
+        self.write_behind.request_save(room)
+        message = await asyncio.wait_for(channel_layer.receive(channel), timeout=2)
+
+        self.assertEqual(message["type"], "broadcast_save")
+        self.assertFalse(room.state_modified)
+        self.assertEqual(
+            await DocumentUpdate.objects.filter(document_id=room.document_id).acount(),
+            1,
+        )
+
+    async def test_failed_saves_hold_back_only_their_own_room(self):
+        good = self.make_room(await Document.objects.acreate(title="Good"))
+        bad = self.make_room(await Document.objects.acreate(title="Bad"))
+        insert_text(good.ydoc, "saved")
+        insert_text(bad.ydoc, "not saved")
+        # Too long for the column, which fails the whole batch
+        bad.set_title("x" * 300)
+
+        with self.assertLogs("django.channels", "ERROR"):
+            await self.write_behind.flush()
+
+        self.assertFalse(good.state_modified)
+        self.assertTrue(bad.state_modified)
+        self.assertEqual(
+            await DocumentUpdate.objects.filter(document_id=good.document_id).acount(),
+            1,
+        )
+        self.assertEqual(
+            await DocumentUpdate.objects.filter(document_id=bad.document_id).acount(),
+            0,
+        )
+
+
+@test_settings
+class StateCacheTests(TransactionTestCase):
+    # Cached states are written once the saving transaction commits
+
+    def load(self, document: Document):
+        """
+        Load a document as a room does, returning its state and the ID of the
+        newest log entry it includes
+        """
+
+        _, updates, log_id = load_room_state(str(document.id))
+        return merge_updates(updates), log_id
+
+    def save(self, document: Document, state: bytes, log_id: int, text: str):
+        """
+        Save an edit on top of the given state, writing the new state through
+        """
+
+        ydoc = Y.YDoc()
+        Y.apply_update(ydoc, state)
+        update = insert_text(ydoc, text)
+        state = Y.encode_state_as_update(ydoc)
+        _, _, log_ids = append_updates(
+            {str(document.id): [update]},
+            states={str(document.id): (state, Y.encode_state_vector(ydoc), log_id)},
+        )
+        return state, log_ids.get(str(document.id))
+
+    def test_serves_loads_from_the_cached_state(self):
+        document = create_document("one ")
+        state, log_id = self.load(document)
+        state, log_id = self.save(document, state, log_id, "two")
+
+        cached = state_cache.get(document.id)
+        self.assertIsNotNone(cached)
+        self.assertEqual(cached.log_id, log_id)
+        # The state alone, without reading the snapshot or replaying the log
+        self.assertEqual(load_existing_state(str(document.id)), [state])
+        self.assertEqual(read_text([state]), "one two")
+
+    def test_replays_entries_written_after_the_cached_state(self):
+        document = create_document("one ")
+        state, log_id = self.load(document)
+        state, _ = self.save(document, state, log_id, "two ")
+        ydoc = Y.YDoc()
+        Y.apply_update(ydoc, state)
+        append_updates({str(document.id): [insert_text(ydoc, "three")]})
+
+        # Saves without a state invalidate the cached one
+        self.assertIsNone(state_cache.get(document.id))
+        self.assertEqual(
+            read_text(load_existing_state(str(document.id))), "one two three"
+        )
+
+    def test_misses_after_compaction(self):
+        document = create_document("one ")
+        state, log_id = self.load(document)
+        self.save(document, state, log_id, "two")
+        compact_document(str(document.id))
+
+        self.assertIsNone(load_cached_state(str(document.id)))
+        self.assertEqual(read_text(load_existing_state(str(document.id))), "one two")
+
+    def test_sync_invalidates_the_cached_state(self):
+        document = create_document("one ")
+        state, log_id = self.load(document)
+        state, _ = self.save(document, state, log_id, "two ")
+        client_doc = Y.YDoc()
+        Y.apply_update(client_doc, state)
+        update = insert_text(client_doc, "three")
+
+        sync_document_state(str(document.id), None, [update])
+
+        self.assertIsNone(state_cache.get(document.id))
+        self.assertEqual(
+            read_text(load_existing_state(str(document.id))), "one two three"
+        )
+
+    def test_does_not_cache_states_missing_other_writers_entries(self):
+        document = create_document()
+        state, log_id = self.load(document)
+        first, first_log_id = self.save(document, state, log_id, "AAA")
+        self.assertIsNotNone(first_log_id)
+
+        # Based on the same log entry, so it is missing the first save
+        _, second_log_id = self.save(document, state, log_id, "BBB")
+
+        self.assertIsNone(second_log_id)
+        self.assertIsNone(state_cache.get(document.id))
+        text = read_text(load_existing_state(str(document.id)))
+        self.assertIn("AAA", text)
+        self.assertIn("BBB", text)
+
+    async def test_two_rooms_saving_the_same_document(self):
+        document = await Document.objects.acreate(title="Shared")
+        rooms = []
+        for _ in range(2):
+            write_behind = WriteBehind()
+            state, log_id = await sync_to_async(self.load)(document)
+            ydoc = Y.YDoc()
+            Y.apply_update(ydoc, state)
+            room = Room(
+                get_room_name(str(document.id)),
+                str(document.id),
+                ydoc,
+                on_change=write_behind.mark_dirty,
+                saved_state=state,
+                saved_log_id=log_id,
+            )
+            rooms.append((room, write_behind))
+
+        for (room, write_behind), text in zip(rooms, ["AAA", "BBB"]):
+            insert_text(room.ydoc, text)
+            await write_behind.flush()
+        # Saved on top of the other room's entry, which it doesn't have
+        room, write_behind = rooms[0]
+        insert_text(room.ydoc, "CCC")
+        await write_behind.flush()
+
+        updates = await sync_to_async(load_existing_state)(str(document.id))
+        text = read_text(updates)
+        for part in ["AAA", "BBB", "CCC"]:
+            self.assertIn(part, text)
+        _, updates, _ = await sync_to_async(load_room_state)(str(document.id))
+        self.assertEqual(read_text(updates), text)
+
+
+@test_settings
+@override_settings(DOCUMENT_ROOM_LEASE_SECONDS=30)
+class OwnershipTests(TransactionTestCase):
+    # Owners save rooms on database threads of their own
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.redis = FakeAsyncRedis(server=self.server)
+        patcher = mock.patch(
+            "documents.ownership.aioredis.Redis.from_url",
+            side_effect=lambda url: FakeAsyncRedis(server=self.server),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def start_worker(self) -> RoomOwnership:
+        ownership = RoomOwnership(RoomRegistry())
+        await ownership.start()
+        self.addCleanup(self.stop_worker, ownership)
+        return ownership
+
+    def stop_worker(self, ownership: RoomOwnership):
+        for task in ownership._tasks:
+            task.cancel()
+
+    async def add_room(self, ownership: RoomOwnership, document: Document) -> Room:
+        room = Room(
+            get_room_name(str(document.id)),
+            str(document.id),
+            Y.YDoc(),
+            on_change=write_behind.mark_dirty,
+        )
+        ownership.registry._rooms[room.name] = room
+        await ownership.register(room)
+        return room
+
+    async def read_log(self, document: Document) -> str:
+        return read_text(
+            [
+                bytes(content)
+                async for content in DocumentUpdate.objects.filter(
+                    document=document
+                ).values_list("content", flat=True)
+            ]
+        )
+
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if await condition():
+                return
+            await asyncio.sleep(0.02)
+        self.fail("Timed out")
+
+    async def test_forwards_to_the_owner(self):
+        document = await Document.objects.acreate(title="Untitled")
+        owner, other = await self.start_worker(), await self.start_worker()
+        owned, forwarding = await self.add_room(owner, document), await self.add_room(
+            other, document
+        )
+        self.assertTrue(owned.owned)
+        self.assertFalse(forwarding.owned)
+        self.assertEqual(forwarding.owner_channel, owner.channel_name)
+
+        await other.forward(forwarding, insert_text(forwarding.ydoc, "hello"))
+
+        async def received():
+            return str(owned.ydoc.get_text("content")) == "hello"
+
+        await self.wait_for(received)
+        await write_behind.flush([owned])
+        self.assertEqual(await self.read_log(document), "hello")
+
+        # Kept until the owner is seen alive long enough to have received it
+        self.assertFalse(await other.registry.evict(forwarding.name))
+        later = time.monotonic() + 31
+        with mock.patch("documents.ownership.time.monotonic", return_value=later):
+            await other._maintain_lease(forwarding)
+        self.assertTrue(await other.registry.evict(forwarding.name))
+
+    async def test_takes_over_idle_rooms_from_dead_owners(self):
+        document = await Document.objects.acreate(title="Untitled")
+        owner, other = await self.start_worker(), await self.start_worker()
+        await self.add_room(owner, document)
+        forwarding = await self.add_room(other, document)
+        # The owner dies holding its lease
+        self.stop_worker(owner)
+
+        await other.forward(forwarding, insert_text(forwarding.ydoc, "hello"))
+        self.assertFalse(await other.registry.evict(forwarding.name))
+        await other._maintain_lease(forwarding)
+        self.assertFalse(forwarding.owned)
+        self.assertFalse(await other.registry.evict(forwarding.name))
+
+        await self.redis.delete(f"{LEASE_KEY_PREFIX}{forwarding.name}")
+        with self.assertLogs("django.channels", "INFO") as logs:
+            await other._maintain_lease(forwarding)
+        self.assertIn("Took over ownership", logs.output[0])
+
+        self.assertEqual(await self.read_log(document), "hello")
+        # Released again, since nobody here uses the room
+        self.assertFalse(forwarding.owned)
+        self.assertIsNone(await self.redis.get(f"{LEASE_KEY_PREFIX}{forwarding.name}"))
+        self.assertTrue(await other.registry.evict(forwarding.name))
+
+    async def test_sends_the_room_to_a_new_owner(self):
+        document = await Document.objects.acreate(title="Untitled")
+        owner, other = await self.start_worker(), await self.start_worker()
+        await self.add_room(owner, document)
+        forwarding = await self.add_room(other, document)
+        self.stop_worker(owner)
+        await other.forward(forwarding, insert_text(forwarding.ydoc, "hello"))
+
+        # Another worker takes over before this one, without the update
+        new_owner = await self.start_worker()
+        await self.redis.set(
+            f"{LEASE_KEY_PREFIX}{forwarding.name}", new_owner.channel_name
+        )
+        with self.assertLogs("django.channels", "INFO"):
+            await other._maintain_lease(forwarding)
+        self.assertEqual(forwarding.owner_channel, new_owner.channel_name)
+
+        async def saved():
+            return await self.read_log(document) == "hello"
+
+        # The new owner doesn't have the room open, so it writes the state
+        await self.wait_for(saved)
+        self.assertFalse(await other.registry.evict(forwarding.name))
+
+
+@test_settings
+class DocumentConsumerTests(TransactionTestCase):
+    # Consumers load and save rooms on database threads of their own
+
+    async def connect(self, document_id, query: str = "") -> WebsocketCommunicator:
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f"/ws/documents/{document_id}{query}"
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_control(self, communicator: WebsocketCommunicator):
+        """
+        Skip Yjs frames until the next control event, as a text or binary frame
+        """
+
+        while True:
+            message = await communicator.receive_output(timeout=2)
+            if message.get("text") is not None or is_control_frame(
+                message.get("bytes")
+            ):
+                return message
+
+    async def receive_event(self, communicator: WebsocketCommunicator):
+        message = await self.receive_control(communicator)
+        if message.get("text") is not None:
+            return json.loads(message["text"])
+        return decode_control_frame(message["bytes"])
+
+    async def test_titles_are_cut_to_the_column_length(self):
+        document = await Document.objects.acreate(title="Untitled")
+        communicator = await self.connect(document.id)
+
+        await communicator.send_json_to(
+            {"eventType": "TITLE_UPDATE", "title": "x" * 300}
+        )
+        event = await self.receive_event(communicator)
+        await communicator.disconnect()
+
+        self.assertEqual(event, {"eventType": "TITLE_UPDATE", "title": "x" * 255})
+        document = await Document.objects.aget(id=document.id)
+        self.assertEqual(document.title, "x" * 255)
+
+    async def receive_update(self, communicator: WebsocketCommunicator) -> bytes:
+        """
+        Skip other frames until the next Yjs document update
+        """
+
+        while True:
+            message = await communicator.receive_output(timeout=2)
+            data = message.get("bytes")
+            if (
+                data is not None
+                and len(data) > 2
+                and data[0] == YMessageType.SYNC
+                and data[1]
+                in (YSyncMessageType.SYNC_STEP2, YSyncMessageType.SYNC_UPDATE)
+            ):
+                return read_message(data[2:])
+
+    async def test_viewers_get_the_snapshot_and_relayed_frames(self):
+        document = await sync_to_async(create_document)("hello")
+        viewer = await self.connect(document.id, "?mode=view")
+        await viewer.send_to(bytes_data=create_sync_step1_message(b"\x00"))
+        snapshot = await self.receive_update(viewer)
+        self.assertEqual(read_text([snapshot]), "hello")
+
+        editor = await self.connect(document.id)
+        ydoc = Y.YDoc()
+        Y.apply_update(ydoc, snapshot)
+        await editor.send_to(
+            bytes_data=create_update_message(insert_text(ydoc, " world"))
+        )
+        relayed = await self.receive_update(viewer)
+        self.assertEqual(read_text([snapshot, relayed]), "hello world")
+
+        # Viewers joining later get the snapshot with the change applied
+        late = await self.connect(document.id, "?mode=view")
+        await late.send_to(bytes_data=create_sync_step1_message(b"\x00"))
+        self.assertEqual(read_text([await self.receive_update(late)]), "hello world")
+
+        for communicator in [viewer, editor, late]:
+            await communicator.disconnect()
+
+    async def test_control_events_in_each_clients_format(self):
+        document = await Document.objects.acreate(title="Untitled")
+        binary = await self.connect(document.id, "?control=msgpack")
+        text = await self.connect(document.id)
+
+        await binary.send_to(
+            bytes_data=encode_control_frame(
+                {"eventType": "TITLE_UPDATE", "title": "Binary"}
+            )
+        )
+        received = [
+            await self.receive_control(binary),
+            await self.receive_control(text),
+        ]
+
+        await binary.send_to(bytes_data=bytes([CONTROL_MESSAGE_TYPE, 0xC1]))
+        invalid = await self.receive_event(binary)
+        await text.send_to(text_data="not json")
+        invalid_json = await self.receive_event(text)
+        await binary.disconnect()
+        await text.disconnect()
+
+        event = {"eventType": "TITLE_UPDATE", "title": "Binary"}
+        self.assertEqual(decode_control_frame(received[0]["bytes"]), event)
+        self.assertEqual(json.loads(received[1]["text"]), event)
+        self.assertEqual(invalid, {"error": "Invalid control frame"})
+        self.assertEqual(invalid_json, {"error": "Invalid JSON data"})
+
+
+@test_settings
+@override_settings(DOCUMENT_OUTBOUND_MAX_MESSAGES=4)
+class SlowClientTests(SimpleTestCase):
+    def setUp(self):
+        self.sent = []
+        base = Y.YDoc()
+        self.base = insert_text(base, "hello")
+        self.editor = base
+
+        room = Room("slow_client", str(uuid.uuid4()), Y.YDoc())
+        Y.apply_update(room.ydoc, self.base)
+        self.consumer = DocumentConsumer()
+        self.consumer.room = room
+        self.consumer.ydoc = room.ydoc
+        self.consumer.room_name = room.name
+        self.consumer.channel_name = "slow-client"
+        self.consumer.send = self.record
+        self.consumer.close = mock.AsyncMock()
+        self.consumer.client_state_vector = Y.encode_state_vector(room.ydoc)
+
+    async def record(self, text_data=None, bytes_data=None, close=False):
+        self.sent.append(text_data if text_data is not None else bytes_data)
+
+    async def edit(self, text: str):
+        """
+        Make an edit in the room and broadcast it to the slow client
+        """
+
+        update = insert_text(self.editor, text)
+        Y.apply_update(self.consumer.ydoc, update)
+        await self.consumer.send_message({"message": create_update_message(update)})
+
+    def test_collapses_pending_updates_into_one_diff(self):
+        control = encode_control_frame({"eventType": "SAVE"})
+
+        async def scenario():
+            self.consumer.outbound = OutboundQueue(self.consumer.send)
+            await self.edit(" one")
+            self.consumer.enqueue(text_data='{"eventType": "TITLE_UPDATE"}')
+            await self.edit(" two")
+            self.consumer.enqueue(bytes_data=control)
+            self.assertFalse(self.consumer.outbound.is_over_limit())
+            await self.edit(" three")
+
+            # Control frames in their original order, then the diff
+            self.assertEqual(len(self.consumer.outbound), 3)
+            self.consumer.outbound.start()
+            await asyncio.sleep(0)
+            self.consumer.outbound.stop()
+
+        with self.assertLogs("django.channels", "INFO"):
+            asyncio.run(scenario())
+
+        self.assertEqual(self.sent[0], '{"eventType": "TITLE_UPDATE"}')
+        self.assertEqual(self.sent[1], control)
+        frame = self.sent[2]
+        self.assertEqual(
+            frame[:2], bytes([YMessageType.SYNC, YSyncMessageType.SYNC_UPDATE])
+        )
+        self.assertEqual(
+            read_text([self.base, read_message(frame[2:])]), "hello one two three"
+        )
+        # The client's state is only known to have advanced once it was sent
+        self.assertEqual(
+            self.consumer.client_state_vector,
+            Y.encode_state_vector(self.consumer.ydoc),
+        )
+
+    @override_settings(DOCUMENT_OUTBOUND_MAX_BYTES=256)
+    def test_disconnects_clients_too_far_behind(self):
+        async def scenario():
+            self.consumer.outbound = OutboundQueue(self.consumer.send)
+            await self.edit("x" * 1000)
+
+        with self.assertLogs("django.channels", "WARNING"):
+            asyncio.run(scenario())
+
+        self.assertIsNone(self.consumer.outbound)
+        self.consumer.close.assert_awaited_once_with(code=RESYNC_CLOSE_CODE)
+        self.assertEqual(
+            json.loads(self.sent[-1]), {"error": "Too far behind; please resync"}
+        )
+
+    def test_drop_sync_messages_keeps_other_frames(self):
+        queue = OutboundQueue(self.consumer.send)
+        update = insert_text(self.editor, " more")
+        queue.put(bytes_data=create_update_message(update))
+        queue.put(text_data="{}")
+        queue.put(bytes_data=encode_control_frame({"eventType": "SAVE"}))
+
+        self.assertEqual(queue.drop_sync_messages(), [update])
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(
+            queue.pending_bytes, 2 + len(encode_control_frame({"eventType": "SAVE"}))
+        )
+
+
+def awareness(client_id: int, clock: int, state: str = '{"cursor": 1}') -> bytes:
+    return create_awareness_message([(client_id, clock, state)])
+
+
+@test_settings
+@override_settings(
+    DOCUMENT_PRESENCE_MAX_UPDATES_PER_SECOND=5, DOCUMENT_PRESENCE_TIMEOUT_SECONDS=30
+)
+class PresenceTests(SimpleTestCase):
+    def setUp(self):
+        self.presence = Presence("presence")
+        patcher = mock.patch("documents.presence.group_send", new=mock.AsyncMock())
+        self.group_send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def broadcasts(self) -> List[List]:
+        return [
+            read_awareness_message(call.args[2]["message"])
+            for call in self.group_send.await_args_list
+        ]
+
+    def run_async(self, *steps):
+        async def scenario():
+            for step in steps:
+                step()
+                await self.presence.flush()
+
+        asyncio.run(scenario())
+
+    def test_merges_changes_into_one_broadcast(self):
+        self.run_async(
+            lambda: (
+                self.presence.receive("one", awareness(1, 1)),
+                self.presence.receive("two", awareness(2, 1)),
+            )
+        )
+
+        self.assertEqual(
+            sorted(self.broadcasts()[0]),
+            [(1, 1, '{"cursor": 1}'), (2, 1, '{"cursor": 1}')],
+        )
+        message = self.group_send.await_args.args[2]
+        self.assertEqual(message["origin"], PROCESS_ID)
+        self.assertEqual(message["sequence"], 1)
+
+    def test_throttles_each_connection(self):
+        later = time.monotonic() + 1
+        self.run_async(
+            lambda: self.presence.receive("one", awareness(1, 1)),
+            # Too soon for the first connection, but not for the second
+            lambda: (
+                self.presence.receive("one", awareness(1, 2, '{"cursor": 2}')),
+                self.presence.receive("one", awareness(1, 3, '{"cursor": 3}')),
+                self.presence.receive("two", awareness(2, 1)),
+            ),
+        )
+        with mock.patch("documents.presence.time.monotonic", return_value=later):
+            self.run_async(lambda: None)
+
+        self.assertEqual(
+            self.broadcasts(),
+            [
+                [(1, 1, '{"cursor": 1}')],
+                [(2, 1, '{"cursor": 1}')],
+                # Only the latest state of a throttled client
+                [(1, 3, '{"cursor": 3}')],
+            ],
+        )
+
+    def test_removes_clients_of_closed_connections(self):
+        self.run_async(
+            lambda: self.presence.receive("one", awareness(1, 1)),
+            # Removals go out even while the connection is throttled
+            lambda: self.presence.disconnect("one"),
+        )
+
+        self.assertEqual(self.presence.states, {})
+        self.assertIsNone(self.presence.snapshot_message())
+        self.assertEqual(self.broadcasts()[-1], [(1, 2, "null")])
+
+    def test_applies_remote_broadcasts_once(self):
+        self.presence.apply_remote("other", 1, awareness(7, 1))
+        # Passed on by every local consumer
+        self.presence.apply_remote("other", 1, awareness(7, 2, "{}"))
+        # Broadcast by this process
+        self.presence.apply_remote(PROCESS_ID, 5, awareness(8, 1))
+
+        self.assertEqual(self.presence.states, {7: '{"cursor": 1}'})
+
+        self.presence.apply_remote("other", 2, awareness(7, 2, "{}"))
+        self.assertEqual(self.presence.states, {7: "{}"})
+        self.assertEqual(
+            read_awareness_message(self.presence.snapshot_message()), [(7, 2, "{}")]
+        )
+
+    def test_expires_states_nobody_renewed(self):
+        self.presence.apply_remote("other", 1, awareness(7, 1))
+        later = time.monotonic() + 31
+        with mock.patch("documents.presence.time.monotonic", return_value=later):
+            self.assertIsNone(self.presence.snapshot_message())
+        self.assertEqual(self.presence.states, {})
+
+
+class ControlFrameTests(SimpleTestCase):
+    def test_negotiates_the_format(self):
+        self.assertEqual(
+            get_control_format({"query_string": b"control=msgpack"}), MSGPACK
+        )
+        self.assertEqual(get_control_format({"query_string": b"control=xml"}), JSON)
+        self.assertEqual(get_control_format({"query_string": b""}), JSON)
+        self.assertEqual(get_control_format({}), JSON)
+
+    def test_round_trip(self):
+        event = {"eventType": "TITLE_UPDATE", "title": "Notes"}
+        frame = encode_control_frame(event)
+        self.assertTrue(is_control_frame(frame))
+        self.assertEqual(decode_control_frame(frame), event)
+        self.assertEqual(encode_event(event, MSGPACK), {"bytes_data": frame})
+        self.assertEqual(encode_event(event, JSON), {"text_data": json.dumps(event)})
+
+    def test_yjs_frames_are_not_control_frames(self):
+        update = insert_text(Y.YDoc(), "text")
+        self.assertFalse(is_control_frame(create_update_message(update)))
+        self.assertFalse(is_control_frame(b""))
+        self.assertFalse(is_control_frame(None))
+
+    def test_rejects_invalid_frames(self):
+        for frame in [
+            bytes([CONTROL_MESSAGE_TYPE, 0xC1]),
+            bytes([CONTROL_MESSAGE_TYPE]) + msgpack.packb(["SAVE"]),
+            bytes([CONTROL_MESSAGE_TYPE]),
+        ]:
+            with self.subTest(frame=frame), self.assertRaises(InvalidControlFrame):
+                decode_control_frame(frame)
+
+    def test_broadcasts_are_encoded_once(self):
+        event = {"eventType": "SAVE"}
+        with (
+            mock.patch("documents.control.msgpack.packb", wraps=msgpack.packb) as packb,
+            mock.patch("documents.control.json.dumps", wraps=json.dumps) as dumps,
+        ):
+            message = make_broadcast("broadcast_save", event)
+            frames = [
+                broadcast_frame(message, control_format)
+                for control_format in [JSON, MSGPACK, JSON, MSGPACK]
+            ]
+
+        self.assertEqual(packb.call_count, 1)
+        self.assertEqual(dumps.call_count, 1)
+        self.assertEqual(frames[0], {"text_data": json.dumps(event)})
+        self.assertEqual(frames[1], {"bytes_data": encode_control_frame(event)})
+        # Every recipient gets the same frame object
+        self.assertIs(frames[0]["text_data"], frames[2]["text_data"])
+        self.assertIs(frames[1]["bytes_data"], frames[3]["bytes_data"])
+
+
+@test_settings
+class SyncTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("editor"))
+
+    def sync(self, document_id, state_vector: bytes, updates: List[bytes]):
+        return self.client.post(
+            f"/documents/{document_id}/sync/",
+            {
+                "state_vector": base64.b64encode(state_vector).decode(),
+                "updates": [base64.b64encode(update).decode() for update in updates],
+            },
+            format="json",
+        )
+
+    def test_applies_updates_and_returns_the_missing_diff(self):
+        document = create_document("server ")
+        client_doc = Y.YDoc()
+        offline = insert_text(client_doc, "offline")
+
+        response = self.sync(document.id, Y.encode_state_vector(client_doc), [offline])
+
+        self.assertEqual(response.status_code, 200)
+        Y.apply_update(client_doc, base64.b64decode(response.data["update"]))
+        self.assertIn("server ", str(client_doc.get_text("content")))
+        self.assertIn("offline", str(client_doc.get_text("content")))
+        self.assertEqual(
+            read_text(load_existing_state(str(document.id))),
+            str(client_doc.get_text("content")),
+        )
+        # The client's update is logged once, after the server's own save
+        self.assertEqual(DocumentUpdate.objects.filter(document=document).count(), 2)
+
+    def test_already_applied_updates_are_not_logged_again(self):
+        document = create_document("server")
+        state = load_existing_state(str(document.id))
+
+        response = self.sync(document.id, Y.encode_state_vector(Y.YDoc()), state)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(DocumentUpdate.objects.filter(document=document).count(), 1)
+
+    def test_unknown_document(self):
+        document_id = uuid.uuid4()
+        response = self.sync(document_id, b"\x00", [insert_text(Y.YDoc(), "nowhere")])
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Document.objects.filter(id=document_id).exists())
+        self.assertFalse(DocumentUpdate.objects.exists())
+
+    def test_invalid_update(self):
+        document = create_document("server")
+        response = self.sync(document.id, b"\x00", [b"\xff\xff\xff"])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(DocumentUpdate.objects.filter(document=document).count(), 1)
+
+    def test_invalid_state_vector(self):
+        document = create_document("server")
+        client_doc = Y.YDoc()
+        Y.apply_update(client_doc, load_existing_state(str(document.id))[0])
+        update = insert_text(client_doc, " offline")
+
+        response = self.sync(document.id, b"\x05", [update])
+
+        self.assertEqual(response.status_code, 400)
+        # Rejected before the update was saved, so a retry still pushes it to
+        # live editors
+        self.assertEqual(DocumentUpdate.objects.filter(document=document).count(), 1)
+
+
+def read_export(response) -> bytes:
+    if not response.streaming:
+        return response.content
+
+    async def read():
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    return async_to_sync(read)()
+
+
+@test_settings
+class ETagTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("reader"))
+
+    def save_edit(self, document: Document, text: str):
+        ydoc = Y.YDoc()
+        for update in load_existing_state(str(document.id)):
+            Y.apply_update(ydoc, update)
+        append_updates({str(document.id): [insert_text(ydoc, text)]})
+
+    def test_summaries_revalidate(self):
+        document = create_document("hello", title="Greeting")
+
+        response = self.client.get("/documents/summaries/")
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        self.assertEqual(response.data[0]["id"], str(document.id))
+
+        response = self.client.get("/documents/summaries/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.save_edit(document, " world")
+        response = self.client.get("/documents/summaries/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_export_revalidates_without_loading_the_state(self):
+        document = create_document("hello", title="Greeting")
+        url = f"/documents/{document.id}/export/?format=txt"
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"hello", read_export(response))
+        etag = response["ETag"]
+
+        with mock.patch("documents.views.load_existing_state") as load:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            # Served from the cache once rendered
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        load.assert_not_called()
+
+        self.save_edit(document, " world")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn(b"hello world", read_export(response))
+
+    def test_export_etag_depends_on_the_format(self):
+        document = create_document("hello")
+        etags = {
+            self.client.get(f"/documents/{document.id}/export/?format={format}")["ETag"]
+            for format in ["html", "md", "txt"]
+        }
+        self.assertEqual(len(etags), 3)
+
+    def test_export_rejects_unknown_formats(self):
+        document = create_document("hello")
+        response = self.client.get(f"/documents/{document.id}/export/?format=pdf")
+        self.assertEqual(response.status_code, 400)
+
+
+@test_settings
+class ArchiveTests(TransactionTestCase):
+    # Exports read from a snapshot of their own, at the start of a transaction
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "documents.archive")
+
+    def test_round_trip(self):
+        compacted = create_document("first ", "second", title="Compacted")
+        compact_document(str(compacted.id))
+        logged = create_document("only ", "in the log", title="Logged")
+        Document.objects.filter(id=logged.id).update(readable_content="only in the log")
+        originals = {
+            document.id: document for document in Document.objects.order_by("id")
+        }
+
+        call_command("export_documents", self.path, stdout=io.StringIO())
+        Document.objects.all().delete()
+        call_command("import_documents", self.path, stdout=io.StringIO())
+
+        imported = Document.objects.order_by("id")
+        self.assertEqual([document.id for document in imported], list(originals))
+        for document in imported:
+            original = originals[document.id]
+            self.assertEqual(document.title, original.title)
+            self.assertEqual(document.readable_content, original.readable_content)
+            self.assertEqual(document.created_at, original.created_at)
+            self.assertEqual(document.updated_at, original.updated_at)
+            self.assertEqual(document.summary.snippet, original.summary.snippet)
+        self.assertFalse(DocumentUpdate.objects.exists())
+        self.assertEqual(
+            read_text(load_existing_state(str(compacted.id))), "first second"
+        )
+        self.assertEqual(
+            read_text(load_existing_state(str(logged.id))), "only in the log"
+        )
+
+    def test_conflicts(self):
+        document = create_document("archived", title="Archived")
+        call_command("export_documents", self.path, stdout=io.StringIO())
+        Document.objects.filter(id=document.id).update(title="Renamed")
+
+        with self.assertRaises(CommandError):
+            call_command("import_documents", self.path, stdout=io.StringIO())
+
+        call_command(
+            "import_documents",
+            self.path,
+            on_conflict="skip",
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(Document.objects.get(id=document.id).title, "Renamed")
+
+        call_command(
+            "import_documents",
+            self.path,
+            on_conflict="replace",
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(Document.objects.get(id=document.id).title, "Archived")
+        self.assertEqual(Document.objects.count(), 1)
@@ -0,0 +1,131 @@
+from typing import Dict, Iterator, List, Optional, Union
+
+import y_py as Y
+
+# Root types the editor stores content in. TipTap's Collaboration extension
+# uses the "default" XML fragment; the editor page also initializes "content".
+XML_ROOTS = ("default",)
+TEXT_ROOTS = ("content",)
+
+XmlNode = Union[Y.YXmlElement, Y.YXmlText]
+
+
+def iter_children(element: Y.YXmlElement) -> Iterator[XmlNode]:
+    child = element.first_child
+    while child is not None:
+        yield child
+        child = child.next_sibling
+
+
+def render_node(node: XmlNode) -> str:
+    """
+    Render the plain text of an XML node, one line per nested element
+    """
+
+    if isinstance(node, Y.YXmlText):
+        return str(node)
+
+    parts = []
+    inline = []
+    for child in iter_children(node):
+        if isinstance(child, Y.YXmlText):
+            inline.append(str(child))
+            continue
+        if inline:
+            parts.append("".join(inline))
+            inline = []
+        parts.append(render_node(child))
+    if inline:
+        parts.append("".join(inline))
+    return "\n".join(part for part in parts if part)
+
+
+class TextExtractor:
+    """
+    Keep a plain-text rendering of a YDoc's content up to date.
+
+    Text is cached per top-level block of each XML root. Edits inside a block
+    only invalidate that block, and blocks inserted or deleted at the top
+    level are spliced into the cache, so extracting the text after an edit
+    only re-renders the blocks that changed.
+    """
+
+    def __init__(self, ydoc: Y.YDoc):
+        self._xml_roots = {name: ydoc.get_xml_element(name) for name in XML_ROOTS}
+        self._text_roots = {name: ydoc.get_text(name) for name in TEXT_ROOTS}
+
+        # A None entry marks a block or text root that needs to be re-rendered
+        self._blocks: Dict[str, List[Optional[str]]] = {}
+        self._texts: Dict[str, Optional[str]] = {}
+        self._subscriptions = []
+
+        for name, root in self._xml_roots.items():
+            self._blocks[name] = [None for _ in iter_children(root)]
+            self._subscriptions.append(
+                root.observe_deep(
+                    lambda events, name=name: self._on_xml_events(name, events)
+                )
+            )
+        for name, text in self._text_roots.items():
+            self._texts[name] = None
+            self._subscriptions.append(
+                text.observe(lambda event, name=name: self._texts.update({name: None}))
+            )
+
+    def _on_xml_events(self, name: str, events):
+        blocks = self._blocks[name]
+        for event in events:
+            path = event.path()
+            if path:
+                # A change somewhere inside a top-level block
+                if path[0] < len(blocks):
+                    blocks[path[0]] = None
+                continue
+
+            # Blocks were inserted into or removed from the root
+            index = 0
+            for change in event.delta:
+                if "retain" in change:
+                    index += change["retain"]
+                elif "insert" in change:
+                    inserted = len(change["insert"])
+                    blocks[index:index] = [None] * inserted
+                    index += inserted
+                elif "delete" in change:
+                    end = index + change["delete"]
+                    del blocks[index:end]
+
+    def get_text(self) -> str:
+        """
+        Return the document's plain text, re-rendering only what changed
+        """
+
+        parts = []
+        for name, root in self._xml_roots.items():
+            blocks = self._blocks[name]
+            if None in blocks:
+                count = 0
+                for index, child in enumerate(iter_children(root)):
+                    count += 1
+                    if index >= len(blocks):
+                        blocks.append(None)
+                    if blocks[index] is None:
+                        blocks[index] = render_node(child)
+                del blocks[count:]
+            parts.extend(block for block in blocks if block)
+
+        for name, text in self._text_roots.items():
+            if self._texts[name] is None:
+                self._texts[name] = str(text)
+            if self._texts[name]:
+                parts.append(self._texts[name])
+
+        return "\n".join(parts)
+
+
+def extract_text(ydoc: Y.YDoc) -> str:
+    """
+    Render the plain text of a YDoc in one go
+    """
+
+    return TextExtractor(ydoc).get_text()
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set
+
+import y_py as Y
+from channels.layers import get_channel_layer
+from ypy_websocket.yutils import (
+    YMessageType,
+    YSyncMessageType,
+    create_sync_step2_message,
+    create_update_message,
+    read_message,
+)
+
+from .broadcast import EMPTY_UPDATE
+from .crdt import crdt_executor
+from .db import run_db
+from .persistence import load_existing_state
+from .rooms import room_registry
+
+logger = logging.getLogger("django.channels")
+
+
+class ViewerHub:
+    """
+    Fan-out point for the read-only viewers of a room within this process.
+
+    The hub subscribes to the room's group once on behalf of all its viewers
+    and keeps the only copy of the document they need. Every event is encoded
+    once and the same frame is handed to each viewer's outbound queue, so a
+    viewer costs little more than its socket. Joining viewers get the cached
+    snapshot, which is only re-encoded after the document has changed.
+    """
+
+    def __init__(self, name: str, document_id: str):
+        self.name = name
+        self.document_id = document_id
+        # Consumers with `deliver` and `deliver_broadcast` methods
+        self.viewers: Set = set()
+        self.ydoc: Optional[Y.YDoc] = None
+        self.channel_name: Optional[str] = None
+        self._snapshot: Optional[bytes] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def open(self):
+        """
+        Subscribe to the room and load the document.
+
+        Raises Document.DoesNotExist if there is no such document.
+        """
+
+        channel_layer = get_channel_layer()
+        self.channel_name = await channel_layer.new_channel("viewers")
+        # Subscribe before loading so no update falls in between; updates
+        # queued meanwhile are applied once loading is done
+        await channel_layer.group_add(self.name, self.channel_name)
+
+        try:
+            room = room_registry.get(self.name)
+            if room is not None:
+                state = Y.encode_state_as_update(room.ydoc)
+            else:
+                updates = await run_db(load_existing_state, self.document_id)
+                state = await crdt_executor.merge(updates)
+        except Exception:
+            await channel_layer.group_discard(self.name, self.channel_name)
+            raise
+
+        self.ydoc = Y.YDoc()
+        Y.apply_update(self.ydoc, state)
+        self._task = asyncio.ensure_future(self._receive())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await get_channel_layer().group_discard(self.name, self.channel_name)
+
+    def snapshot_frame(self) -> bytes:
+        """
+        The whole document as a SYNC_STEP2 message
+        """
+
+        if self._snapshot is None:
+            self._snapshot = create_sync_step2_message(
+                Y.encode_state_as_update(self.ydoc)
+            )
+        return self._snapshot
+
+    def relay(
+        self, text_data: Optional[str] = None, bytes_data: Optional[bytes] = None
+    ):
+        for viewer in list(self.viewers):
+            viewer.deliver(text_data=text_data, bytes_data=bytes_data)
+
+    def apply_update(self, update: bytes):
+        Y.apply_update(self.ydoc, update)
+        self._snapshot = None
+
+    async def _receive(self):
+        channel_layer = get_channel_layer()
+        while True:
+            event = await channel_layer.receive(self.channel_name)
+            try:
+                self.dispatch(event)
+            except Exception:
+                logger.exception(f"Failed to relay {event['type']} to viewers")
+
+    def dispatch(self, event: Dict):
+        """
+        Handle an event sent to the room's group
+        """
+
+        if event["type"] == "send_message":
+            message = event["message"]
+            if len(message) > 2 and message[0] == YMessageType.SYNC:
+                # Viewers have nothing to contribute to another client's sync
+                if message[1] == YSyncMessageType.SYNC_STEP1:
+                    return
+                update = read_message(message[2:])
+                if update == EMPTY_UPDATE:
+                    return
+                self.apply_update(update)
+            self.relay(bytes_data=message)
+        elif event["type"] == "apply_remote_update":
+            self.apply_update(event["update"])
+            self.relay(bytes_data=create_update_message(event["update"]))
+        elif event["type"] == "broadcast_presence":
+            self.relay(bytes_data=event["message"])
+        elif event["type"] in ("broadcast_title_update", "broadcast_error"):
+            for viewer in list(self.viewers):
+                viewer.deliver_broadcast(event)
+
+
+class ViewerHubRegistry:
+    """
+    Process-wide registry of viewer hubs keyed by room name. A hub is opened
+    for a room's first viewer and closed when its last viewer leaves.
+    """
+
+    def __init__(self):
+        self._hubs: Dict[str, ViewerHub] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiters: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def _hub_lock(self, name: str):
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        self._waiters[name] = self._waiters.get(name, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[name] -= 1
+            if self._waiters[name] == 0 and name not in self._hubs:
+                del self._waiters[name]
+                del self._locks[name]
+
+    def hubs(self) -> List[ViewerHub]:
+        return list(self._hubs.values())
+
+    async def join(self, name: str, document_id: str, viewer) -> ViewerHub:
+        async with self._hub_lock(name):
+            hub = self._hubs.get(name)
+            if hub is None:
+                hub = ViewerHub(name, document_id)
+                await hub.open()
+                self._hubs[name] = hub
+                logger.debug(f"Opened viewer hub for {name}")
+            hub.viewers.add(viewer)
+            return hub
+
+    async def leave(self, name: str, viewer):
+        async with self._hub_lock(name):
+            hub = self._hubs.get(name)
+            if hub is None:
+                return
+            hub.viewers.discard(viewer)
+            if not hub.viewers:
+                del self._hubs[name]
+                await hub.close()
+                logger.debug(f"Closed viewer hub for {name}")
+
+
+viewer_hubs = ViewerHubRegistry()
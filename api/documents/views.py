@@ -1,34 +1,127 @@
 # from django.contrib.auth.models import User
 import logging
+import uuid
 
+import y_py as Y
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.generics import get_object_or_404
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
-from .models import Document
-from .serializers import DocumentSerializer
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
+
+from .db import db_executor
+from .lifecycle import room_lifecycle
+from .models import Document, DocumentVersion
+from .pagination import (
+    DocumentKeysetPagination,
+    DocumentSearchPagination,
+    DocumentVersionPagination,
+)
+from .persistence import (
+    InvalidStateVector,
+    InvalidUpdate,
+    get_version_state,
+    load_existing_state,
+    sync_document_state,
+)
+from .rendering import CONTENT_TYPES, get_export_etag, iterate_in_thread, render_chunks
+from .rooms import get_room_name, room_registry
+from .search import search_documents
+from .serializers import (
+    DocumentListSerializer,
+    DocumentSearchResultSerializer,
+    DocumentSerializer,
+    DocumentSummarySerializer,
+    DocumentSyncSerializer,
+    DocumentVersionSerializer,
+    DocumentVersionStateSerializer,
+)
+from .summaries import get_summaries_etag
+from .text import extract_text
 
 logger = logging.getLogger(__name__)
 
 
+class ExportNegotiation(DefaultContentNegotiation):
+    """
+    Leave the `format` query parameter to the export action, which renders
+    its own output
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+async def cache_export(chunks, cache_key: str):
+    """
+    Stream a rendering, caching it once complete unless it is too large
+    """
+
+    cached = []
+    size = 0
+    async for chunk in chunks:
+        yield chunk
+        if cached is not None:
+            size += len(chunk)
+            if size > settings.DOCUMENT_EXPORT_CACHE_MAX_BYTES:
+                cached = None
+            else:
+                cached.append(chunk)
+    if cached is not None:
+        await cache.aset(
+            cache_key, b"".join(cached), settings.DOCUMENT_EXPORT_CACHE_SECONDS
+        )
+
+
 class DocumentViewSet(viewsets.ModelViewSet):
     """
     Model ViewSet for Document model.
 
     Routes:
-    - GET /documents/ -> list(): Get list of documents
+    - GET /documents/ -> list(): Get list of documents, without their text
+        Pass `limit` and/or `cursor` to page through documents by keyset
     - GET /documents/{id}/ -> retrieve(): Get a single document
     - DELETE /documents/{id}/ -> destroy(): Delete a single document
+    - GET /documents/search/?q= -> search(): Full-text search, best matches first
+    - GET /documents/summaries/ -> summaries(): List documents with their
+        snippet, counts and last activity; supports ETag/If-None-Match and
+        the same pagination as list()
+    - POST /documents/{id}/sync/ -> sync(): Apply a client's pending updates and
+        return the diff it is missing
+    - GET /documents/rooms/ -> rooms(): Staff only; rooms held in memory by
+        this worker
+    - GET /documents/db-stats/ -> db_stats(): Staff only; database executor
+        and connection pool statistics for this worker
+    - GET /documents/{id}/versions/ -> versions(): List versions, newest first
+    - GET /documents/{id}/versions/{number}/ -> version(): Get the full
+        document state at a version
+    - GET /documents/{id}/export/?format=html|md|txt -> export(): Download the
+        document rendered as HTML, Markdown or plain text; supports
+        ETag/If-None-Match
 
     Not yet implemented:
     - PATCH /documents/{id}/add_collaborator/ -> add_collaborator():
         Add a collaborator to a document
     """
 
-    queryset = Document.objects.all()
+    # Never load the CRDT blob or search vector; the serializer doesn't expose them
+    queryset = Document.objects.defer("content", "search_vector")
     serializer_class = DocumentSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = DocumentKeysetPagination
+
+    def get_serializer_class(self):
+        if self.action == "list":
+            return DocumentListSerializer
+        return super().get_serializer_class()
 
     def perform_create(self, serializer):
         # TODO: Uncomment this after implementing auth and adding author field
@@ -48,10 +141,191 @@ class DocumentViewSet(viewsets.ModelViewSet):
         # TODO: Add query param for user ID to fetch docs owned by user or
         # collaborated on by user
 
-        self.queryset = self.queryset.order_by("-updated_at")
+        self.queryset = self.queryset.defer("readable_content").order_by(
+            "-updated_at", "-id"
+        )
 
         return super().list(request, *args, **kwargs)
 
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        terms = request.query_params.get("q", "").strip()
+        if not terms:
+            return Response(
+                {"error": "Missing search query"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        queryset = search_documents(
+            Document.objects.only("id", "title", "created_at", "updated_at"), terms
+        )
+        paginator = DocumentSearchPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = DocumentSearchResultSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=["get"])
+    def summaries(self, request):
+        etag = get_summaries_etag(request.get_full_path())
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        cache_key = f"document-summaries:{etag}"
+        data = cache.get(cache_key)
+        if data is None:
+            queryset = (
+                Document.objects.defer("content", "readable_content", "search_vector")
+                .select_related("summary__last_editor")
+                .order_by("-updated_at", "-id")
+            )
+            paginator = DocumentKeysetPagination()
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            if page is None:
+                data = DocumentSummarySerializer(queryset, many=True).data
+            else:
+                serializer = DocumentSummarySerializer(page, many=True)
+                data = paginator.get_paginated_response(serializer.data).data
+            cache.set(cache_key, data, settings.DOCUMENT_SUMMARY_CACHE_SECONDS)
+
+        # Clients must revalidate, which costs a single aggregate query
+        return Response(data, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    @action(detail=False, methods=["get"], permission_classes=[IsAdminUser])
+    def rooms(self, request):
+        return Response(
+            {
+                "size_bytes": room_registry.size_bytes,
+                "budget_bytes": settings.DOCUMENT_ROOM_MEMORY_BUDGET_BYTES,
+                "rooms": room_lifecycle.resident_set(),
+            }
+        )
+
+    @action(
+        detail=False,
+        methods=["get"],
+        url_path="db-stats",
+        permission_classes=[IsAdminUser],
+    )
+    def db_stats(self, request):
+        return Response(db_executor.stats())
+
+    @action(detail=True, methods=["post"])
+    def sync(self, request, pk=None):
+        document = self.get_object()
+        serializer = DocumentSyncSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            diff, state_vector, new_update = sync_document_state(
+                str(document.id),
+                serializer.validated_data.get("state_vector"),
+                serializer.validated_data["updates"],
+                editor_id=request.user.id,
+            )
+        except Document.DoesNotExist:
+            return Response(
+                {"error": "Document not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        except InvalidUpdate:
+            return Response(
+                {"error": "Invalid update"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        except InvalidStateVector:
+            return Response(
+                {"error": "Invalid state vector"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Push the client's changes, already persisted, to anyone editing the
+        # document live
+        if new_update:
+            async_to_sync(get_channel_layer().group_send)(
+                get_room_name(str(document.id)),
+                {
+                    "type": "apply_remote_update",
+                    "update": new_update,
+                    "update_id": uuid.uuid4().hex,
+                },
+            )
+
+        return Response(
+            DocumentSyncSerializer({"update": diff, "state_vector": state_vector}).data
+        )
+
+    @action(detail=True, methods=["get"])
+    def versions(self, request, pk=None):
+        document = self.get_object()
+        queryset = (
+            DocumentVersion.objects.filter(document=document)
+            .defer("content")
+            .order_by("-number")
+        )
+        paginator = DocumentVersionPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = DocumentVersionSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path=r"versions/(?P<number>[0-9]+)",
+    )
+    def version(self, request, pk=None, number=None):
+        document = self.get_object()
+        version = get_object_or_404(
+            DocumentVersion.objects.defer("content"),
+            document=document,
+            number=number,
+        )
+        try:
+            state = get_version_state(document.id, version.number)
+        except DocumentVersion.DoesNotExist:
+            return Response(
+                {"error": "Version history is incomplete"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        doc = Y.YDoc()
+        Y.apply_update(doc, state)
+        version.state = state
+        version.readable_content = extract_text(doc)
+        return Response(DocumentVersionStateSerializer(version).data)
+
+    @action(detail=True, methods=["get"], content_negotiation_class=ExportNegotiation)
+    def export(self, request, pk=None):
+        format = request.query_params.get("format", "html")
+        if format not in CONTENT_TYPES:
+            return Response(
+                {"error": f"Format must be one of {', '.join(CONTENT_TYPES)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        document = self.get_object()
+        etag = get_export_etag(document, format)
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return HttpResponse(
+                status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+            )
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "no-cache",
+            "Content-Disposition": f'attachment; filename="{document.id}.{format}"',
+        }
+        cache_key = f"document-export:{etag}"
+        content = cache.get(cache_key)
+        if content is not None:
+            return HttpResponse(
+                content, content_type=CONTENT_TYPES[format], headers=headers
+            )
+
+        # Render block by block off the event loop rather than in memory
+        updates = load_existing_state(document.id)
+        chunks = iterate_in_thread(render_chunks, updates, format, document.title)
+        return StreamingHttpResponse(
+            cache_export(chunks, cache_key),
+            content_type=CONTENT_TYPES[format],
+            headers=headers,
+        )
+
     @action(detail=True, methods=["patch"], url_path="add_collaborator")
     def add_collaborator(self, request):
         # TODO: Implement
@@ -9,18 +9,21 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 from django.core.asgi import get_asgi_application
 
-from minidoc_api.routing import websocket_urlpatterns
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "minidoc_api.settings")
 
+# Initialize Django before importing consumers, which depend on the ORM
+django_asgi_app = get_asgi_application()
+
+from minidoc_api.authentication import CachedAuthMiddlewareStack  # noqa: E402
+from minidoc_api.routing import websocket_urlpatterns  # noqa: E402
+
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
-        "websocket": AuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
+        "http": django_asgi_app,
+        "websocket": CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
     }
 )
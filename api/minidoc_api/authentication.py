@@ -0,0 +1,159 @@
+"""
+Authentication backed by a small in-process cache of users.
+
+Reconnect storms (deploys, network blips) make every client authenticate at
+once, which means a session and user lookup per WebSocket connection and a
+token lookup per REST request. Caching the resolved user by token key or
+session key for a short while keeps those lookups off the database.
+
+Entries are dropped on logout, when a token is deleted and when a user is
+saved or deleted. The cache is local to each worker, so other workers may keep
+serving a stale entry for up to `AUTH_CACHE_TTL_SECONDS`.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from channels.auth import AuthMiddleware, get_user
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
+
+
+class UserCache:
+    """
+    Thread-safe LRU cache with a TTL, mapping credentials to users
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, _, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, user_id: Any):
+        expires_at = time.monotonic() + settings.AUTH_CACHE_TTL_SECONDS
+        with self._lock:
+            self._entries[key] = (value, user_id, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.AUTH_CACHE_MAX_SIZE:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_user(self, user_id: Any):
+        """
+        Drop every entry that resolves to the given user
+        """
+
+        with self._lock:
+            for key in [
+                key for key, entry in self._entries.items() if entry[1] == user_id
+            ]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
+
+
+def get_session_user(request):
+    """
+    Return the user of the request's session, from the cache if possible
+    """
+
+    session_key = request.session.session_key
+    if session_key is None:
+        return auth.get_user(request)
+
+    user = user_cache.get(("session", session_key))
+    if user is None:
+        user = auth.get_user(request)
+        if user.is_authenticated:
+            user_cache.set(("session", session_key), user, user.pk)
+    return user
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """
+    Django's AuthenticationMiddleware, resolving `request.user` through the
+    user cache
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_session_user(request))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        credentials = user_cache.get(("token", key))
+        if credentials is None:
+            credentials = super().authenticate_credentials(key)
+            user_cache.set(("token", key), credentials, credentials[0].pk)
+        return credentials
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """
+    Channels' AuthMiddleware, resolving `scope["user"]` through the user cache
+    """
+
+    async def resolve_scope(self, scope):
+        session_key = scope["session"].session_key
+        user = user_cache.get(("session", session_key)) if session_key else None
+        if user is None:
+            user = await get_user(scope)
+            if session_key and user.is_authenticated:
+                user_cache.set(("session", session_key), user, user.pk)
+        scope["user"]._wrapped = user
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
+
+
+@receiver(user_logged_out)
+def invalidate_session(sender, request, user, **kwargs):
+    if request is not None and request.session.session_key:
+        user_cache.delete(("session", request.session.session_key))
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    user_cache.delete(("token", instance.key))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_user(sender, instance, **kwargs):
+    # e.g. deactivated users or changed passwords
+    user_cache.delete_user(instance.pk)
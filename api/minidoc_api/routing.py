@@ -1,7 +1,30 @@
+from urllib.parse import parse_qs
+
 from django.urls import path
 
-from documents.consumers import DocumentConsumer
+from documents.consumers import DocumentConsumer, ViewerConsumer
+
+
+class DocumentModeRouter:
+    """
+    Route document connections opened with `?mode=view` to the read-only
+    viewer consumer, and all others to the collaborative editor
+    """
+
+    def __init__(self, editor, viewer):
+        self.editor = editor
+        self.viewer = viewer
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get("query_string", b"").decode())
+        if query.get("mode") == ["view"]:
+            return await self.viewer(scope, receive, send)
+        return await self.editor(scope, receive, send)
+
 
 websocket_urlpatterns = [
-    path("ws/documents/<str:document_id>", DocumentConsumer.as_asgi())
+    path(
+        "ws/documents/<str:document_id>",
+        DocumentModeRouter(DocumentConsumer.as_asgi(), ViewerConsumer.as_asgi()),
+    )
 ]
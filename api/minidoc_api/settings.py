@@ -56,6 +56,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "rest_framework",
     "rest_framework.authtoken",
     "channels",
@@ -69,7 +70,7 @@ MIDDLEWARE = [
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "minidoc_api.authentication.CachedAuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -110,12 +111,23 @@ DATABASES = {
     }
 }
 
+# Reuse connections from a psycopg pool instead of connecting for every request
+# or consumer query
+if os.getenv("POSTGRES_POOL_ENABLED", "true").lower() == "true":
+    DATABASES["default"]["OPTIONS"] = {
+        "pool": {
+            "min_size": int(os.getenv("POSTGRES_POOL_MIN_SIZE", "2")),
+            "max_size": int(os.getenv("POSTGRES_POOL_MAX_SIZE", "10")),
+            "timeout": float(os.getenv("POSTGRES_POOL_TIMEOUT", "10")),
+        }
+    }
+
 
 # Rest Framework
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework.authentication.SessionAuthentication",
-        "rest_framework.authentication.TokenAuthentication",
+        "minidoc_api.authentication.CachedTokenAuthentication",
     ],
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
@@ -141,6 +153,23 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Cache up to this many authenticated users per worker, for this many seconds
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "30"))
+
+# Caches
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Encoded document states, shared by all workers; configure Redis with an
+    # LRU maxmemory-policy so it evicts the coldest documents
+    "documents": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("DOCUMENT_STATE_CACHE_URL", "redis://redis:6379/2"),
+    },
+}
+
 # Channel Layers
 CHANNEL_LAYERS = {
     "default": {
@@ -151,6 +180,138 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Documents
+# Compact a document's update log into its snapshot once it exceeds either limit
+DOCUMENT_UPDATE_LOG_MAX_COUNT = int(os.getenv("DOCUMENT_UPDATE_LOG_MAX_COUNT", "500"))
+DOCUMENT_UPDATE_LOG_MAX_BYTES = int(
+    os.getenv("DOCUMENT_UPDATE_LOG_MAX_BYTES", str(1024 * 1024))
+)
+
+# Flush each modified document once it hasn't changed for this many seconds,
+# and at most this many seconds after its first unsaved change
+DOCUMENT_AUTOSAVE_IDLE_SECONDS = float(os.getenv("DOCUMENT_AUTOSAVE_IDLE_SECONDS", "2"))
+DOCUMENT_AUTOSAVE_MAX_DELAY_SECONDS = float(
+    os.getenv("DOCUMENT_AUTOSAVE_MAX_DELAY_SECONDS", "10")
+)
+# Flush a document this many seconds after a client asks to save it, so saves
+# requested together are still written together
+DOCUMENT_AUTOSAVE_SAVE_DELAY_SECONDS = float(
+    os.getenv("DOCUMENT_AUTOSAVE_SAVE_DELAY_SECONDS", "0.05")
+)
+
+# Compress stored document snapshots larger than this many bytes
+DOCUMENT_CONTENT_COMPRESSION_MIN_BYTES = int(
+    os.getenv("DOCUMENT_CONTENT_COMPRESSION_MIN_BYTES", "1024")
+)
+DOCUMENT_CONTENT_COMPRESSION_LEVEL = int(
+    os.getenv("DOCUMENT_CONTENT_COMPRESSION_LEVEL", "6")
+)
+
+# Merge incoming Yjs updates per room before broadcasting them, sending each
+# batch after at most this many milliseconds or updates
+DOCUMENT_UPDATE_BATCHING_ENABLED = (
+    os.getenv("DOCUMENT_UPDATE_BATCHING_ENABLED", "false").lower() == "true"
+)
+DOCUMENT_UPDATE_BATCH_MAX_LATENCY_MS = int(
+    os.getenv("DOCUMENT_UPDATE_BATCH_MAX_LATENCY_MS", "20")
+)
+DOCUMENT_UPDATE_BATCH_MAX_SIZE = int(os.getenv("DOCUMENT_UPDATE_BATCH_MAX_SIZE", "64"))
+
+# Once a client has this many bytes or frames waiting to be sent, its pending
+# Yjs frames are replaced with one diff (or it is told to resync)
+DOCUMENT_OUTBOUND_MAX_BYTES = int(
+    os.getenv("DOCUMENT_OUTBOUND_MAX_BYTES", str(1024 * 1024))
+)
+DOCUMENT_OUTBOUND_MAX_MESSAGES = int(os.getenv("DOCUMENT_OUTBOUND_MAX_MESSAGES", "500"))
+
+# Store a full snapshot in the version history every this many versions and
+# diffs against the previous version in between
+DOCUMENT_VERSION_SNAPSHOT_INTERVAL = int(
+    os.getenv("DOCUMENT_VERSION_SNAPSHOT_INTERVAL", "20")
+)
+# Fold changes saved within this many seconds of a document's latest version
+# into that version rather than starting a new one
+DOCUMENT_VERSION_MIN_INTERVAL_SECONDS = int(
+    os.getenv("DOCUMENT_VERSION_MIN_INTERVAL_SECONDS", "300")
+)
+# Keep only the snapshots of versions older than this many days
+DOCUMENT_VERSION_RETENTION_DAYS = int(
+    os.getenv("DOCUMENT_VERSION_RETENTION_DAYS", "30")
+)
+
+# Keep rooms loaded after their last client leaves, evicting them once idle for
+# this many seconds or when the resident rooms exceed the memory budget
+# (approximated by their encoded document size)
+DOCUMENT_ROOM_IDLE_SECONDS = float(os.getenv("DOCUMENT_ROOM_IDLE_SECONDS", "300"))
+DOCUMENT_ROOM_MEMORY_BUDGET_BYTES = int(
+    os.getenv("DOCUMENT_ROOM_MEMORY_BUDGET_BYTES", str(64 * 1024 * 1024))
+)
+DOCUMENT_ROOM_SWEEP_INTERVAL_SECONDS = float(
+    os.getenv("DOCUMENT_ROOM_SWEEP_INTERVAL_SECONDS", "30")
+)
+
+# Let a single worker, holding a lease in Redis, persist each room while other
+# workers forward their clients' updates to it
+DOCUMENT_ROOM_OWNERSHIP_ENABLED = (
+    os.getenv("DOCUMENT_ROOM_OWNERSHIP_ENABLED", "false").lower() == "true"
+)
+DOCUMENT_ROOM_OWNERSHIP_REDIS_URL = os.getenv(
+    "DOCUMENT_ROOM_OWNERSHIP_REDIS_URL", "redis://redis:6379/1"
+)
+DOCUMENT_ROOM_LEASE_SECONDS = float(os.getenv("DOCUMENT_ROOM_LEASE_SECONDS", "15"))
+
+# Broadcast the presence (awareness) changes of a room's clients merged, every
+# this many milliseconds, passing on each client's changes at most this many
+# times a second. Presence not renewed for this many seconds is dropped.
+DOCUMENT_PRESENCE_BROADCAST_INTERVAL_MS = int(
+    os.getenv("DOCUMENT_PRESENCE_BROADCAST_INTERVAL_MS", "100")
+)
+DOCUMENT_PRESENCE_MAX_UPDATES_PER_SECOND = float(
+    os.getenv("DOCUMENT_PRESENCE_MAX_UPDATES_PER_SECOND", "5")
+)
+DOCUMENT_PRESENCE_TIMEOUT_SECONDS = float(
+    os.getenv("DOCUMENT_PRESENCE_TIMEOUT_SECONDS", "30")
+)
+
+# Cache rendered document summary listings for this many seconds
+DOCUMENT_SUMMARY_CACHE_SECONDS = int(os.getenv("DOCUMENT_SUMMARY_CACHE_SECONDS", "300"))
+
+# Cache rendered document exports of up to this many bytes for this many
+# seconds; larger exports are streamed without being cached
+DOCUMENT_EXPORT_CACHE_SECONDS = int(os.getenv("DOCUMENT_EXPORT_CACHE_SECONDS", "3600"))
+DOCUMENT_EXPORT_CACHE_MAX_BYTES = int(
+    os.getenv("DOCUMENT_EXPORT_CACHE_MAX_BYTES", str(1024 * 1024))
+)
+
+# Serve document loads from the encoded states in the "documents" cache,
+# written through on save and kept for this many seconds
+DOCUMENT_STATE_CACHE_ENABLED = (
+    os.getenv("DOCUMENT_STATE_CACHE_ENABLED", "true").lower() == "true"
+)
+DOCUMENT_STATE_CACHE_SECONDS = int(
+    os.getenv("DOCUMENT_STATE_CACHE_SECONDS", str(24 * 60 * 60))
+)
+
+# Merge and encode CRDT updates of at least this many bytes in an executor
+# ("process", "thread" or "inline") with this many workers rather than on the
+# event loop. y-py holds the GIL, so only processes free the loop entirely.
+DOCUMENT_CRDT_EXECUTOR = os.getenv("DOCUMENT_CRDT_EXECUTOR", "process")
+DOCUMENT_CRDT_OFFLOAD_MIN_BYTES = int(
+    os.getenv("DOCUMENT_CRDT_OFFLOAD_MIN_BYTES", str(256 * 1024))
+)
+DOCUMENT_CRDT_MAX_WORKERS = int(os.getenv("DOCUMENT_CRDT_MAX_WORKERS", "2"))
+
+# Run at most this many database calls from consumers at once; keep it below
+# the connection pool size so HTTP requests still get connections
+DOCUMENT_DB_MAX_CONCURRENCY = int(os.getenv("DOCUMENT_DB_MAX_CONCURRENCY", "8"))
+
+# Metrics
+# Bearer token scrapers present to read /metrics; without it, only staff users
+# can read them
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Log a timing breakdown of this fraction of received WebSocket messages
+METRICS_TRACE_SAMPLE_RATE = float(os.getenv("METRICS_TRACE_SAMPLE_RATE", "0"))
+
 # Logging
 LOGGING = {
     "version": 1,
@@ -0,0 +1,149 @@
+import time
+from unittest import mock
+
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory, TestCase, override_settings
+
+from .authentication import CachedTokenAuthentication, get_session_user, user_cache
+
+
+@override_settings(AUTH_CACHE_TTL_SECONDS=60, AUTH_CACHE_MAX_SIZE=100)
+class UserCacheTests(TestCase):
+    def setUp(self):
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+        self.user = User.objects.create_user("writer", password="secret")
+        self.token = Token.objects.create(user=self.user)
+
+    def authenticate_token(self):
+        user, _ = CachedTokenAuthentication().authenticate_credentials(self.token.key)
+        return user
+
+    def session_request(self):
+        session = SessionStore()
+        session.update(
+            {
+                "_auth_user_id": str(self.user.pk),
+                "_auth_user_backend": "django.contrib.auth.backends.ModelBackend",
+                "_auth_user_hash": self.user.get_session_auth_hash(),
+            }
+        )
+        session.save()
+        request = RequestFactory().get("/")
+        request.session = SessionStore(session.session_key)
+        return request
+
+    def test_token_hits_skip_the_database(self):
+        self.assertEqual(self.authenticate_token(), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate_token(), self.user)
+
+    def test_session_hits_skip_the_database(self):
+        request = self.session_request()
+        self.assertEqual(get_session_user(request), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_session_user(self.session_request_for(request)), self.user
+            )
+
+    def session_request_for(self, request):
+        # A new request presenting the same session cookie
+        other = RequestFactory().get("/")
+        other.session = SessionStore(request.session.session_key)
+        return other
+
+    def test_deleting_the_token_invalidates(self):
+        self.authenticate_token()
+        self.token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate_token()
+
+    def test_logout_invalidates(self):
+        client = APIClient()
+        response = client.post(
+            "/auth/login/", {"username": "writer", "password": "secret"}
+        )
+        self.assertEqual(response.status_code, 200)
+        session_key = client.session.session_key
+        token_client = APIClient()
+        token_client.credentials(HTTP_AUTHORIZATION=f"Token {response.data['token']}")
+        self.assertEqual(client.get("/documents/").status_code, 200)
+        self.assertEqual(token_client.get("/documents/").status_code, 200)
+        self.assertIsNotNone(user_cache.get(("session", session_key)))
+        self.assertIsNotNone(user_cache.get(("token", response.data["token"])))
+
+        self.assertEqual(client.post("/auth/logout/").status_code, 200)
+
+        self.assertIsNone(user_cache.get(("session", session_key)))
+        self.assertIsNone(user_cache.get(("token", response.data["token"])))
+        self.assertEqual(client.get("/documents/").status_code, 403)
+        self.assertEqual(token_client.get("/documents/").status_code, 403)
+
+    def test_deactivating_the_user_invalidates(self):
+        request = self.session_request()
+        get_session_user(request)
+        self.authenticate_token()
+
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertEqual(len(user_cache), 0)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate_token()
+        self.assertFalse(
+            get_session_user(self.session_request_for(request)).is_authenticated
+        )
+
+    def test_entries_expire(self):
+        self.authenticate_token()
+        later = time.monotonic() + 61
+        with mock.patch(
+            "minidoc_api.authentication.time.monotonic", return_value=later
+        ):
+            self.assertIsNone(user_cache.get(("token", self.token.key)))
+        self.assertEqual(len(user_cache), 0)
+
+    @override_settings(AUTH_CACHE_MAX_SIZE=2)
+    def test_evicts_least_recently_used_entries(self):
+        user_cache.set("a", "A", 1)
+        user_cache.set("b", "B", 2)
+        user_cache.get("a")
+        user_cache.set("c", "C", 3)
+
+        self.assertEqual(len(user_cache), 2)
+        self.assertIsNone(user_cache.get("b"))
+        self.assertEqual(user_cache.get("a"), "A")
+        self.assertEqual(user_cache.get("c"), "C")
+
+
+@override_settings(METRICS_TOKEN="scraper-token")
+class MetricsTests(TestCase):
+    def test_requires_staff_or_the_token(self):
+        user = User.objects.create_user("writer", password="secret")
+        client = APIClient()
+        self.assertEqual(client.get("/metrics").status_code, 401)
+        client.force_login(user)
+        self.assertEqual(client.get("/metrics").status_code, 401)
+        self.assertEqual(
+            client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code,
+            401,
+        )
+
+        response = client.get("/metrics", HTTP_AUTHORIZATION="Bearer scraper-token")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"minidoc_rooms_resident", response.content)
+
+        user.is_staff = True
+        user.save()
+        client.force_login(user)
+        self.assertEqual(client.get("/metrics").status_code, 200)
+
+    @override_settings(METRICS_TOKEN="")
+    def test_empty_token_grants_nothing(self):
+        response = APIClient().get("/metrics", HTTP_AUTHORIZATION="Bearer ")
+        self.assertEqual(response.status_code, 401)
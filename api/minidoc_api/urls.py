@@ -8,7 +8,7 @@ from django.urls import include, path
 
 from documents.views import DocumentViewSet
 
-from .views import CSRFTokenView, LoginView, LogoutView
+from .views import CSRFTokenView, LoginView, LogoutView, metrics
 
 router = DefaultRouter()
 router.register(r"documents", DocumentViewSet, basename="document")
@@ -24,5 +24,6 @@ urlpatterns = [
             ]
         ),
     ),
+    path("metrics", metrics, name="metrics"),
     path("", include(router.urls)),
 ]
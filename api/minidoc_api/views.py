@@ -1,3 +1,4 @@
+import hmac
 import logging
 
 from rest_framework import status
@@ -6,10 +7,17 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
+from django.http import HttpResponse
 from django.middleware.csrf import get_token
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
+
+import documents.metrics  # noqa: F401 (registers the document metrics)
+
+from .metrics import registry
 
 logger = logging.getLogger(__name__)
 
@@ -65,3 +73,23 @@ class CSRFTokenView(APIView):
 
         csrf_token = get_token(request)
         return Response({"csrfToken": csrf_token}, status=status.HTTP_200_OK)
+
+
+@require_GET
+def metrics(request):
+    """
+    Expose this process' metrics in the Prometheus text format, to staff users
+    or to scrapers presenting `METRICS_TOKEN` as a bearer token
+    """
+
+    if not request.user.is_staff:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        provided = request.headers.get("Authorization", "")
+        if not settings.METRICS_TOKEN or not hmac.compare_digest(
+            provided.encode(), expected.encode()
+        ):
+            return HttpResponse(status=401)
+
+    return HttpResponse(
+        registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -3,7 +3,8 @@
 export interface Document {
   id: string;
   title: string;
-  readable_content: string;
+  // Only returned for a single document, not in listings
+  readable_content?: string;
   created_at: string;
   updated_at: string;
 }